@@ -41,15 +41,6 @@ def check_file_exists(path):
 
     return True
 
-def save_to_file(data, path, filename):
-    if path == False:
-        path = os.path.dirname(os.path.abspath(__file__))
-
-    filename = "%s/%s" % (path, filename)
-    f = open(filename , "a")
-    f.write(data)
-    f.close()
-
 def run_piped_command(commands_as_nested_list):
     try:
         process_dict = []
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+import burst
+import simulate
+import basics
+import getopt
+import sys
+import os
+import json
+import random
+from math import sin,pi
+
+# Canned traces for comparing policy changes offline. Each trace is generated
+# from a fixed seed so runs are comparable across commits.
+
+TRACE_START = 1430438400 # 2015-05-01 00:00 UTC
+
+def print_usage():
+    print "Benchmark suite for the cloud bursting policy\n"
+    print "usage: " + __file__ + " [arguments]\n"
+    print "Arguments:"
+    print "   --help\t\t\t Prints this help message"
+    print "   -c [--config]\t\t Config file for the baseline run"
+    print "   -o [--compare]\t\t Config file for a second run to compare against"
+    print "   -t [--trace]\t\t\t Only run the named trace"
+    print "   -d [--dump]\t\t\t Write the canned traces to this directory for simulate.py"
+
+def usage_sample(timestamp, cpus, mem, disk):
+    return {'timestamp': timestamp,
+            u'master/cpus_used': cpus,
+            u'master/mem_used': mem,
+            u'master/disk_used': disk}
+
+def steady_trace(rng):
+    metrics = [usage_sample(TRACE_START + i*60, 30 + rng.uniform(-2, 2), 50000, 400000) for i in range(6*60)]
+    prices = [(TRACE_START + i*300, 0.0171 + rng.uniform(-0.0005, 0.0005)) for i in range(6*12)]
+    return metrics, prices
+
+def spike_trace(rng):
+    metrics = []
+    for i in range(6*60):
+        cpus = 30 + rng.uniform(-2, 2)
+        if 60 <= i < 180:
+            cpus += 20
+        metrics.append(usage_sample(TRACE_START + i*60, cpus, 55000, 400000))
+    prices = [(TRACE_START + i*300, 0.0171 + rng.uniform(-0.0005, 0.0005)) for i in range(6*12)]
+    return metrics, prices
+
+def diurnal_trace(rng):
+    metrics = []
+    for i in range(24*60):
+        load = 0.5 + 0.5*sin(2*pi*i/(24*60))
+        metrics.append(usage_sample(TRACE_START + i*60, 25 + 25*load + rng.uniform(-1, 1), 45000 + 30000*load, 500000))
+    prices = [(TRACE_START + i*300, 0.0171 + 0.004*sin(2*pi*i/288) + rng.uniform(-0.0005, 0.0005)) for i in range(24*12)]
+    return metrics, prices
+
+def memory_heavy_trace(rng):
+    metrics = []
+    for i in range(6*60):
+        mem = 50000
+        if 30 <= i < 270:
+            mem += 60000
+        metrics.append(usage_sample(TRACE_START + i*60, 20 + rng.uniform(-1, 1), mem + rng.uniform(-500, 500), 400000))
+    prices = [(TRACE_START + i*300, 0.0171 + rng.uniform(-0.0005, 0.0005)) for i in range(6*12)]
+    return metrics, prices
+
+def price_spike_trace(rng):
+    metrics = [usage_sample(TRACE_START + i*60, 45 + rng.uniform(-2, 2), 55000, 400000) for i in range(6*60)]
+    prices = []
+    for i in range(6*12):
+        price = 0.0171 + rng.uniform(-0.0005, 0.0005)
+        if 24 <= i < 36:
+            price = 0.12
+        prices.append((TRACE_START + i*300, price))
+    return metrics, prices
+
+TRACES = [('steady', steady_trace),
+          ('spike', spike_trace),
+          ('diurnal', diurnal_trace),
+          ('memory_heavy', memory_heavy_trace),
+          ('price_spike', price_spike_trace)]
+
+def dump_trace(path, name, metrics, prices):
+    if not basics.check_path_exists(path):
+        os.makedirs(path)
+
+    with open(os.path.join(path, '%s_metrics.json' % name), 'w') as tracefile:
+        for sample in metrics:
+            tracefile.write(json.dumps(sample) + '\n')
+
+    with open(os.path.join(path, '%s_prices.json' % name), 'w') as tracefile:
+        history = [{'Timestamp': timestamp, 'SpotPrice': '%.6f' % price} for timestamp, price in prices]
+        json.dump({'SpotPriceHistory': history}, tracefile)
+
+def run_suite(config, only=None):
+    results = dict()
+    for name, generate in TRACES:
+        if only and name != only:
+            continue
+
+        metrics, prices = generate(random.Random(name))
+        results[name] = simulate.simulate(config, metrics, prices)
+
+    return results
+
+def print_results(label, results):
+    print '   |------------------------------------------------------------------------------'
+    print '   | %-40s' % label
+    print '   |------------------------------------------------------------------------------'
+    print '   | Trace          | Cost     | Above burst | Churn | Peak | Sim hours/wall second'
+    print '   |------------------------------------------------------------------------------'
+    for name, generate in TRACES:
+        if name not in results:
+            continue
+
+        result = results[name]
+        print '   | %-14s | %.4f   | %5.1f%%      | %5i | %4i | %.0f' % (
+            name,
+            result['cost'],
+            100.0 * result['seconds_above_burst_point'] / max(1, result['simulated_seconds']),
+            result['churn'],
+            result['peak_instances'],
+            result['simulated_seconds'] / 3600.0 / max(result['wall_seconds'], 0.001))
+    print '   |------------------------------------------------------------------------------'
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "c:o:t:d:", ["help","config=","compare=","trace=","dump="])
+    except getopt.GetoptError as e:
+        basics.handle_error(e)
+
+    compare_path = False
+    only = None
+    dump_path = False
+    for o,p in opts:
+        if o in ["--help"]:
+            print_usage()
+            exit()
+        elif o in ["-o", "--compare"]:
+            compare_path = os.path.abspath(p)
+        elif o in ["-t", "--trace"]:
+            only = p
+        elif o in ["-d", "--dump"]:
+            dump_path = p
+
+    if dump_path:
+        for name, generate in TRACES:
+            metrics, prices = generate(random.Random(name))
+            dump_trace(dump_path, name, metrics, prices)
+        return
+
+    burst.set_options([o for o in opts if o[0] in ["-c", "--config"]])
+    config = burst.import_config().clusters()[0]
+
+    print_results('Baseline: %s' % burst.config_path, run_suite(config, only))
+
+    if compare_path:
+        burst.config_path = compare_path
+        print_results('Compared: %s' % compare_path, run_suite(burst.import_config().clusters()[0], only))
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,44 @@
 #!/usr/bin/env python
 import basics
+import pricestore
+import leader
+import events
+import forecast
+import fleet
+import metrics
+import inventory
+import drain
+import history
+import journal
+import zones
+import pipeline
+import warmpool
+import interruptions
+import ec2api
+import httpclient
 import boto3
-import yaml
+import settings
 import syslog
 import getopt
 import signal
 import sys
 import time
+import threading
 import datetime
 import dateutil
 import json
-import urllib2
+import httplib
+import socket
+import mmap
+from concurrent import futures
 from math import ceil,floor
 
+# Keep-alive connections shared by all Mesos and Marathon reads
+http = httpclient.HttpClient()
+
+# Longest wait before a failing cluster loop tries again
+MAX_BACKOFF = 600
+
 def print_usage():
     print "Automated cloud bursting script\n"
     print "usage: " + __file__ + " [arguments]\n"
@@ -49,19 +75,69 @@ def print_verbose(message):
     if verbose:
         print message
 
-def sleep(start_timestamp, duration):
+def sleep(start_timestamp, duration, wakeup=None):
+    # A set wakeup, e.g. on a Mesos leader change, ends the sleep early
     loop_time = time.time() - start_timestamp
     sleep_time = duration - loop_time
     print_verbose("The script used " + str(loop_time) + " seconds this loop")
     if sleep_time <= 0:
         print_verbose("Time used >= the set interval. Skipping sleep.")
         sys.stdout.flush()
-    else:
+    elif wakeup is None:
         print_verbose("Sleeping additional " + str(sleep_time) + " seconds")
         sys.stdout.flush()
         time.sleep(sleep_time)
+    else:
+        print_verbose("Sleeping additional " + str(sleep_time) + " seconds")
+        sys.stdout.flush()
+        if wakeup.wait(sleep_time):
+            print_verbose("Woken up before the interval passed")
+        wakeup.clear()
+
+def wait_for_next_loop(start_timestamp,duration,wakeup,debounce,min_interval):
+    loop_time = time.time() - start_timestamp
+    print_verbose("The script used " + str(loop_time) + " seconds this loop")
+    sys.stdout.flush()
+
+    # Sleep until the next poll is due or Marathon reports a change in demand
+    deadline = start_timestamp + duration
+    while not wakeup.is_set():
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        wakeup.wait(remaining)
+
+    # Let a burst of events settle, but never run loops closer than min_interval
+    wakeup.clear()
+    while time.time() < deadline and wakeup.wait(debounce):
+        wakeup.clear()
 
-def import_config():
+    remaining = start_timestamp + min_interval - time.time()
+    if remaining > 0:
+        time.sleep(remaining)
+
+    print_verbose("Woken up by a Marathon event")
+    return True
+
+def sleep_until_next_loop(start_timestamp,config,wakeup):
+    loop_time = time.time() - start_timestamp
+    metrics.LOOP_SECONDS.observe(loop_time, (config['name'],))
+    overrun = loop_time > config['execution_interval']
+    metrics.LAST_LOOP_OVERRUN.set(int(overrun), (config['name'],))
+    if overrun:
+        metrics.LOOP_OVERRUNS.inc(1, (config['name'],))
+
+    # execution_interval is required by the settings schema
+    if config.get('event_driven', False):
+        wait_for_next_loop(start_timestamp,
+                           config['execution_interval'],
+                           wakeup,
+                           config.get('event_debounce', 1),
+                           config.get('event_min_interval', 5))
+    else:
+        sleep(start_timestamp,config['execution_interval'],wakeup)
+
+def import_config(watch=False):
     global config_path
     if config_path == False:
         config_path = 'config.yml'
@@ -70,151 +146,256 @@ def import_config():
         print_verbose('Attempted to find config file: %s' % config_path)
         basics.handle_error('No configuration file found')
 
+    # Every cluster's settings, checked and with the launch configuration
+    # parsed. Watched for changes when the daemon runs.
     try:
-        with open(config_path, 'r') as configfile:
-            config = yaml.load(configfile)
-    except StandardError as e:
-        print_verbose(e)
-        basics.handle_error('Error when attempting to read the configuration file')
-
-    return config
+        return settings.ConfigSource(config_path, watch)
+    except settings.ConfigError as e:
+        basics.handle_error(e)
 
-def purge_old_spot_requests(ec2client,cur_spot_requests,timeout,max_bid):
+def utc_now():
     now_time = datetime.datetime.utcnow()
-    now_time = now_time.replace(tzinfo=dateutil.tz.tzutc())
+    return now_time.replace(tzinfo=dateutil.tz.tzutc())
 
+def purge_old_spot_requests(ec2client,cur_spot_requests,timeout,max_bid,now_time=None):
+    if now_time is None:
+        now_time = utc_now()
+
+    stale_requests = []
     for request in cur_spot_requests:
         if request[u'State'] == 'open':
             #print now_time - request[u'CreateTime']
             if (int(now_time.strftime('%s')) - int(request[u'CreateTime'].strftime('%s')) > timeout and
                 not request[u'SpotPrice'] == max_bid):
-                try:
-                    response = ec2client.cancel_spot_instance_requests(SpotInstanceRequestIds=[request[u'SpotInstanceRequestId']])
-                except Exception as e:
-                    print_verbose(e)
-                    basics.handle_error('Some error ocurred. Could not cancel old spot instance request.')
-
+                stale_requests.append(request[u'SpotInstanceRequestId'])
 
-def get_current_spot_slaves(ec2resource):
-    spot_slaves = []
-    filter = [{
-                'Name': 'instance-lifecycle',
-                'Values': ['spot'],
-              },
-              {
-                'Name': 'instance-state-name',
-                'Values': ['pending','running','rebooting']
-              },
-             ]
-
-    for instance in ec2resource.instances.filter(Filters=filter):
-        spot_slaves.append(instance)
-
-    return spot_slaves,ec2resource.instances.filter(Filter=filter)
-
-def get_current_spot_requests(ec2client,states):
-    spot_requests = []
-
-    data = ec2client.describe_spot_instance_requests()['SpotInstanceRequests']
-    if states == 'all':
-        return data
-
-    for request in data:
-        if request['State'] in states:
-            spot_requests.append(request['SpotInstanceRequestId'])
-
-    return spot_requests
-
-def import_launch_config():
-    config_path = 'launch_config.yml'
-    if not basics.check_file_exists(config_path):
-        print_verbose('Attempted to find config file: %s' % config_path)
-        basics.handle_error('No configuration file found')
-
-    try:
-        with open(config_path, 'r') as configfile:
-            config = yaml.load(configfile)
-    except StandardError as e:
-        print_verbose(e)
-        basics.handle_error('Error when attempting to read the configuration file')
-
-    return config
+    # One call per batch of stale requests
+    for batch in ec2api.batches(stale_requests):
+        try:
+            response = ec2client.cancel_spot_instance_requests(SpotInstanceRequestIds=batch)
+        except Exception as e:
+            # Still open next loop, so it is retried then
+            print_verbose(e)
+            basics.write_to_syslog('error', 'Could not cancel old spot instance requests: %s' % e)
 
-def request_spot_instances(ec2client,num_to_boot,instance_type,max_bid):
-    launch_config = import_launch_config()
+def request_spot_instances(ec2client,num_to_boot,instance_type,max_bid,launch_specification):
+    launch_config = dict(launch_specification, InstanceType=instance_type)
 
     try:
         response = ec2client.request_spot_instances(SpotPrice=str(max_bid),
                                                     InstanceCount=num_to_boot,
                                                     LaunchSpecification=launch_config)
     except Exception as e:
+        # Still short next loop, so it is requested again then
         print_verbose(e)
-        basics.handle_error('Requesting spot instances failed')
-
-def cancel_spot_requests(ec2client,spot_requests,num_to_cancel):
+        basics.write_to_syslog('error', 'Requesting spot instances failed: %s' % e)
+
+def request_spot_instances_in_zones(ec2client,num_to_boot,instance_type,ranked_zones,spread,avoided,launch_specification):
+    # Split over the best zones, each at its own bid
+    for zone, count in zones.split(num_to_boot, ranked_zones, spread, avoided):
+        print_verbose('Requesting %i %s spot instances in %s at %.3f' % (count, instance_type, zone['zone'], zone['bid']))
+        request_spot_instances(ec2client,
+                               count,
+                               instance_type,
+                               zone['bid'],
+                               zones.placement(launch_specification, zone))
+
+def start_pool_instances(ec2client,pool,num_to_start):
     try:
-        response = ec2client.cancel_spot_instance_requests(SpotInstanceRequestIds=spot_requests[-num_to_cancel:])
+        started = warmpool.start(ec2client, pool, num_to_start)
     except Exception as e:
+        # Spot requests make up for them
         print_verbose(e)
-        basics.handle_error('Termination of spot requests failed')
+        basics.write_to_syslog('error', 'Could not start warm pool instances: %s' % e)
+        return 0
+
+    if started:
+        print_verbose('Started %i instances from the warm pool' % started)
+    return started
+
+def place_spot_requests(ec2client,num_to_boot,instance_type,bid,snapshot,config):
+    # Warm pool instances first, they serve within a boot
+    if snapshot.get('pool') is not None and instance_type == config['instance_type']:
+        num_to_boot -= start_pool_instances(ec2client, snapshot['pool'], num_to_boot)
+        if num_to_boot <= 0:
+            return
+
+    if snapshot.get('zones'):
+        request_spot_instances_in_zones(ec2client,
+                                        num_to_boot,
+                                        instance_type,
+                                        snapshot['zones'][instance_type],
+                                        config.get('zone_spread', 2),
+                                        snapshot.get('avoided_zones', set()),
+                                        config['launch_specification'])
+    else:
+        request_spot_instances(ec2client,
+                               num_to_boot,
+                               instance_type,
+                               bid,
+                               config['launch_specification'])
+
+def cancel_spot_requests(ec2client,spot_requests,num_to_cancel):
+    for batch in ec2api.batches(spot_requests[-num_to_cancel:]):
+        try:
+            response = ec2client.cancel_spot_instance_requests(SpotInstanceRequestIds=batch)
+        except Exception as e:
+            print_verbose(e)
+            basics.write_to_syslog('error', 'Cancelling spot requests failed: %s' % e)
+
+def partial_hour_seconds(instance_lifetime_delta,partial_hour_limit):
+    # Calculate minutes in a partial hour used
+    if instance_lifetime_delta < partial_hour_limit:
+        return instance_lifetime_delta
+
+    return instance_lifetime_delta - (floor(instance_lifetime_delta/3600)*partial_hour_limit)
+
+def get_termination_victims(spot_instances,num_to_terminate,partial_hour_limit,now_time,agents=None,drainer=None,pool_ids=()):
+    # Instances already draining go first, then started warm pool instances
+    # (on-demand, billed by the second). With the agent allocations, then the
+    # least allocated agents and those closest to the end of their billed
+    # hour. Without them, the oldest instances as before.
+    candidates = []
+    for instance in spot_instances:
+        instance_lifetime_delta = int(now_time.strftime('%s')) - int(instance.launch_time.strftime('%s'))
+        draining = drainer is not None and drainer.is_draining(instance.instance_id)
+        pooled = instance.instance_id in pool_ids
+        if agents:
+            agent = agents.get(instance.private_ip_address)
+            order = (agent.allocated_share() if agent else 0.0, -(instance_lifetime_delta % 3600))
+        else:
+            order = (-instance_lifetime_delta,)
+        candidates.append(((not draining, not pooled) + order, instance, instance_lifetime_delta, draining or pooled))
+
+    victims = []
+    for rank, instance, instance_lifetime_delta, exempt in sorted(candidates, key=lambda c: c[0])[:num_to_terminate]:
+        part_seconds = partial_hour_seconds(instance_lifetime_delta, partial_hour_limit)
+        if part_seconds > partial_hour_limit or exempt:
+            victims.append(instance)
+        else:
+            print_verbose('%s has not reached the set partial hour limit. %.0f minutes has passed.' % (instance.instance_id,part_seconds/60))
+
+    return victims
+
+def terminate_spot_instances(ec2client,spot_instances,num_to_terminate,partial_hour_limit,now_time=None,agents=None,drainer=None,drain_timeout=600,pool=None):
+    if now_time is None:
+        now_time = utc_now()
+
+    pool_ids = set(i.instance_id for i in pool['in_service']) if pool is not None else set()
+    victims = get_termination_victims(spot_instances,num_to_terminate,partial_hour_limit,now_time,agents,drainer,pool_ids)
+
+    # Drained agents are terminated once they run nothing or their deadline passed
+    if drainer is not None:
+        ready = drainer.select(victims, agents, drain_timeout, pricestore.to_epoch(now_time))
+        for instance in victims:
+            if instance not in ready:
+                print_verbose('Draining %s before terminating it' % instance.instance_id)
+        victims = ready
+
+    # Started pool instances go back into the pool while it is short
+    if pool_ids:
+        to_stop = [i for i in victims if i.instance_id in pool_ids][:max(0, warmpool.shortfall(pool))]
+        if to_stop:
+            print_verbose('Stopping %s into the warm pool' % ', '.join(i.instance_id for i in to_stop))
+            try:
+                warmpool.stop(ec2client, pool, to_stop)
+                victims = [i for i in victims if i not in to_stop]
+            except Exception as e:
+                # Terminated instead, the pool fills up again
+                print_verbose(e)
+                basics.write_to_syslog('error', 'Could not stop instances into the warm pool: %s' % e)
+
+    for instance in victims:
+        print_verbose('Terminating %s...' % instance.instance_id)
+
+    # One call per batch of instances
+    for batch in ec2api.batches([instance.instance_id for instance in victims]):
+        try:
+            response = ec2client.terminate_instances(InstanceIds=batch)
+        except Exception as e:
+            # The instances are still running next loop, so it is retried then
+            print_verbose(e)
+            basics.write_to_syslog('error', 'Termination of spot instances failed: %s' % e)
 
-def terminate_spot_instances(ec2client,spot_instances,raw_spot_info,num_to_terminate,partial_hour_limit):
+def fetch_current_mesos_master(leader_detector,refresh=False):
     try:
-        list_with_timestamp = dict()
-        now_time = datetime.datetime.utcnow()
-        now_time = now_time.replace(tzinfo=dateutil.tz.tzutc())
-        terminated = 0
+        if refresh:
+            print_verbose('Resolving ZooKeeper url for the working Mesos Master')
+            mesos_master = leader_detector.refresh()
+        else:
+            mesos_master = leader_detector.get()
+    except Exception as e:
+        print_verbose(e)
+        mesos_master = None
 
-        for instance in spot_instances:
-            list_with_timestamp[instance.instance_id] = instance.launch_time.strftime('%s')
+    if not mesos_master:
+        basics.handle_error('Could not resolve the ZooKeeper url for the leading master node.')
 
-        for instance in sorted(list_with_timestamp, key=list_with_timestamp.get):
-            if terminated == num_to_terminate:
-                break
+    return mesos_master
 
-            instance_lifetime_delta = int(now_time.strftime('%s')) - int(list_with_timestamp[instance])
+def fetch_json(request,timeout=None):
+    print_verbose('Fetching %s' % request)
+    return http.get_json(request, timeout)
+
+def iter_json(request,prefix,timeout=None):
+    # Decodes the items under prefix one by one instead of the whole document
+    print_verbose('Streaming %s' % request)
+    return http.iter_json(request, prefix, timeout)
+
+def fetch_agents(snapshot):
+    # The agents with their allocations, keyed by ip. Only scale-down, drains
+    # and lead time measurement need them, so /master/slaves is fetched on
+    # first use in a loop. It is streamed, and each agent is cut down to its
+    # allocations as it arrives, so the document is never held in memory.
+    # None when it could not be fetched, which only leaves them out of this
+    # loop.
+    if 'agents' not in snapshot:
+        snapshot['agents'] = None
+        if snapshot.get('agents_url'):
+            try:
+                snapshot['agents'] = drain.agents_by_ip(iter_json(snapshot['agents_url'], 'slaves.item', snapshot['agents_timeout']))
+            except Exception as e:
+                print_verbose(e)
 
-            # Calculate minutes in a partial hour used
-            if instance_lifetime_delta < partial_hour_limit:
-                part_seconds = instance_lifetime_delta
-            else:
-                part_seconds = instance_lifetime_delta - (floor(instance_lifetime_delta/3600)*partial_hour_limit)
+    return snapshot['agents']
 
-            if part_seconds > partial_hour_limit:
-                print_verbose('Terminating %s...' % instance)
-                response = ec2client.terminate_instances(InstanceIds=[instance])
-            else:
-                print_verbose('%s has not reached the set partial hour limit. %.0f minutes has passed.' % (instance,part_seconds/60))
+def fetch_registered_ips(snapshot):
+    if 'registered_ips' not in snapshot:
+        agents = fetch_agents(snapshot)
+        snapshot['registered_ips'] = forecast.registered_agent_ips(agents) if agents is not None else None
 
-            terminated += 1
+    return snapshot['registered_ips']
 
+def fetch_and_parse_json(request,timeout=None):
+    try:
+        parsed_data = fetch_json(request, timeout)
     except Exception as e:
         print_verbose(e)
-        basics.handle_error('Termination of spot requests failed')
+        basics.handle_error('Failed JSON fetch and parse.')
 
-def fetch_current_mesos_master(mesos_zkurl):
-    print_verbose('Resolving ZooKeeper url for the working Mesos Master')
+    return parsed_data
 
-    #return '52.17.132.212:5050'
+def get_required_slaves(resources_in_use,config):
+    burst_point = config['burst_point_percentage']
+    required = 0
 
-    try:
-        mesos_master = basics.run_command('mesos-resolve %s' % mesos_zkurl)
-    except Exception as e:
-        print_verbose(e)
-        basics.handle_error('Could not resolve the ZooKeeper url for the leading master node.')
+    for resource in ['cpus', 'mem', 'disk']:
+        used = resources_in_use[resource]
+        baseline = config['baseline_%s' % resource]
+        per_slave = config['instance_%s' % resource]
 
-    return mesos_master
+        # Smallest n where used/(baseline + n*per_slave) < burst_point
+        n = max(0, int(floor((used/burst_point - baseline)/per_slave)) + 1)
 
-def fetch_and_parse_json(request):
-    try:
-        print_verbose('Fetching %s' % request)
-        json_data = urllib2.urlopen(request).read()
-        parsed_data = json.loads(json_data)
-    except Exception as e:
-        print_verbose(e)
-        basics.handle_error('Failed JSON fetch and parse.')
+        # Settle float rounding at the boundary with the exact usage comparison
+        while n > 0 and used/(baseline + (n-1)*per_slave) < burst_point:
+            n -= 1
+        while used/(baseline + n*per_slave) >= burst_point:
+            n += 1
 
-    return parsed_data
+        required = max(required, n)
+
+    return required
 
 def get_scaling_decision(resources_in_use,current_percent_in_use,active,pending,config):
 
@@ -222,31 +403,8 @@ def get_scaling_decision(resources_in_use,current_percent_in_use,active,pending,
     burst_point = config['burst_point_percentage']
     max_slaves = config['maximum_spot_slaves']
 
-    baseline_cpus = config['baseline_cpus']
-    baseline_mem = config['baseline_mem']
-    baseline_disk = config['baseline_disk']
-
-    instance_cpus = config['instance_cpus']
-    instance_mem = config['instance_mem']
-    instance_disk = config['instance_disk']
-
     pending_active_slaves = active + pending
 
-    # Calculate pending resources
-    pending_active_spot_resources = {'cpus': pending_active_slaves * instance_cpus,
-                                     'mem': pending_active_slaves * instance_mem,
-                                     'disk': pending_active_slaves * instance_disk}
-
-    # Total of pending, active and baseline resources
-    total_resources_apb = {'cpus': baseline_cpus + pending_active_spot_resources['cpus'],
-                           'mem': baseline_mem + pending_active_spot_resources['mem'],
-                           'disk': baseline_disk + pending_active_spot_resources['disk']}
-
-    # Calculate usage percentage if the pending resources would have been available
-    pending_usage_percent = {'cpus': resources_in_use['cpus']/total_resources_apb['cpus'],
-                             'mem': resources_in_use['mem']/total_resources_apb['mem'],
-                             'disk': resources_in_use['disk']/total_resources_apb['disk']}
-
     print_verbose('   |------------------------------------------')
     print_verbose('   |       Burst point value set to %.2f      ' % burst_point)
     print_verbose('   |------------------------------------------')
@@ -258,62 +416,51 @@ def get_scaling_decision(resources_in_use,current_percent_in_use,active,pending,
     print_verbose('   | Disk            |  %.2f%%\t | %i MB      ' % (current_percent_in_use['disk']*100,resources_in_use['disk']))
     print_verbose('   |------------------------------------------')
 
+    # Number of spot slaves needed to keep every resource below the burst point
+    required_slaves = get_required_slaves(resources_in_use,config)
 
-    # Scale up if the burst point is lower than the resources used
-    if any(pending_usage_percent[i] >= burst_point for i in pending_usage_percent):
-        if pending_active_slaves + 1 > max_slaves:
+    # Scale up by the whole deficit at once, capped by the max number of slaves
+    if required_slaves > pending_active_slaves:
+        if min(required_slaves, max_slaves) <= pending_active_slaves:
             print_verbose('The specified limit for max number of slaves has been hit. Will not scale up.')
             return 0
         else:
-            return 1
+            return min(required_slaves, max_slaves) - pending_active_slaves
 
     # Stop evaluating if the number of slaves is zero
     if pending_active_slaves == 0:
         print_verbose('')
         return 0
 
-    # Calculate the number of slaves that can potentially be terminated
-    scale_down_num = 0
-    while pending_active_slaves >= 0:
-
-        ## Calculate the usage percent if we remove scale_down_num slave
-        x_less_usage = {'cpus': (resources_in_use['cpus'])/(total_resources_apb['cpus'] - scale_down_num*instance_cpus),
-                        'mem': (resources_in_use['mem'])/(total_resources_apb['mem'] - scale_down_num*instance_mem),
-                        'disk': (resources_in_use['disk'])/(total_resources_apb['disk'] - scale_down_num*instance_disk)}
-
-        # Set any negative values to zero
-        for i in x_less_usage:
-            if x_less_usage[i] < 0:
-                x_less_usage[i] = 0.0
-
-        # Check if the usage exceeds the burst point
-        if not any(x_less_usage[i] >= burst_point for i in x_less_usage):
-            scale_down_num += 1
-            pending_active_slaves -= 1
-            continue
-
-        break
-
-    # Subtract 1 from scale_down_num, otherwise the script will scale up and down
-    # every minute. This will ensure that the number stays right above the the burst point
-    scale_down_num -= 1
-
-    if scale_down_num > 0:
-        return - scale_down_num
+    # Terminate the slaves that are not needed to stay below the burst point
+    if pending_active_slaves > required_slaves:
+        return - (pending_active_slaves - required_slaves)
 
     # No change
     return 0
 
-def fetch_current_price(ec2client,avail_zone,instance_type,max_limit):
+def fetch_current_price(ec2client,avail_zone,instance_type,max_limit,price_store=None,bid_percentile=None,bid_window=3600):
+    market_price = None
+
+    # Serve the price from the local history when there is one. It only asks
+    # EC2 for entries newer than what is already stored.
+    if price_store is not None:
+        price_store.refresh(ec2client, avail_zone, instance_type)
+        market_price = price_store.current(avail_zone, instance_type)
 
-    # Fetch the most recent price entry for the set zone and instance type
-    price_entry = ec2client.describe_spot_price_history(InstanceTypes=[instance_type],
-                                                          AvailabilityZone=avail_zone,
-                                                          ProductDescriptions=['Linux/UNIX (Amazon VPC)'],
-                                                          MaxResults=1)
+        # Bid at a percentile of the recent prices to ride out small spikes
+        if market_price is not None and bid_percentile is not None:
+            market_price = max(market_price, price_store.percentile(avail_zone, instance_type, bid_window, bid_percentile))
 
-    bid = float(price_entry['SpotPriceHistory'][0][u'SpotPrice']) + 0.001
+    if market_price is None:
+        # Fetch the most recent price entry for the set zone and instance type
+        price_entry = ec2client.describe_spot_price_history(InstanceTypes=[instance_type],
+                                                              AvailabilityZone=avail_zone,
+                                                              ProductDescriptions=['Linux/UNIX (Amazon VPC)'],
+                                                              MaxResults=1)
+        market_price = float(price_entry['SpotPriceHistory'][0][u'SpotPrice'])
 
+    bid = market_price + 0.001
 
     print_verbose('   |--------------------------------')
     print_verbose('   | Curent market price:    %.3f   ' % bid)
@@ -330,13 +477,470 @@ def fetch_current_price(ec2client,avail_zone,instance_type,max_limit):
 
     return final_bid
 
-def main():
-    # Get paramaters and process them
-    opts, args = get_params()
-    set_options(opts)
+def fetch_zone_bids(ec2client,zone_list,instance_types,max_limit,price_store=None,bid_percentile=None,bid_window=3600,volatility_weight=1.0):
+    # {instance type: zones ranked best first}, with the prices of every zone
+    # and type from one query. Types without a price in any zone are left out.
+    names = [zone for zone, subnet_id in zone_list]
+    if price_store is not None:
+        price_store.refresh_many(ec2client, names, instance_types)
+        prices = dict(((z, t), price_store.current(z, t)) for z in names for t in instance_types)
+    else:
+        prices = zones.fetch_zone_prices(ec2client, names, instance_types, time.time())
+
+    ranked = dict()
+    for instance_type in instance_types:
+        market_prices = dict()
+        volatilities = dict()
+        for zone in names:
+            market_price = prices.get((zone, instance_type))
+            # Volatility and percentiles need the price history
+            if market_price is not None and price_store is not None:
+                volatilities[zone] = price_store.volatility(zone, instance_type, bid_window)
+                if bid_percentile is not None:
+                    market_price = max(market_price, price_store.percentile(zone, instance_type, bid_window, bid_percentile))
+            market_prices[zone] = market_price
+
+        ranked[instance_type] = zones.rank_zones(zone_list, market_prices, volatilities, max_limit, volatility_weight)
+        if not ranked[instance_type]:
+            print_verbose('No spot price for %s in any of %s' % (instance_type, ', '.join(names)))
+            del ranked[instance_type]
+            continue
 
-    # Import the configuration and set some session settings
-    config = import_config()
+        print_verbose('   |--------------------------------')
+        print_verbose('   | %-20s Bid' % instance_type)
+        for zone in ranked[instance_type]:
+            print_verbose('   | %-20s %.3f%s' % (zone['zone'], zone['bid'], ' (limit)' if zone['capped'] else ''))
+        print_verbose('   |--------------------------------')
+
+    return ranked
+
+def record_history(ring,snapshot,now):
+    values = {'active': len(snapshot['cur_slaves']),
+              'pending': len(snapshot['cur_open_spot_requests']),
+              'bid': snapshot['bid']}
+    for resource in forecast.RESOURCES:
+        values['%s_used' % resource] = snapshot['resources_in_use'][resource]
+        values['%s_percent' % resource] = snapshot['current_percent_in_use'][resource]
+
+    ring.append(now, values)
+
+def get_window_resources(ring,windows,seconds,statistic):
+    # Windows are created on first use and kept up to date by the ring
+    if seconds not in windows:
+        windows[seconds] = ring.window(seconds)
+    window = windows[seconds]
+
+    resources = dict((r, window.aggregate('%s_used' % r, statistic)) for r in forecast.RESOURCES)
+
+    print_verbose('   |------------------------------------------')
+    print_verbose('   | %s of the last %i seconds (%i readings)   ' % (statistic, seconds, len(window)))
+    print_verbose('   |------------------------------------------')
+    print_verbose('   | CPUs            |  %.2f       ' % resources['cpus'])
+    print_verbose('   | Memory          |  %i MB      ' % resources['mem'])
+    print_verbose('   | Disk            |  %i MB      ' % resources['disk'])
+
+    return resources
+
+def execute_scaling_decision(ec2client,snapshot,desired_slaves,config,now_time=None,drainer=None):
+    cur_slaves = snapshot['cur_slaves']
+    cur_spot_requests = snapshot['cur_spot_requests']
+    cur_open_spot_requests = snapshot['cur_open_spot_requests']
+    bid = snapshot['bid']
+    num_active_pending_slaves = len(cur_slaves) + len(cur_open_spot_requests)
+
+    # Remove spot requests that exceeded the timeout and that does bid at max limit
+    purge_old_spot_requests(ec2client,
+                            cur_spot_requests,
+                            config['spot_request_timeout'],
+                            config['maximum_bid_limit'],
+                            now_time)
+
+    ## The number of pending and active instances are ok
+    if desired_slaves == num_active_pending_slaves:
+        print_verbose('The number of pending and active slaves are ok')
+        return
+
+    ## Request new spot instances
+    if desired_slaves > num_active_pending_slaves:
+        print_verbose('Not enough pending or active slave nodes. Requesting new ones')
+        place_spot_requests(ec2client,
+                            desired_slaves-num_active_pending_slaves,
+                            config['instance_type'],
+                            bid,
+                            snapshot,
+                            config)
+
+    ## Terminate excessive pending spot requests
+    if (num_active_pending_slaves > desired_slaves
+        and not len(cur_open_spot_requests) == 0):
+        excessive_slaves = num_active_pending_slaves - desired_slaves
+
+        if excessive_slaves < len(cur_open_spot_requests):
+            print_verbose('Excessive spot requests. Attempting to cancel %i' % excessive_slaves)
+            cancel_spot_requests(ec2client,cur_open_spot_requests,excessive_slaves)
+            num_active_pending_slaves = num_active_pending_slaves - excessive_slaves
+        else:
+            print_verbose('Excessive spot requests. Attempting to cancel %i' % len(cur_open_spot_requests))
+            cancel_spot_requests(ec2client,cur_open_spot_requests,len(cur_open_spot_requests))
+            num_active_pending_slaves = num_active_pending_slaves - len(cur_open_spot_requests)
+
+    ## Terminate excessive spot instances
+    if (num_active_pending_slaves > desired_slaves):
+        excessive_slaves = num_active_pending_slaves - desired_slaves
+        print_verbose('Excessive spot instances. Attempting to terminate %i' % excessive_slaves)
+
+        terminate_spot_instances(ec2client,
+                                 serving_instances(snapshot),
+                                 excessive_slaves,
+                                 config['partial_hour_limit'],
+                                 now_time,
+                                 fetch_agents(snapshot),
+                                 drainer,
+                                 config.get('drain_timeout', 600),
+                                 snapshot.get('pool'))
+
+def fill_warm_pool(ec2client,snapshot,config):
+    # Launch what the pool is short once its last changes show in a listing,
+    # and terminate warm instances beyond its size
+    pool = snapshot.get('pool')
+    if pool is None or pool['changed']:
+        return
+
+    missing = warmpool.shortfall(pool)
+    try:
+        if missing > 0:
+            print_verbose('Launching %i instances into the warm pool' % missing)
+            warmpool.launch(ec2client, missing, config['name'], config['instance_type'], config['launch_specification'])
+        elif missing < 0 and pool['warm']:
+            excess = [i.instance_id for i in pool['warm'][:-missing]]
+            print_verbose('Terminating %s from the warm pool' % ', '.join(excess))
+            ec2client.terminate_instances(InstanceIds=excess)
+    except Exception as e:
+        # Tried again next loop
+        print_verbose(e)
+        basics.write_to_syslog('error', 'Could not resize the warm pool: %s' % e)
+
+def add_warm_pool(snapshot,pool_instances,size):
+    # Started pool instances are active instances like the spot ones
+    snapshot['pool'] = warmpool.classify(pool_instances, size)
+    snapshot['cur_slaves'] = snapshot['cur_slaves'] + snapshot['pool']['in_service']
+
+def fetch_interruption_notices(url,timeout):
+    # Optional, so a failing relay only leaves its notices out of this loop
+    try:
+        return interruptions.metadata_notices(http.get_json(url, timeout))
+    except Exception as e:
+        print_verbose(e)
+        return dict()
+
+def add_interruptions(snapshot,notices):
+    # Listed instances with a termination notice, and when they go
+    listed = set(i.instance_id for i in snapshot['cur_slaves'])
+    snapshot['interrupted'] = dict((i, notices[i]) for i in notices if i in listed)
+
+def serving_instances(snapshot):
+    # Instances with a termination notice are on their way out. Leaving them
+    # out gets their replacements requested while they still run, and keeps
+    # them from being picked for termination.
+    interrupted = snapshot.get('interrupted') or {}
+    return [i for i in snapshot['cur_slaves'] if i.instance_id not in interrupted]
+
+def drain_interrupted(drainer,snapshot,now):
+    # Agents on instances with a termination notice drain until they go
+    interrupted = snapshot.get('interrupted')
+    if drainer is None or not interrupted:
+        return
+
+    for instance in snapshot['cur_slaves']:
+        if instance.instance_id in interrupted:
+            drainer.select([instance], fetch_agents(snapshot), max(0, interrupted[instance.instance_id] - now), now)
+
+def get_fleet_decision(resources_in_use,snapshot,config):
+    catalog = fleet.load_catalog(config)
+    bids = snapshot['bids']
+
+    members = fleet.get_fleet_members(serving_instances(snapshot), snapshot['cur_spot_requests'])
+    capacity = fleet.get_fleet_capacity(members, catalog, fleet.default_size(config))
+    deficit = fleet.get_deficit(resources_in_use, capacity, config)
+
+    print_verbose('   |------------------------------------------')
+    print_verbose('   | Resource:       |  Spot capacity\t | Deficit ')
+    print_verbose('   |------------------------------------------')
+    print_verbose('   | CPUs            |  %.2f\t | %.2f     ' % (capacity['cpus'],deficit['cpus']))
+    print_verbose('   | Memory          |  %i MB\t | %i MB    ' % (capacity['mem'],deficit['mem']))
+    print_verbose('   | Disk            |  %i MB\t | %i MB    ' % (capacity['disk'],deficit['disk']))
+    print_verbose('   |------------------------------------------')
+
+    # Scale up with the cheapest mix that covers every resource
+    if any(deficit[r] >= 0 for r in fleet.RESOURCES):
+        # A bid stuck at the limit is unlikely to be fulfilled
+        prices = dict((t, bids[t]) for t in bids if bids[t] < config['maximum_bid_limit']) or bids
+        max_count = config['maximum_spot_slaves'] - len(members)
+        if max_count <= 0:
+            print_verbose('The specified limit for max number of slaves has been hit. Will not scale up.')
+            return {'request': dict(), 'remove': []}
+        if not any(t['instance_type'] in prices for t in catalog):
+            print_verbose('No spot price for any instance type in the catalog. Will not scale up.')
+            return {'request': dict(), 'remove': []}
+
+        mix = fleet.cheapest_mix(deficit, catalog, prices, max_count)
+        if not mix:
+            print_verbose('No mix of at most %i instances covers the deficit. Will not scale up.' % max_count)
+            return {'request': dict(), 'remove': []}
+
+        for instance_type in mix:
+            print_verbose('   Planned %i x %s at %.3f' % (mix[instance_type], instance_type, prices[instance_type]))
+        return {'request': mix, 'remove': []}
+
+    # Scale down by what is not needed to stay below the burst point
+    return {'request': dict(), 'remove': fleet.get_removable_members(deficit, members, catalog, bids, fleet.default_size(config))}
+
+def execute_fleet_decision(ec2client,snapshot,plan,config,now_time=None,drainer=None):
+    # Remove spot requests that exceeded the timeout and that does bid at max limit
+    purge_old_spot_requests(ec2client,
+                            snapshot['cur_spot_requests'],
+                            config['spot_request_timeout'],
+                            config['maximum_bid_limit'],
+                            now_time)
+
+    if not plan['request'] and not plan['remove']:
+        print_verbose('The number of pending and active slaves are ok')
+        return
+
+    ## Request the planned mix of spot instances
+    for instance_type in plan['request']:
+        print_verbose('Requesting %i %s spot instances' % (plan['request'][instance_type], instance_type))
+        place_spot_requests(ec2client,
+                            plan['request'][instance_type],
+                            instance_type,
+                            snapshot['bids'][instance_type],
+                            snapshot,
+                            config)
+
+    ## Cancel excessive spot requests
+    requests = [member[0] for member in plan['remove'] if member[2]]
+    if requests:
+        print_verbose('Excessive spot requests. Attempting to cancel %i' % len(requests))
+        cancel_spot_requests(ec2client,requests,len(requests))
+
+    ## Terminate excessive spot instances
+    instances = [member[0] for member in plan['remove'] if not member[2]]
+    if instances:
+        print_verbose('Excessive spot instances. Attempting to terminate %i' % len(instances))
+        terminate_spot_instances(ec2client,
+                                 [i for i in snapshot['cur_slaves'] if i.instance_id in instances],
+                                 len(instances),
+                                 config['partial_hour_limit'],
+                                 now_time,
+                                 fetch_agents(snapshot),
+                                 drainer,
+                                 config.get('drain_timeout', 600),
+                                 snapshot.get('pool'))
+
+def get_forecast_resources(forecaster,lead_tracker,snapshot,now):
+    resources_in_use = snapshot['resources_in_use']
+
+    forecaster.update(resources_in_use, now)
+    lead_tracker.forget(snapshot['cur_spot_requests'])
+    if lead_tracker.waiting(snapshot['cur_spot_requests'], snapshot['cur_slaves']):
+        lead_tracker.observe(snapshot['cur_spot_requests'],
+                             snapshot['cur_slaves'],
+                             fetch_registered_ips(snapshot),
+                             now)
+
+    # Plan for the usage expected once new capacity would be ready, plus
+    # what Marathon is still waiting to place. Never plan below the current usage.
+    predicted = forecaster.predict(lead_tracker.lead_time)
+    queued = snapshot.get('queued_demand') or dict((r, 0.0) for r in forecast.RESOURCES)
+    planned = dict((r, max(resources_in_use[r], predicted[r]) + queued[r]) for r in forecast.RESOURCES)
+
+    print_verbose('   |------------------------------------------')
+    print_verbose('   | Forecast %i seconds ahead (%i samples)   ' % (lead_tracker.lead_time, lead_tracker.samples))
+    print_verbose('   |------------------------------------------')
+    print_verbose('   | Resource:       |  Predicted\t | Queued  ')
+    print_verbose('   |------------------------------------------')
+    print_verbose('   | CPUs            |  %.2f\t | %.2f     ' % (predicted['cpus'],queued['cpus']))
+    print_verbose('   | Memory          |  %i MB\t | %i MB    ' % (predicted['mem'],queued['mem']))
+    print_verbose('   | Disk            |  %i MB\t | %i MB    ' % (predicted['disk'],queued['disk']))
+    print_verbose('   |------------------------------------------')
+
+    return planned
+
+def collect_mesos_metrics(cluster_name,leader_detector,marathon_port,timeout,predictive=False):
+    ## Fetch current Mesos master
+    with metrics.PHASE_SECONDS.time((cluster_name, 'leader')):
+        mesos_master = fetch_current_mesos_master(leader_detector)
+
+    ## Collect Mesos metrics
+    try:
+        with metrics.PHASE_SECONDS.time((cluster_name, 'mesos_fetch')):
+            mesos_data = fetch_json('http://%s/metrics/snapshot' % mesos_master, timeout)
+    except (httplib.HTTPException, socket.error) as e:
+        # The cached master may have lost the election since the last watch event
+        print_verbose(e)
+        with metrics.PHASE_SECONDS.time((cluster_name, 'leader')):
+            mesos_master = fetch_current_mesos_master(leader_detector, refresh=True)
+        with metrics.PHASE_SECONDS.time((cluster_name, 'mesos_fetch')):
+            mesos_data = fetch_and_parse_json('http://%s/metrics/snapshot' % mesos_master, timeout)
+
+    ## Create a Marathon url
+    mesos_host = mesos_master.rsplit(':', 1)[0]
+    marathon_url = '%s:%i' % (mesos_host, marathon_port)
+    print_verbose('   Current Mesos master %s' % mesos_host)
+
+    ## Collect the usage values of the resources
+    resources_in_use = {'cpus': float(mesos_data[u'master/cpus_used']),
+                        'mem': float(mesos_data[u'master/mem_used']),
+                        'disk': float(mesos_data[u'master/disk_used'])}
+    current_percent_in_use = {'cpus': float(mesos_data[u'master/cpus_percent']),
+                              'mem': float(mesos_data[u'master/mem_percent']),
+                              'disk': float(mesos_data[u'master/disk_percent'])}
+
+    ## The pending demand for the forecast. It is optional, so a failing
+    ## fetch only leaves it out of this loop.
+    queued = None
+    if predictive:
+        try:
+            queued = forecast.queued_demand(iter_json('http://%s/v2/queue' % marathon_url, 'queue.item', timeout))
+        except Exception as e:
+            print_verbose(e)
+
+    return {'mesos_master': mesos_master,
+            'marathon_url': marathon_url,
+            'resources_in_use': resources_in_use,
+            'current_percent_in_use': current_percent_in_use,
+            'queued_demand': queued,
+            'agents_url': 'http://%s/master/slaves' % mesos_master,
+            'agents_timeout': timeout}
+
+def collect_metrics(executor,ec2client,leader_detector,ec2_inventory,config,price_store=None,request_filters=None,instance_filters=None):
+    # The Mesos and EC2 reads are independent of each other, so fire them all at
+    # once and wait for each one against its own deadline.
+    mesos_timeout = config.get('mesos_fetch_timeout', 10)
+    ec2_timeout = config.get('ec2_fetch_timeout', 20)
+
+    zone_list = zones.get_zones(config)
+    instance_types = [config['instance_type']] + [i['instance_type'] for i in config.get('instance_catalog') or []]
+
+    started = time.time()
+    sources = {'mesos': (executor.submit(collect_mesos_metrics,
+                                         config['name'],
+                                         leader_detector,
+                                         config['marathon_port'],
+                                         mesos_timeout,
+                                         config.get('predictive_scaling', False)), mesos_timeout),
+               'instances': (executor.submit(metrics.timed, config['name'], 'ec2_describe_instances',
+                                             inventory.fetch_spot_instances, ec2client, instance_filters), ec2_timeout),
+               'requests': (executor.submit(metrics.timed, config['name'], 'ec2_describe_spot_requests',
+                                            inventory.fetch_spot_requests, ec2client, request_filters), ec2_timeout)}
+
+    # Started, stopped and filling warm pool instances
+    if config.get('warm_pool_size'):
+        sources['pool'] = (executor.submit(metrics.timed, config['name'], 'ec2_describe_pool',
+                                           warmpool.fetch_pool_instances, ec2client, config['name']), ec2_timeout)
+
+    # Termination notices relayed from the instance metadata
+    if config.get('interruption_notices', False) and config.get('interruption_notice_url'):
+        sources['notices'] = (executor.submit(metrics.timed, config['name'], 'notices',
+                                              fetch_interruption_notices,
+                                              config['interruption_notice_url'],
+                                              mesos_timeout), mesos_timeout)
+
+    # Every zone and instance type in one price query when spread over zones
+    if len(zone_list) > 1:
+        sources['zones'] = (executor.submit(metrics.timed, config['name'], 'pricing',
+                                            fetch_zone_bids,
+                                            ec2client,
+                                            zone_list,
+                                            sorted(set(instance_types)),
+                                            config['maximum_bid_limit'],
+                                            price_store,
+                                            config.get('bid_percentile'),
+                                            config.get('bid_window', 3600),
+                                            config.get('zone_volatility_weight', 1.0)), ec2_timeout)
+    else:
+        sources['bid'] = (executor.submit(metrics.timed, config['name'], 'pricing',
+                                          fetch_current_price,
+                                          ec2client,
+                                          config['availability_zone'],
+                                          config['instance_type'],
+                                          config['maximum_bid_limit'],
+                                          price_store,
+                                          config.get('bid_percentile'),
+                                          config.get('bid_window', 3600)), ec2_timeout)
+
+    # One price per instance type when planning a mixed fleet
+    if config.get('instance_catalog') and len(zone_list) == 1:
+        for instance in config['instance_catalog']:
+            sources['bid:%s' % instance['instance_type']] = (executor.submit(metrics.timed, config['name'], 'pricing',
+                                                                             fetch_current_price,
+                                                                             ec2client,
+                                                                             config['availability_zone'],
+                                                                             instance['instance_type'],
+                                                                             config['maximum_bid_limit'],
+                                                                             price_store,
+                                                                             config.get('bid_percentile'),
+                                                                             config.get('bid_window', 3600)), ec2_timeout)
+
+    results = dict()
+    for name in sources:
+        future, timeout = sources[name]
+        try:
+            results[name] = future.result(timeout=max(0, started + timeout - time.time()))
+        except futures.TimeoutError:
+            print_verbose('Timed out after %i seconds while collecting %s metrics' % (timeout, name))
+        except Exception as e:
+            print_verbose(e)
+            basics.write_to_syslog('error', 'Could not collect %s metrics for cluster %s: %s' % (name, config['name'], e))
+
+    if len(results) != len(sources):
+        # Do not decide on a partial view of the cluster
+        for name in sources:
+            sources[name][0].cancel()
+        return None
+
+    print_verbose('   Collected all metrics in %.2f seconds' % (time.time() - started))
+
+    # Checked before the inventory takes the listings, so their changes are
+    # not lost with the snapshot
+    if 'zones' in results and config['instance_type'] not in results['zones']:
+        print_verbose('No spot price for %s. Skipping the scaling decision.' % config['instance_type'])
+        return None
+
+    changes = ec2_inventory.update(results['requests'], results['instances'])
+    for change in sorted(changes):
+        if changes[change]:
+            print_verbose('   %s: %s' % (change.replace('_', ' ').capitalize(), ', '.join(changes[change])))
+
+    snapshot = results['mesos']
+    snapshot['inventory_changes'] = changes
+    snapshot['cur_slaves'] = ec2_inventory.spot_instances()
+    snapshot['cur_spot_requests'] = ec2_inventory.spot_requests()
+    snapshot['cur_open_spot_requests'] = ec2_inventory.open_request_ids()
+    if 'pool' in results:
+        add_warm_pool(snapshot, results['pool'], config['warm_pool_size'])
+    if config.get('interruption_notices', False):
+        notices = interruptions.request_notices(snapshot['cur_spot_requests'])
+        notices.update(results.get('notices') or {})
+        add_interruptions(snapshot, notices)
+    if 'zones' in results:
+        # Bids of the best zone, where the next request goes first
+        snapshot['zones'] = results['zones']
+        snapshot['bid'] = results['zones'][config['instance_type']][0]['bid']
+        snapshot['bids'] = dict((i['instance_type'], results['zones'][i['instance_type']][0]['bid'])
+                                for i in config.get('instance_catalog') or [] if i['instance_type'] in results['zones'])
+    else:
+        snapshot['bid'] = results['bid']
+        snapshot['bids'] = dict((name[len('bid:'):], results[name]) for name in results if name.startswith('bid:'))
+
+    return snapshot
+
+def get_ec2client(ec2clients,config):
+    # One client per region and account. Clusters in the same region share it,
+    # and with it the API rate budget that EC2 enforces per region.
+    key = (config['default_region'], config['aws_access_key_id'], config.get('ec2_endpoint_url'))
+    if key in ec2clients:
+        return ec2clients[key]
 
     try:
         session = boto3.session.Session(aws_access_key_id=config['aws_access_key_id'],
@@ -346,132 +950,485 @@ def main():
         print_verbose(e)
         basics.handle_error('Could not establish a session towards AWS API, check config')
 
-    # Start EC2 and resource and client session
+    # Start EC2 client session. All calls share one rate budget and back
+    # off when EC2 throttles the account.
     try:
-        ec2resource = session.resource('ec2')
-        ec2client = session.client('ec2')
+        ec2clients[key] = ec2api.ThrottledClient(session.client('ec2', endpoint_url=config.get('ec2_endpoint_url')),
+                                                 ec2api.TokenBucket(config.get('ec2_api_rate', 5),
+                                                                    config.get('ec2_api_burst', 20)),
+                                                 config.get('ec2_api_retries', 5),
+                                                 config.get('ec2_api_backoff', 0.5))
     except Exception as e:
         print_verbose(e)
         basics.handle_error('Could not establish a session towards EC2.')
 
-    # Main execution
+    return ec2clients[key]
+
+def get_price_store(price_stores,config):
+    # Local spot price history, shared by the clusters that use the same file
+    if not config.get('price_store_path'):
+        return None
+
+    if config['price_store_path'] not in price_stores:
+        try:
+            price_stores[config['price_store_path']] = pricestore.PriceStore(config['price_store_path'],
+                                                                             config.get('price_history_window', 7*24*3600),
+                                                                             config.get('price_refresh_interval', 300))
+        except Exception as e:
+            print_verbose(e)
+            basics.handle_error('Could not open the spot price store.')
+
+    return price_stores[config['price_store_path']]
+
+def get_journal(journals,config):
+    # One journal per file, shared by the clusters that name the same one
+    if not config.get('journal_path'):
+        return None
+
+    if config['journal_path'] not in journals:
+        try:
+            journals[config['journal_path']] = journal.Journal(config['journal_path'],
+                                                               config.get('journal_max_bytes', 1024*1024))
+        except (IOError, OSError) as e:
+            print_verbose(e)
+            basics.handle_error('Could not open the journal %s' % config['journal_path'])
+
+    return journals[config['journal_path']]
+
+def get_inventory_filters(config):
+    # Clusters sharing a region are told apart by the security group of their
+    # launch configuration
+    if not config.get('multi_cluster'):
+        return [], []
+
+    group_id = config.get('security_group_id')
+    if not group_id:
+        group_id = config['launch_specification']['SecurityGroupIds'][0]
+
+    return ([{'Name': 'launch.group-id', 'Values': [group_id]}],
+            [{'Name': 'instance.group-id', 'Values': [group_id]}])
+
+def on_leader_change(cluster,mesos_master):
+    # Called from the ZooKeeper watch. The next loop starts right away, so
+    # the new leader's view is acted on without waiting for the interval.
+    message = 'Mesos leader of cluster %s is now %s' % (cluster['config']['name'], mesos_master)
+    print_verbose(message)
+    basics.write_to_syslog('info', message)
+    if 'wakeup' in cluster:
+        cluster['wakeup'].set()
+
+def setup_cluster(config,ec2clients,price_stores,journals):
+    cluster = {'config': config}
+    cluster['ec2client'] = get_ec2client(ec2clients, config)
+    cluster['journal'] = get_journal(journals, config)
+    if cluster['journal'] is not None:
+        cluster['ec2client'] = journal.JournaledClient(cluster['ec2client'], cluster['journal'], config['name'])
+    cluster['price_store'] = get_price_store(price_stores, config)
+    cluster['request_filters'], cluster['instance_filters'] = get_inventory_filters(config)
+
+    # Follow the Mesos leader election in ZooKeeper, unless the master is fixed
+    try:
+        if config.get('mesos_master'):
+            leader_detector = leader.StaticLeader(config['mesos_master'])
+        else:
+            leader_detector = leader.MesosLeaderDetector(config['mesos_zkurl'],
+                                                         config.get('mesos_zk_timeout', 10))
+        leader_detector.start()
+    except Exception as e:
+        print_verbose(e)
+        basics.handle_error('Could not connect to ZooKeeper at %s' % config['mesos_zkurl'])
+    cluster['leader_detector'] = leader_detector
+    leader_detector.add_listener(lambda leader: on_leader_change(cluster, leader))
+
+    # Recent readings, one file per cluster when they are kept across restarts
+    history_path = config.get('history_path')
+    if history_path and config.get('multi_cluster'):
+        history_path = '%s.%s' % (history_path, config['name'])
+    try:
+        cluster['history'] = history.RingBuffer(config.get('history_size', 512), path=history_path)
+    except (IOError, OSError, mmap.error) as e:
+        print_verbose(e)
+        basics.handle_error('Could not open the history file %s' % history_path)
+    cluster['windows'] = dict()
+
+    # Usage forecast for predictive scaling
+    if config.get('predictive_scaling', False):
+        cluster['forecaster'] = forecast.HoltForecaster(config.get('forecast_alpha', 0.5),
+                                                        config.get('forecast_beta', 0.2))
+        cluster['lead_tracker'] = forecast.LeadTimeTracker(config.get('initial_lead_time', 300), time.time())
+
+    # Re-evaluate as soon as Marathon reports new deployments or task changes
+    cluster['wakeup'] = threading.Event()
+    if config.get('event_driven', False):
+        listener = events.MarathonEventListener(lambda: '%s:%i' % (leader_detector.get().rsplit(':', 1)[0],
+                                                                   config['marathon_port']),
+                                                cluster['wakeup'])
+        listener.start()
+
+    # Spot requests and instances, kept between loops
+    cluster['inventory'] = inventory.Inventory()
+
+    # Zones whose spot requests stay open, when spread over several
+    zone_list = zones.get_zones(config)
+    if len(zone_list) > 1:
+        cluster['zone_tracker'] = zones.ZoneTracker(zone_list, config.get('zone_cooloff', 1800))
+
+    # Agents being drained before termination or interruption
+    if config.get('drain_agents', False) or config.get('interruption_notices', False):
+        cluster['drainer'] = drain.Drainer(http)
+    cluster['noticed'] = set()
+
+    if cluster['journal'] is not None:
+        recover_cluster(cluster)
+
+    return cluster
+
+def expected_request(placed):
+    # A spot request as the listings show it, from its journal entry
+    return {u'SpotInstanceRequestId': placed['id'],
+            u'State': 'open',
+            u'SpotPrice': placed['spot_price'],
+            u'CreateTime': pricestore.from_epoch(placed['created']),
+            u'LaunchSpecification': {u'InstanceType': placed['instance_type'],
+                                     u'Placement': {u'AvailabilityZone': placed.get('zone')}}}
+
+def recover_cluster(cluster):
+    # Carry on from where the previous run of the daemon stopped
+    config = cluster['config']
+    now = time.time()
+    grace = config.get('journal_grace', 120)
+    recovered = cluster['journal'].recover(config['name'], grace, now)
+
+    # Calls cut short may or may not have reached EC2, so make them again.
+    # Older ones show in the listings by now, and the loop decides afresh.
+    placed = recovered['requests']
+    for intent in recovered['unfinished']:
+        response = None
+        if intent['time'] > now - grace:
+            print_verbose('Repeating the unfinished %s' % intent['call'])
+            response = journal.reissue(cluster['ec2client'], intent, config['launch_specification'])
+        if response is not None and intent['call'] == 'request_spot_instances':
+            placed = placed + journal.describe_result(intent['call'], response)['requests']
+        cluster['journal'].done(config['name'], intent['seq'], {'repeated': response is not None})
+
+    if placed:
+        print_verbose('Counting %i spot requests from before the restart as pending' % len(placed))
+        cluster['inventory'].expect([expected_request(p) for p in placed], now + grace)
+
+    state = recovered['state'] or dict()
+    # A forecast left for long has a trend that no longer holds
+    if ('forecaster' in cluster and state.get('forecast') and
+        state['forecast']['last_update'] > now - 10 * float(config['execution_interval'])):
+        cluster['forecaster'].restore(state['forecast'])
+    if 'lead_tracker' in cluster and state.get('lead_time'):
+        cluster['lead_tracker'].restore(state['lead_time'])
+    # Drains no longer picked are put back in service by the first publish
+    if cluster.get('drainer') is not None and state.get('drain'):
+        cluster['drainer'].restore(state['drain'])
+
+    cluster['journal'].commit()
+
+def forecast_state(cluster):
+    # Taken by the decider, which is the only stage that updates the forecast
+    state = dict()
+    if 'forecaster' in cluster and cluster['forecaster'].level is not None:
+        state['forecast'] = cluster['forecaster'].state()
+        state['lead_time'] = cluster['lead_tracker'].state()
+
+    return state
+
+def journal_tick(cluster,snapshot,decision,state=None):
+    # The loop's readings, decision and the state a restart carries on from.
+    # The drains belong to the actuator, which this runs in.
+    if cluster.get('journal') is None:
+        return
+
+    state = dict(state or {})
+    if cluster.get('drainer') is not None:
+        state['drain'] = cluster['drainer'].state()
+
+    readings = {'resources_in_use': snapshot['resources_in_use'],
+                'percent_in_use': snapshot['current_percent_in_use'],
+                'active': len(snapshot['cur_slaves']),
+                'pending': len(snapshot['cur_open_spot_requests']),
+                'bid': snapshot['bid']}
+
+    try:
+        cluster['journal'].tick(cluster['config']['name'], readings, decision, state)
+        cluster['journal'].commit()
+    except (IOError, OSError) as e:
+        print_verbose(e)
+        basics.write_to_syslog('error', 'Could not write the journal: %s' % e)
+
+def publish_drains(drainer,snapshot,config):
+    # Agents no longer picked for termination are put back in service
+    if drainer is not None:
+        drainer.publish(snapshot['mesos_master'], config.get('mesos_fetch_timeout', 10))
+
+def run_cluster_loop(cluster,executor,config_source,offset=0):
+    # Sampling runs here on its fixed cadence. Deciding and acting run in
+    # their own threads, so a slow actuation never holds back the next sample.
+    cluster['snapshots'] = pipeline.LatestQueue()
+    cluster['decisions'] = pipeline.LatestQueue()
+    cluster['acted'] = 0
+    name = cluster['config']['name']
+    pipeline.start_stage('decide-%s' % name, run_stage, cluster, 'decide', decide_next)
+    pipeline.start_stage('act-%s' % name, run_stage, cluster, 'act', act_next)
+
+    # Start late by offset seconds, so the clusters' API calls are spread over the interval
+    time.sleep(offset)
+
+    failures = 0
     while True:
         start_time = time.time()
-        print ''
-
-        #################################
-        ### Collect hybrid cloud metrics
-        #################################
-
-        ## Fetch current Mesos master
-        mesos_master = fetch_current_mesos_master(config['mesos_zkurl'])
-
-        ## Create a Marathon url
-        marathon_url = '%s:%i' % (mesos_master[:-5], config['marathon_port'])
-        print_verbose('   Current Mesos master %s' % mesos_master[:-5])
-
-        ## Collect Mesos metrics
-        mesos_data = fetch_and_parse_json('http://%s/metrics/snapshot' % mesos_master)
-
-        ## Collect the usage values of the resources
-        resources_in_use = {'cpus': float(mesos_data[u'master/cpus_used']),
-                            'mem': float(mesos_data[u'master/mem_used']),
-                            'disk': float(mesos_data[u'master/disk_used'])}
-        current_percent_in_use = {'cpus': float(mesos_data[u'master/cpus_percent']),
-                                  'mem': float(mesos_data[u'master/mem_percent']),
-                                  'disk': float(mesos_data[u'master/disk_percent'])}
-
-        ### Collect EC2 metrics
-        cur_slaves,cur_slaves_raw = get_current_spot_slaves(ec2resource)
-        cur_spot_requests = get_current_spot_requests(ec2client,'all')
-        cur_open_spot_requests = get_current_spot_requests(ec2client,[u'open'])
-        num_active_pending_slaves = len(cur_slaves) + len(cur_open_spot_requests)
-
-        #################################
-        ### Calculate the bidding price
-        #################################
-
-        # Fetch the current price
-        bid = fetch_current_price(ec2client,
-                                  config['availability_zone'],
-                                  config['instance_type'],
-                                  config['maximum_bid_limit']
-                                  )
-
-        ########################################################
-        ### Make a descision of whether or not to cloud burst
-        ########################################################
+        try:
+            # Pick up a changed configuration between loops, never during one
+            if config_source.refresh():
+                print_verbose('Reloaded the configuration')
+                cluster['history'].flush()
+            cluster['config'] = config_source.cluster(name)
+
+            sample_cluster(cluster, executor)
+            failures = 0
+        except (Exception, SystemExit) as e:
+            # Only this cluster waits, longer after each failure in a row
+            failures += 1
+            backoff = min(cluster['config']['execution_interval'] * 2 ** failures, MAX_BACKOFF)
+            print_verbose(e)
+            basics.write_to_syslog('error', 'The loop of cluster %s failed: %s. Trying again in %i seconds.' % (name, e, backoff))
+            sleep(start_time, backoff)
+            continue
+
+        ### Sleep and repeat
+        sleep_until_next_loop(start_time, cluster['config'], cluster['wakeup'])
+
+def run_stage(cluster,name,stage):
+    # A failure drops the snapshot or decision at hand and is logged right
+    # away. The stage goes on with the next one.
+    while True:
+        try:
+            stage(cluster)
+        except (Exception, SystemExit) as e:
+            print_verbose(e)
+            basics.write_to_syslog('error', 'The %s stage of cluster %s failed: %s' % (name, cluster['config']['name'], e))
+
+def collector_workers(config):
+    # Twice the sources of a loop, so a loop still has a worker for every
+    # source while those of the last loop hang up to their timeout
+    sources = 3 + (1 if config.get('warm_pool_size') else 0)
+    if len(zones.get_zones(config)) > 1:
+        sources += 1
+    else:
+        sources += 1 + len(config.get('instance_catalog') or [])
+    if config.get('interruption_notices', False) and config.get('interruption_notice_url'):
+        sources += 1
+
+    return config.get('collector_workers') or 2 * sources
+
+def sample_cluster(cluster,executor):
+    config = cluster['config']
+    print ''
+    if config.get('multi_cluster'):
+        print_verbose('   Cluster %s' % config['name'])
+
+    #################################
+    ### Collect hybrid cloud metrics
+    #################################
+
+    sampled = time.time()
+    snapshot = collect_metrics(executor,
+                               cluster['ec2client'],
+                               cluster['leader_detector'],
+                               cluster['inventory'],
+                               config,
+                               cluster['price_store'],
+                               cluster['request_filters'],
+                               cluster['instance_filters'])
+    if snapshot is None:
+        print_verbose('Incomplete metrics this loop. Skipping the scaling decision.')
+        return
+
+    snapshot['sampled'] = sampled
+
+    # New requests pass over zones where earlier ones are stuck. Observed
+    # here, as the decide stage may skip snapshots and with them their
+    # inventory changes.
+    if cluster.get('zone_tracker') is not None:
+        snapshot['avoided_zones'] = cluster['zone_tracker'].observe(snapshot['cur_spot_requests'],
+                                                                    snapshot['inventory_changes'],
+                                                                    config['spot_request_timeout'],
+                                                                    sampled)
+        for zone in snapshot['avoided_zones']:
+            print_verbose('   Passing over %s, where spot requests stay open' % zone)
+
+    if cluster['snapshots'].put((snapshot, config)):
+        metrics.SUPERSEDED.inc(1, (config['name'], 'snapshot'))
+
+def decide_next(cluster):
+    # Always decides on the newest snapshot; older ones waiting are dropped
+    snapshot, config = cluster['snapshots'].get()
+    decision = decide_cluster(cluster, snapshot, config)
+    if cluster['decisions'].put(decision):
+        metrics.SUPERSEDED.inc(1, (config['name'], 'decision'))
+
+def act_next(cluster):
+    # A decision sampled before the last actuation ended does not know what it
+    # did, so it is dropped and the next sample decides again. Scaling
+    # decisions carry the desired number of instances rather than a change.
+    decision = cluster['decisions'].get()
+    config = decision['config']
+    if decision['snapshot']['sampled'] < cluster['acted']:
+        metrics.SUPERSEDED.inc(1, (config['name'], 'stale'))
+        print_verbose('Dropping a decision sampled before the last actuation ended')
+        return
+
+    try:
+        act_cluster(cluster, decision)
+    finally:
+        cluster['acted'] = time.time()
+
+def decide_cluster(cluster,snapshot,config):
+    resources_in_use = snapshot['resources_in_use']
+    current_percent_in_use = snapshot['current_percent_in_use']
+    cur_slaves = snapshot['cur_slaves']
+    cur_open_spot_requests = snapshot['cur_open_spot_requests']
+    interrupted = snapshot.get('interrupted') or {}
+    decision = {'snapshot': snapshot, 'config': config}
+
+    for instance_id in interrupted:
+        if instance_id not in cluster['noticed']:
+            message = ('Spot instance %s in cluster %s is interrupted in %i seconds. Replacing it.' %
+                       (instance_id, config['name'], max(0, interrupted[instance_id] - time.time())))
+            print_verbose(message)
+            basics.write_to_syslog('info', message)
+    cluster['noticed'] = set(interrupted)
+
+    for resource in resources_in_use:
+        metrics.RESOURCES_USED.set(resources_in_use[resource], (config['name'], resource))
+        metrics.RESOURCES_PERCENT.set(current_percent_in_use[resource], (config['name'], resource))
+    metrics.INSTANCES.set(len(cur_slaves), (config['name'], 'active'))
+    metrics.INSTANCES.set(len(cur_open_spot_requests), (config['name'], 'pending'))
+    metrics.INSTANCES.set(len(interrupted), (config['name'], 'interrupted'))
+    metrics.BID_PRICE.set(snapshot['bid'], (config['name'], config['instance_type']))
+    for instance_type in snapshot['bids']:
+        metrics.BID_PRICE.set(snapshot['bids'][instance_type], (config['name'], instance_type))
+
+    ## Plan for an aggregate of the recent readings rather than the last one
+    record_history(cluster['history'], snapshot, snapshot['sampled'])
+    if config.get('decision_window') and not config.get('predictive_scaling', False):
+        resources_in_use = get_window_resources(cluster['history'],
+                                                cluster['windows'],
+                                                config['decision_window'],
+                                                config.get('decision_statistic', 'p90'))
+
+    if config.get('predictive_scaling', False):
+        with metrics.PHASE_SECONDS.time((config['name'], 'forecast')):
+            resources_in_use = get_forecast_resources(cluster['forecaster'], cluster['lead_tracker'], snapshot, snapshot['sampled'])
+    decision['state'] = forecast_state(cluster)
+
+    ## Plan a mix of instance types when a catalog is configured
+    if config.get('instance_catalog'):
+        with metrics.PHASE_SECONDS.time((config['name'], 'decision')):
+            decision['plan'] = get_fleet_decision(resources_in_use, snapshot, config)
+        change = sum(decision['plan']['request'].values()) - len(decision['plan']['remove'])
+        metrics.DECISION.set(change, (config['name'],))
+        metrics.INSTANCES.set(len(cur_slaves) + len(cur_open_spot_requests) + change, (config['name'], 'desired'))
+        return decision
+
+    ########################################################
+    ### Make a descision of whether or not to cloud burst
+    ########################################################
+    with metrics.PHASE_SECONDS.time((config['name'], 'decision')):
         slaves_to_adjust = get_scaling_decision(resources_in_use,
                                                 current_percent_in_use,
-                                                len(cur_slaves),
+                                                len(cur_slaves) - len(interrupted),
                                                 len(cur_open_spot_requests),
                                                 config)
 
-        desired_slaves = len(cur_open_spot_requests) + len(cur_slaves) + slaves_to_adjust
-
-        print_verbose('   |----------------------------')
-        print_verbose('   | Number of:         | Count ')
-        print_verbose('   |----------------------------')
-        print_verbose('   | Desired instances  |   %i  ' % desired_slaves)
-        print_verbose('   | Pending requests   |   %i  ' % len(cur_open_spot_requests))
-        print_verbose('   | Active instances   |   %i  ' % len(cur_slaves))
-        print_verbose('   |----------------------------')
-
-        ############################
-        ### Execute the descision
-        ############################
-
-        # Remove spot requests that exceeded the timeout and that does bid at max limit
-        purge_old_spot_requests(ec2client,
-                                cur_spot_requests,
-                                config['spot_request_timeout'],
-                                config['maximum_bid_limit'])
-
-        ## The number of pending and active instances are ok
-        if desired_slaves == num_active_pending_slaves:
-            print_verbose('The number of pending and active slaves are ok')
-            try:
-                sleep(start_time,config['execution_interval'])
-            except KeyError as e:
-                basics.handle_error('%s has not been set in the config.' % e)
-
-            continue
-
-        ## Request new spot instances
-        if desired_slaves > num_active_pending_slaves:
-            print_verbose('Not enough pending or active slave nodes. Requesting new ones')
-            request_spot_instances(ec2client,
-                                   desired_slaves-num_active_pending_slaves,
-                                   config['instance_typed'],
-                                   bid)
-
-        ## Terminate excessive pending spot requests
-        if (num_active_pending_slaves > desired_slaves
-            and not len(cur_open_spot_requests) == 0):
-            excessive_slaves = num_active_pending_slaves - desired_slaves
-
-            if excessive_slaves < len(cur_open_spot_requests):
-                print_verbose('Excessive spot requests. Attempting to cancel %i' % excessive_slaves)
-                cancel_spot_requests(ec2client,cur_open_spot_requests,excessive_slaves)
-                num_active_pending_slaves = num_active_pending_slaves - excessive_slaves
-            else:
-                print_verbose('Excessive spot requests. Attempting to cancel %i' % len(cur_open_spot_requests))
-                cancel_spot_requests(ec2client,cur_open_spot_requests,len(cur_open_spot_requests))
-                num_active_pending_slaves = num_active_pending_slaves - len(cur_open_spot_requests)
+    desired_slaves = len(cur_open_spot_requests) + len(cur_slaves) + slaves_to_adjust
+    metrics.DECISION.set(slaves_to_adjust, (config['name'],))
+    metrics.INSTANCES.set(desired_slaves, (config['name'], 'desired'))
+
+    print_verbose('   |----------------------------')
+    print_verbose('   | Number of:         | Count ')
+    print_verbose('   |----------------------------')
+    print_verbose('   | Desired instances  |   %i  ' % desired_slaves)
+    print_verbose('   | Pending requests   |   %i  ' % len(cur_open_spot_requests))
+    print_verbose('   | Active instances   |   %i  ' % len(cur_slaves))
+    if interrupted:
+        print_verbose('   | Interrupted        |   %i  ' % len(interrupted))
+    print_verbose('   |----------------------------')
+
+    decision['adjust'] = slaves_to_adjust
+    decision['desired_slaves'] = desired_slaves
+    return decision
+
+def act_cluster(cluster,decision):
+    snapshot = decision['snapshot']
+    config = decision['config']
+    drainer = cluster.get('drainer')
+    if drainer is not None:
+        drainer.begin()
+        drain_interrupted(drainer, snapshot, time.time())
+
+    # Scale-down drains its victims only with drain_agents set
+    scale_drainer = drainer if config.get('drain_agents', False) else None
+
+    ############################
+    ### Execute the descision
+    ############################
+    with metrics.PHASE_SECONDS.time((config['name'], 'actuation')):
+        if 'plan' in decision:
+            execute_fleet_decision(cluster['ec2client'], snapshot, decision['plan'], config, None, scale_drainer)
+        else:
+            execute_scaling_decision(cluster['ec2client'], snapshot, decision['desired_slaves'], config, None, scale_drainer)
+        fill_warm_pool(cluster['ec2client'], snapshot, config)
+        publish_drains(drainer, snapshot, config)
 
-        ## Terminate excessive spot instances
-        if (num_active_pending_slaves > desired_slaves):
-            excessive_slaves = num_active_pending_slaves - desired_slaves
-            print_verbose('Excessive spot instances. Attempting to terminate %i' % excessive_slaves)
+    journal_tick(cluster, snapshot, decision.get('plan', decision.get('adjust')), decision.get('state'))
 
-            terminate_spot_instances(ec2client,cur_slaves,cur_slaves_raw,excessive_slaves,config['partial_hour_limit'])
+def main():
+    # Get paramaters and process them
+    opts, args = get_params()
+    set_options(opts)
 
+    # Import the configuration and set some session settings
+    config_source = import_config(watch=True)
+    config = config_source.clusters()[0]
 
-        ### Sleep and repeat
+    # Serve the loop metrics for scraping
+    if config.get('metrics_port'):
         try:
-            sleep(start_time,config['execution_interval'])
-        except KeyError as e:
-            basics.handle_error('%s has not been set in the config.' % e)
+            metrics.start_http_server(config['metrics_port'], config.get('metrics_address', '127.0.0.1'))
+        except Exception as e:
+            print_verbose(e)
+            basics.handle_error('Could not start the metrics endpoint on port %s' % config['metrics_port'])
+
+    ec2clients = dict()
+    price_stores = dict()
+    journals = dict()
+    clusters = [setup_cluster(c, ec2clients, price_stores, journals) for c in config_source.clusters()]
+
+    # Worker pool for the concurrent metric collection of each cluster, so a
+    # cluster whose sources hang never holds up the collection of another
+    executors = [futures.ThreadPoolExecutor(max_workers=collector_workers(c['config'])) for c in clusters]
+
+    # Main execution: one loop thread per cluster, staggered over the
+    # interval. A failing cluster backs off in its own loop.
+    for i, cluster in enumerate(clusters):
+        offset = i * float(cluster['config']['execution_interval']) / len(clusters)
+        thread = threading.Thread(target=run_cluster_loop, args=(cluster, executors[i], config_source, offset))
+        thread.daemon = True
+        thread.start()
+
+    # Stay in the main thread so SIGINT still reaches the handler. Its exit
+    # writes the history out, so a restart picks up where this run stopped.
+    try:
+        while True:
+            time.sleep(1)
+    finally:
+        for cluster in clusters:
+            cluster['history'].flush()
 
 if __name__ == '__main__':
     original_sigint = signal.getsignal(signal.SIGINT)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+import basics
+
+# Draining spot agents before they are terminated. The agents picked for
+# termination are put in a Mesos maintenance window, so frameworks that honour
+# maintenance (Marathon with the maintenance_mode feature) stop placing tasks
+# there and move what runs there. They are terminated once they run nothing or
+# their drain deadline has passed.
+
+RESOURCES = ['cpus', 'mem', 'disk']
+
+class Agent(object):
+    """A Mesos agent from /master/slaves with what is allocated on it."""
+
+    def __init__(self, data):
+        self.agent_id = data[u'id']
+        self.hostname = data[u'hostname']
+        # pid looks like slave(1)@10.0.0.5:5051
+        self.ip = data[u'pid'].split('@', 1)[1].rsplit(':', 1)[0]
+        self.active = data.get(u'active', True)
+        total = data.get(u'resources', {})
+        used = data.get(u'used_resources', {})
+        self.total = dict((r, float(total.get(r, 0) or 0)) for r in RESOURCES)
+        self.used = dict((r, float(used.get(r, 0) or 0)) for r in RESOURCES)
+
+    def allocated_share(self):
+        # The largest share of any resource in use, 0 for an idle agent
+        return max([self.used[r] / self.total[r] for r in RESOURCES if self.total[r] > 0] or [0.0])
+
+    def is_empty(self):
+        return all(self.used[r] == 0 for r in RESOURCES)
+
+def agents_by_ip(mesos_slaves):
+    # Takes the agents one at a time, e.g. as they are decoded from a stream
+    return dict((agent.ip, agent) for agent in (Agent(slave) for slave in mesos_slaves))
+
+def machine_id(agent):
+    return {'hostname': agent.hostname, 'ip': agent.ip}
+
+class Drainer(object):
+    """The spot instances being drained, kept between loops.
+
+    Each loop starts with begin(). Instances picked for termination during the
+    loop are passed to select(), which returns those that can be terminated
+    now. publish() then releases the instances that were not picked again and
+    brings the Mesos maintenance schedule up to date.
+    """
+
+    def __init__(self, http):
+        self.http = http
+        self.draining = dict()
+        self.selected = set()
+        self.published = set()
+
+    def begin(self):
+        self.selected = set()
+
+    def select(self, instances, agents, timeout, now):
+        ready = []
+        for instance in instances:
+            self.selected.add(instance.instance_id)
+            agent = agents.get(instance.private_ip_address) if agents is not None else None
+
+            if instance.instance_id not in self.draining:
+                self.draining[instance.instance_id] = {'ip': instance.private_ip_address,
+                                                       'machine': machine_id(agent) if agent else None,
+                                                       'start': now,
+                                                       'deadline': now + timeout}
+            drain = self.draining[instance.instance_id]
+            if drain['machine'] is None and agent is not None:
+                drain['machine'] = machine_id(agent)
+
+            # Without the agent listing this loop, only the deadline is known
+            if now >= drain['deadline']:
+                ready.append(instance)
+            elif agents is not None and (agent is None or agent.is_empty()):
+                ready.append(instance)
+
+        return ready
+
+    def is_draining(self, instance_id):
+        return instance_id in self.draining
+
+    def state(self):
+        return {'draining': dict((i, dict(d)) for i, d in self.draining.items()), 'published': sorted(self.published)}
+
+    def restore(self, state):
+        self.draining = state['draining']
+        self.published = set(state['published'])
+
+    def schedule(self, current):
+        # Keep the windows of other machines and replace ours
+        ours = self.published | set(d['ip'] for d in self.draining.values())
+        windows = []
+        for window in current.get(u'windows', []):
+            machines = [m for m in window[u'machine_ids'] if m.get(u'ip') not in ours]
+            if machines:
+                windows.append(dict(window, machine_ids=machines))
+
+        for drain in self.draining.values():
+            if drain['machine'] is None:
+                continue
+            windows.append({'machine_ids': [drain['machine']],
+                            'unavailability': {'start': {'nanoseconds': int(drain['start'] * 1e9)},
+                                               'duration': {'nanoseconds': int((drain['deadline'] - drain['start']) * 1e9)}}})
+
+        return {'windows': windows}
+
+    def publish(self, mesos_master, timeout):
+        for instance_id in self.draining.keys():
+            if instance_id not in self.selected:
+                del self.draining[instance_id]
+
+        machines = set(d['ip'] for d in self.draining.values() if d['machine'] is not None)
+        if machines == self.published:
+            return
+
+        url = 'http://%s/maintenance/schedule' % mesos_master
+        try:
+            self.http.post_json(url, self.schedule(self.http.get_json(url, timeout)), timeout)
+            self.published = machines
+        except Exception as e:
+            # Published again next loop, as the schedule still differs
+            basics.write_to_syslog('error', 'Could not update the Mesos maintenance schedule: %s' % e)
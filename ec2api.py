@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+import basics
+import random
+import threading
+import time
+from botocore.exceptions import ClientError
+
+# Error codes EC2 uses when the account's request rate is exceeded
+THROTTLING_ERRORS = ['RequestLimitExceeded', 'Throttling', 'ThrottlingException']
+
+# Ids per terminate/cancel call
+BATCH_SIZE = 500
+
+class TokenBucket(object):
+    """Allows rate calls per second on average and bursts of up to capacity.
+
+    The rate is halved when EC2 throttles a call, at most once a second as
+    the calls in flight are throttled together, and grows back to the
+    configured rate with every call that goes through.
+    """
+
+    def __init__(self, rate, capacity, min_rate=0.1, recovery=0.05):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.min_rate = min(float(min_rate), self.max_rate)
+        self.recovery = recovery
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.time()
+        self.slowed = 0
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                self.refill(time.time())
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            now = time.time()
+            self.refill(now)
+            # No saved up burst either, every caller waits for the lower rate
+            self.tokens = min(self.tokens, 0.0)
+            if now - self.slowed >= 1:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.slowed = now
+
+    def succeeded(self):
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.refill(time.time())
+                self.rate = min(self.max_rate, self.rate + self.max_rate * self.recovery)
+
+def is_throttled(e):
+    return isinstance(e, ClientError) and e.response.get('Error', {}).get('Code') in THROTTLING_ERRORS
+
+class ThrottledClient(object):
+    """Wraps an EC2 client so every API call shares one token bucket.
+
+    Throttled calls slow down the bucket and are retried with exponential
+    backoff and full jitter. Other errors, and throttling that outlasts the
+    retries, are raised.
+    """
+
+    def __init__(self, client, bucket, retries=5, backoff=0.5, max_backoff=20):
+        self.client = client
+        self.bucket = bucket
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if not callable(attribute) or name.startswith('get_') or name in ['can_paginate']:
+            return attribute
+
+        def call(*args, **kwargs):
+            attempt = 0
+            while True:
+                self.bucket.acquire()
+                try:
+                    result = attribute(*args, **kwargs)
+                except Exception as e:
+                    if not is_throttled(e):
+                        raise
+
+                    self.bucket.throttled()
+                    if attempt >= self.retries:
+                        raise
+
+                    delay = random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+                    basics.write_to_syslog('info', '%s throttled, retrying in %.1f seconds' % (name, delay))
+                    time.sleep(delay)
+                    attempt += 1
+                else:
+                    self.bucket.succeeded()
+                    return result
+
+        return call
+
+def batches(ids, size=BATCH_SIZE):
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+import basics
+import json
+import threading
+import time
+import urllib2
+
+# Marathon events that change the demand on the cluster
+TRIGGER_EVENTS = ['api_post_event',
+                  'deployment_info',
+                  'deployment_success',
+                  'deployment_failed',
+                  'deployment_step_success',
+                  'deployment_step_failure',
+                  'group_change_success',
+                  'status_update_event']
+
+class MarathonEventListener(threading.Thread):
+    """Follows Marathon's /v2/events stream and sets wakeup on demand changes.
+
+    get_url is called on every (re)connect, so the stream follows the current
+    leader. The connection is retried with a growing delay when it drops.
+    """
+
+    def __init__(self, get_url, wakeup, read_timeout=300, max_retry_delay=60):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.get_url = get_url
+        self.wakeup = wakeup
+        self.read_timeout = read_timeout
+        self.max_retry_delay = max_retry_delay
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        retry_delay = 1
+        while self.running:
+            try:
+                url = 'http://%s/v2/events' % self.get_url()
+                request = urllib2.Request(url, headers={'Accept': 'text/event-stream'})
+                stream = urllib2.urlopen(request, timeout=self.read_timeout)
+                retry_delay = 1
+                self.follow(stream)
+            except Exception as e:
+                basics.write_to_syslog('info', 'Marathon event stream dropped: %s' % e)
+
+            time.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, self.max_retry_delay)
+
+    def follow(self, stream):
+        event_type = None
+        while self.running:
+            line = stream.readline()
+            if not line:
+                return
+
+            line = line.rstrip('\r\n')
+            if line.startswith('event:'):
+                event_type = line[len('event:'):].strip()
+            elif line.startswith('data:') and event_type is None:
+                # Streams without event lines carry the type in the payload
+                try:
+                    event_type = json.loads(line[len('data:'):]).get('eventType')
+                except ValueError:
+                    pass
+            elif line == '':
+                # A blank line ends the event
+                if event_type in TRIGGER_EVENTS:
+                    self.wakeup.set()
+                event_type = None
@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+import simulate
+import pricestore
+import basics
+import BaseHTTPServer
+import SocketServer
+import botocore.session
+import datetime
+import dateutil.parser
+import dateutil.tz
+import getopt
+import json
+import random
+import sys
+import threading
+import time
+import urlparse
+import yaml
+from xml.sax.saxutils import escape
+
+# Local stand-ins for the EC2 API and the Mesos master, served over HTTP so
+# burst.py can run unmodified against them (ec2_endpoint_url and mesos_master
+# in its config). EC2 is the simulator's FakeEC2 on the wall clock, and Mesos
+# reports its running instances as agents. Latency and throttling can be
+# injected into the EC2 calls.
+
+EC2_ACTIONS = {'DescribeSpotInstanceRequests': 'describe_spot_instance_requests',
+               'DescribeInstances': 'describe_instances',
+               'DescribeSpotPriceHistory': 'describe_spot_price_history',
+               'RequestSpotInstances': 'request_spot_instances',
+               'CancelSpotInstanceRequests': 'cancel_spot_instance_requests',
+               'TerminateInstances': 'terminate_instances',
+               'RunInstances': 'run_instances',
+               'StartInstances': 'start_instances',
+               'StopInstances': 'stop_instances',
+               'CreateTags': 'create_tags'}
+
+RESOURCES = ['cpus', 'mem', 'disk']
+
+def print_usage():
+    print "Local EC2 and Mesos endpoints for load testing burst.py\n"
+    print "usage: " + __file__ + " [arguments]\n"
+    print "Arguments:"
+    print "   --help\t\t\t Prints this help message"
+    print "   -c [--config]\t\t burst.py config the fake cluster is sized from (default config.yml)"
+    print "   -p [--port]\t\t\t Port to listen on (default 8080)"
+    print "   -n [--fleet-size]\t\t Spot instances running at start (default 100)"
+    print "   -l [--latency]\t\t Seconds added to every EC2 call (default 0)"
+    print "   -t [--throttle]\t\t Share of EC2 calls answered with RequestLimitExceeded (default 0)"
+    print "   -s [--swing]\t\t\t Instances of demand that come and go every 5 minutes (default 0)"
+
+class WallClock(object):
+    @property
+    def now(self):
+        return time.time()
+
+    def datetime(self):
+        return datetime.datetime.fromtimestamp(time.time(), dateutil.tz.tzutc())
+
+## The EC2 query protocol, driven by the botocore service model
+
+def member_name(name, member):
+    # What a member is called in the request parameters
+    if 'queryName' in member.serialization:
+        return member.serialization['queryName']
+    if 'name' in member.serialization:
+        return member.serialization['name'][0].upper() + member.serialization['name'][1:]
+
+    return name
+
+def parse_query(shape, params, prefix=''):
+    if shape.type_name == 'structure':
+        value = dict()
+        for name, member in shape.members.items():
+            parsed = parse_query(member, params, (prefix + '.' if prefix else '') + member_name(name, member))
+            if parsed is not None:
+                value[name] = parsed
+        return value or None
+
+    if shape.type_name == 'list':
+        items = []
+        while True:
+            item = parse_query(shape.member, params, '%s.%i' % (prefix, len(items) + 1))
+            if item is None:
+                return items or None
+            items.append(item)
+
+    if prefix not in params:
+        return None
+
+    value = params[prefix]
+    if shape.type_name in ['integer', 'long']:
+        return int(value)
+    if shape.type_name == 'timestamp':
+        return dateutil.parser.parse(value)
+
+    return value
+
+def to_xml(shape, value):
+    if shape.type_name == 'structure':
+        elements = []
+        for name, member in shape.members.items():
+            if name in value and value[name] is not None:
+                tag = member.serialization.get('name', name[0].lower() + name[1:])
+                elements.append('<%s>%s</%s>' % (tag, to_xml(member, value[name]), tag))
+        return ''.join(elements)
+
+    if shape.type_name == 'list':
+        return ''.join('<item>%s</item>' % to_xml(shape.member, item) for item in value)
+
+    if shape.type_name == 'timestamp':
+        return value.astimezone(dateutil.tz.tzutc()).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+    if shape.type_name == 'boolean':
+        return 'true' if value else 'false'
+
+    return escape(str(value))
+
+def error_xml(code, message):
+    return ('<?xml version="1.0" encoding="UTF-8"?><Response><Errors><Error><Code>%s</Code>'
+            '<Message>%s</Message></Error></Errors><RequestID>fake</RequestID></Response>' % (code, escape(message)))
+
+class FakeCloud(object):
+    """The state behind the endpoints.
+
+    Starts with fleet_size running spot instances. Mesos reports a demand of
+    fleet_size instances, less swing every other five minutes, so the loop has
+    something to request and cancel. zone_prices gives zones their own price
+    traces, as in simulate.FakeEC2.
+    """
+
+    def __init__(self, config, fleet_size=100, latency=0.0, throttle=0.0, swing=0, price=0.02, fulfil_delay=60, boot_delay=120, zone_prices=None):
+        self.config = config
+        self.fleet_size = fleet_size
+        self.latency = latency
+        self.throttle = throttle
+        self.swing = swing
+        self.lock = threading.Lock()
+        self.random = random.Random(fleet_size)
+        self.clock = WallClock()
+        self.ec2 = simulate.FakeEC2(self.clock, [(self.clock.now - 24*3600, price)], fulfil_delay, boot_delay, zone_prices)
+        self.model = botocore.session.get_session().get_service_model('ec2')
+        self.throttled = 0
+        self.schedule = {'windows': []}
+        self.preload(price * 2)
+
+    def preload(self, bid):
+        now = self.clock.now
+        for i in range(self.fleet_size):
+            # Launched over the last hour, so the billing boundaries are spread out
+            launched_at = now - self.random.uniform(60, 3600)
+            request_id = self.ec2.new_id('sir')
+            instance = simulate.FakeInstance(self.ec2.new_id('i'),
+                                             self.config['instance_type'],
+                                             request_id,
+                                             pricestore.from_epoch(launched_at),
+                                             launched_at,
+                                             launched_at,
+                                             bid)
+            instance.state = {'Name': 'running'}
+            instance.billed_hours = 1
+            self.ec2.instances[instance.instance_id] = instance
+            self.ec2.requests.append({'SpotInstanceRequestId': request_id,
+                                      'SpotPrice': '%.6f' % bid,
+                                      'State': 'active',
+                                      'InstanceId': instance.instance_id,
+                                      'CreateTime': pricestore.from_epoch(launched_at),
+                                      'CreateEpoch': launched_at,
+                                      'LaunchSpecification': {'InstanceType': self.config['instance_type']}})
+
+    def call_counts(self):
+        with self.lock:
+            return dict(self.ec2.calls)
+
+    ## EC2
+
+    def ec2_call(self, params):
+        action = params.get('Action')
+        if action not in EC2_ACTIONS:
+            return 400, error_xml('InvalidAction', 'The action %s is not valid for this web service.' % action)
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self.lock:
+            if self.random.random() < self.throttle:
+                self.throttled += 1
+                return 503, error_xml('RequestLimitExceeded', 'Request limit exceeded.')
+
+            operation = self.model.operation_model(action)
+            kwargs = parse_query(operation.input_shape, params) or dict()
+            self.ec2.advance()
+            try:
+                response = getattr(self.ec2, EC2_ACTIONS[action])(**kwargs)
+            except (KeyError, TypeError) as e:
+                return 400, error_xml('InvalidParameterValue', str(e))
+
+        # Some calls (CreateTags) answer with nothing but the request id
+        output = to_xml(operation.output_shape, response) if operation.output_shape is not None else ''
+        body = ('<?xml version="1.0" encoding="UTF-8"?><%sResponse xmlns="http://ec2.amazonaws.com/doc/%s/">'
+                '<requestId>fake</requestId>%s</%sResponse>' % (action, self.model.api_version, output, action))
+        return 200, body
+
+    ## Mesos
+
+    def demand(self):
+        # Instances worth of demand beyond the baseline
+        if self.swing and int(self.clock.now / 300) % 2:
+            return self.fleet_size - self.swing
+
+        return self.fleet_size
+
+    def usage(self):
+        with self.lock:
+            running = len(self.ec2.running())
+
+        used = dict()
+        total = dict()
+        for resource in RESOURCES:
+            per_instance = self.config['instance_%s' % resource]
+            total[resource] = self.config['baseline_%s' % resource] + running * per_instance
+            wanted = self.config['burst_point_percentage'] * (self.config['baseline_%s' % resource] +
+                                                              (self.demand() - 0.5) * per_instance)
+            used[resource] = min(wanted, total[resource])
+
+        return running, used, total
+
+    def metrics_snapshot(self):
+        running, used, total = self.usage()
+        snapshot = dict()
+        for resource in RESOURCES:
+            snapshot['master/%s_used' % resource] = used[resource]
+            snapshot['master/%s_total' % resource] = total[resource]
+            snapshot['master/%s_percent' % resource] = used[resource] / total[resource] if total[resource] else 0.0
+
+        return snapshot
+
+    def slaves(self):
+        running, used, total = self.usage()
+        with self.lock:
+            instances = self.ec2.running()
+
+        # The usage is spread evenly over the spot agents
+        share = dict((r, used[r] / total[r] if total[r] else 0.0) for r in RESOURCES)
+        slaves = []
+        for instance in instances:
+            resources = dict((r, self.config['instance_%s' % r]) for r in RESOURCES)
+            slaves.append({'id': 'agent-%s' % instance.instance_id,
+                           'pid': 'slave(1)@%s:5051' % instance.private_ip_address,
+                           'hostname': instance.private_ip_address,
+                           'active': True,
+                           'resources': resources,
+                           'used_resources': dict((r, resources[r] * share[r]) for r in RESOURCES)})
+
+        return {'slaves': slaves}
+
+    ## Instance metadata
+
+    def instance_actions(self):
+        # A relay of the instances' spot/instance-action documents
+        with self.lock:
+            self.ec2.advance()
+            return self.ec2.instance_actions()
+
+class FakeCloudHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def respond(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_POST(self):
+        cloud = self.server.cloud
+        path = self.path.split('?', 1)[0]
+        if path == '/maintenance/schedule':
+            cloud.schedule = json.loads(self.read_body())
+            self.respond(200, '', 'application/json')
+            return
+
+        params = dict(urlparse.parse_qsl(self.read_body(), keep_blank_values=True))
+        status, body = cloud.ec2_call(params)
+        self.respond(status, body, 'text/xml;charset=UTF-8')
+
+    def do_GET(self):
+        cloud = self.server.cloud
+        path = self.path.split('?', 1)[0]
+        if path == '/metrics/snapshot':
+            self.respond(200, json.dumps(cloud.metrics_snapshot()), 'application/json')
+        elif path == '/master/slaves':
+            self.respond(200, json.dumps(cloud.slaves()), 'application/json')
+        elif path == '/maintenance/schedule':
+            self.respond(200, json.dumps(cloud.schedule), 'application/json')
+        elif path == '/spot/instance-actions':
+            self.respond(200, json.dumps(cloud.instance_actions()), 'application/json')
+        else:
+            self.respond(404, '', 'text/plain')
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeCloudServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def start_server(cloud, port=0, addr='127.0.0.1'):
+    server = FakeCloudServer((addr, port), FakeCloudHandler)
+    server.cloud = cloud
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "c:p:n:l:t:s:", ["help","config=","port=","fleet-size=","latency=","throttle=","swing="])
+    except getopt.GetoptError as e:
+        basics.handle_error(e)
+
+    config_path = 'config.yml'
+    port = 8080
+    fleet_size = 100
+    latency = 0.0
+    throttle = 0.0
+    swing = 0
+    for o,p in opts:
+        if o in ["--help"]:
+            print_usage()
+            exit()
+        elif o in ["-c", "--config"]:
+            config_path = p
+        elif o in ["-p", "--port"]:
+            port = int(p)
+        elif o in ["-n", "--fleet-size"]:
+            fleet_size = int(p)
+        elif o in ["-l", "--latency"]:
+            latency = float(p)
+        elif o in ["-t", "--throttle"]:
+            throttle = float(p)
+        elif o in ["-s", "--swing"]:
+            swing = int(p)
+
+    with open(config_path, 'r') as configfile:
+        config = yaml.safe_load(configfile)
+
+    server = start_server(FakeCloud(config, fleet_size, latency, throttle, swing), port)
+    print "Serving EC2 and Mesos on http://%s:%i" % server.server_address
+    while True:
+        time.sleep(60)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+RESOURCES = ['cpus', 'mem', 'disk']
+
+def default_size(config):
+    return {'instance_type': config['instance_type'],
+            'cpus': config['instance_cpus'],
+            'mem': config['instance_mem'],
+            'disk': config['instance_disk']}
+
+def load_catalog(config):
+    # The single instance type settings are the catalog when none is configured
+    if config.get('instance_catalog'):
+        return config['instance_catalog']
+
+    return [default_size(config)]
+
+def get_fleet_members(spot_instances, spot_requests):
+    # (id, instance type, is an open request) for every instance and open request
+    members = [(i.instance_id, i.instance_type, False) for i in spot_instances]
+    for request in spot_requests:
+        if request[u'State'] == 'open':
+            members.append((request[u'SpotInstanceRequestId'],
+                            request[u'LaunchSpecification'][u'InstanceType'],
+                            True))
+
+    return members
+
+def get_fleet_capacity(members, catalog, default=None):
+    # Members of types outside the catalog (instance_type, warm pool
+    # instances, types since dropped from the catalog) count as default
+    by_type = dict((t['instance_type'], t) for t in catalog)
+    capacity = dict((r, 0.0) for r in RESOURCES)
+    for member_id, instance_type, is_request in members:
+        size = by_type.get(instance_type, default)
+        if size is not None:
+            for r in RESOURCES:
+                capacity[r] += size[r]
+
+    return capacity
+
+def get_deficit(resources_in_use, capacity, config):
+    # Positive where more capacity is needed to get usage below the burst point.
+    # Adding more than the deficit of every resource is enough.
+    burst_point = config['burst_point_percentage']
+    return dict((r, resources_in_use[r]/burst_point - config['baseline_%s' % r] - capacity[r]) for r in RESOURCES)
+
+# Branch and bound nodes to spend improving on the greedy mix
+SEARCH_NODES = 20000
+
+def covers(remaining):
+    return all(remaining[r] < 0 for r in RESOURCES)
+
+def mix_cost(mix, prices):
+    return sum(n * prices[t] for t, n in mix.items())
+
+def take(remaining, instance, n):
+    return dict((r, remaining[r] - n*instance[r]) for r in RESOURCES)
+
+def greedy_mix(deficit, types, max_count):
+    # Add the type with the lowest price per share of what is still short,
+    # then repair: drop instances that are not needed and swap instances for
+    # cheaper types while the deficit stays covered
+    remaining = dict(deficit)
+    mix = dict()
+    while not covers(remaining):
+        if sum(mix.values()) == max_count:
+            return None
+
+        def price_per_share(t):
+            share = sum(min(1.0, t['instance'][r] / max(remaining[r], 1e-9)) for r in RESOURCES if remaining[r] >= 0)
+            return t['price'] / share if share > 0 else float('inf')
+
+        best = min(types, key=price_per_share)
+        if price_per_share(best) == float('inf'):
+            return None
+        mix[best['instance_type']] = mix.get(best['instance_type'], 0) + 1
+        remaining = take(remaining, best['instance'], 1)
+
+    by_type = dict((t['instance_type'], t) for t in types)
+    improved = True
+    while improved:
+        improved = False
+        for name in sorted(mix, key=lambda n: -by_type[n]['price']):
+            if not mix.get(name):
+                continue
+            without = take(remaining, by_type[name]['instance'], -1)
+            if covers(without):
+                remaining = without
+                mix[name] -= 1
+                improved = True
+                continue
+            for other in types:
+                if other['price'] >= by_type[name]['price']:
+                    break
+                swapped = take(without, other['instance'], 1)
+                if covers(swapped):
+                    remaining = swapped
+                    mix[name] -= 1
+                    mix[other['instance_type']] = mix.get(other['instance_type'], 0) + 1
+                    improved = True
+                    break
+
+    return dict((t, n) for t, n in mix.items() if n)
+
+def single_type_mix(deficit, instance, max_count):
+    # The fewest instances of one type that cover the deficit
+    needed = 0
+    for r in RESOURCES:
+        if deficit[r] >= 0:
+            if instance[r] <= 0:
+                return None
+            needed = max(needed, int(deficit[r] // instance[r]) + 1)
+
+    return {instance['instance_type']: needed} if needed <= max_count else None
+
+def cheapest_mix(deficit, catalog, prices, max_count, max_nodes=SEARCH_NODES):
+    """Cheapest counts per instance type that cover the deficit.
+
+    A greedy mix, repaired, or the best single type if that is cheaper, is
+    the starting point. Branch and bound over the catalog then looks for a
+    cheaper mix within max_nodes nodes, so the time spent is bounded however
+    large the deficit or the catalog. Returns None when max_count instances
+    can not cover the deficit.
+    """
+
+    types = sorted([{'instance_type': t['instance_type'], 'instance': t, 'price': prices[t['instance_type']]}
+                    for t in catalog if t['instance_type'] in prices],
+                   key=lambda t: t['price'])
+    if not types or max_count <= 0:
+        return {} if covers(deficit) else None
+
+    best = {'cost': None, 'count': None, 'mix': None, 'nodes': 0}
+
+    def consider(mix):
+        if mix is None:
+            return
+        cost = mix_cost(mix, prices)
+        count = sum(mix.values())
+        if (best['cost'] is None or cost < best['cost'] or
+            (cost == best['cost'] and count < best['count'])):
+            best['cost'], best['count'], best['mix'] = cost, count, dict(mix)
+
+    consider(greedy_mix(deficit, types, max_count))
+    for t in types:
+        consider(single_type_mix(deficit, t['instance'], max_count))
+
+    unit_price = dict()
+    for r in RESOURCES:
+        rates = [t['price']/t['instance'][r] for t in types if t['instance'][r] > 0]
+        unit_price[r] = min(rates) if rates else float('inf')
+
+    def lower_bound(remaining):
+        return max(max(0.0, remaining[r]) * unit_price[r] for r in RESOURCES)
+
+    def search(i, remaining, count_left, cost, mix):
+        best['nodes'] += 1
+        if best['nodes'] > max_nodes:
+            return
+
+        if covers(remaining):
+            consider(mix)
+            return
+
+        if i == len(types) or count_left == 0:
+            return
+
+        if best['cost'] is not None and cost + lower_bound(remaining) > best['cost']:
+            return
+
+        instance = types[i]['instance']
+        price = types[i]['price']
+
+        # More of this type than covers every remaining resource is never cheaper
+        needed = max([int(remaining[r] // instance[r]) + 1 for r in RESOURCES if instance[r] > 0 and remaining[r] >= 0] or [0])
+        for n in range(min(count_left, needed), -1, -1):
+            if n:
+                mix[types[i]['instance_type']] = n
+            search(i + 1, take(remaining, instance, n), count_left - n, cost + n*price, mix)
+            mix.pop(types[i]['instance_type'], None)
+
+    search(0, deficit, max_count, 0.0, dict())
+    return best['mix']
+
+def get_removable_members(deficit, members, catalog, prices, default=None):
+    # Drop members of types outside the catalog first, as the planner never
+    # requests them again, then open requests, then the most expensive
+    # instances, as long as every resource stays covered. Those outside the
+    # catalog count as default, as in get_fleet_capacity.
+    by_type = dict((t['instance_type'], t) for t in catalog)
+    surplus = dict((r, -deficit[r]) for r in RESOURCES)
+    candidates = sorted([m for m in members if m[1] in by_type or default is not None],
+                        key=lambda m: (m[1] in by_type, not m[2], -prices.get(m[1], 0.0)))
+
+    removable = []
+    for member_id, instance_type, is_request in candidates:
+        instance = by_type.get(instance_type, default)
+        if all(surplus[r] - instance[r] > 0 for r in RESOURCES):
+            for r in RESOURCES:
+                surplus[r] -= instance[r]
+            removable.append((member_id, instance_type, is_request))
+
+    return removable
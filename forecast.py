@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+import calendar
+
+RESOURCES = ['cpus', 'mem', 'disk']
+
+class HoltForecaster(object):
+    """Holt's linear smoothing of the resource usage, one level and trend per resource.
+
+    Each update is O(1) and the state is a few floats, so it can run every loop
+    for as long as the daemon lives. The trend is kept per second, which keeps
+    it valid when loops are irregular (event-driven mode).
+    """
+
+    def __init__(self, alpha=0.5, beta=0.2):
+        self.alpha = alpha
+        self.beta = beta
+        self.level = None
+        self.trend = None
+        self.last_update = None
+
+    def update(self, resources_in_use, now):
+        if self.level is None:
+            self.level = dict((r, resources_in_use[r]) for r in RESOURCES)
+            self.trend = dict((r, 0.0) for r in RESOURCES)
+            self.last_update = now
+            return
+
+        elapsed = now - self.last_update
+        if elapsed <= 0:
+            return
+
+        for r in RESOURCES:
+            expected = self.level[r] + self.trend[r] * elapsed
+            level = self.alpha * resources_in_use[r] + (1 - self.alpha) * expected
+            self.trend[r] = self.beta * (level - self.level[r]) / elapsed + (1 - self.beta) * self.trend[r]
+            self.level[r] = level
+
+        self.last_update = now
+
+    def state(self):
+        # Copies, as update() changes level and trend in place
+        return {'level': dict(self.level), 'trend': dict(self.trend), 'last_update': self.last_update}
+
+    def restore(self, state):
+        self.level = state['level']
+        self.trend = state['trend']
+        self.last_update = state['last_update']
+
+    def predict(self, horizon):
+        return dict((r, max(0.0, self.level[r] + self.trend[r] * horizon)) for r in RESOURCES)
+
+class LeadTimeTracker(object):
+    """Measures the time from a spot request until its agent registers with Mesos.
+
+    Only requests placed after the tracker started are measured. The estimate
+    is an exponentially weighted mean of the samples, starting from initial.
+    """
+
+    def __init__(self, initial, now, alpha=0.3):
+        self.lead_time = float(initial)
+        self.alpha = alpha
+        self.started = now
+        self.measured = set()
+        self.samples = 0
+
+    def observe(self, spot_requests, instances, registered_ips, now):
+        if registered_ips is None:
+            return
+
+        addresses = dict((i.instance_id, i.private_ip_address) for i in instances)
+        for request in spot_requests:
+            request_id = request[u'SpotInstanceRequestId']
+            instance_id = request.get(u'InstanceId')
+            if request_id in self.measured or instance_id not in addresses:
+                continue
+
+            created = calendar.timegm(request[u'CreateTime'].utctimetuple())
+            if created < self.started:
+                self.measured.add(request_id)
+                continue
+
+            if addresses[instance_id] in registered_ips:
+                self.lead_time = self.alpha * (now - created) + (1 - self.alpha) * self.lead_time
+                self.measured.add(request_id)
+                self.samples += 1
+
+    def forget(self, spot_requests):
+        # Requests that left the listings are not seen again, so only the
+        # live ones are kept
+        self.measured.intersection_update(r[u'SpotInstanceRequestId'] for r in spot_requests)
+
+    def waiting(self, spot_requests, instances):
+        # Whether a request placed since the start has an instance whose
+        # agent is still to be seen registering
+        listed = set(i.instance_id for i in instances)
+        for request in spot_requests:
+            if (request[u'SpotInstanceRequestId'] not in self.measured
+                    and request.get(u'InstanceId') in listed
+                    and calendar.timegm(request[u'CreateTime'].utctimetuple()) >= self.started):
+                return True
+
+        return False
+
+    def state(self):
+        # What was learned; requests from before a restart are not measured
+        return {'lead_time': self.lead_time, 'samples': self.samples}
+
+    def restore(self, state):
+        self.lead_time = state['lead_time']
+        self.samples = state['samples']
+
+def queued_demand(queue_entries):
+    # Resources Marathon is still waiting to place, from the entries of /v2/queue
+    demand = dict((r, 0.0) for r in RESOURCES)
+    for entry in queue_entries:
+        app = entry.get(u'app', {})
+        count = entry.get(u'count', 0)
+        for r in RESOURCES:
+            demand[r] += count * float(app.get(r, 0) or 0)
+
+    return demand
+
+def registered_agent_ips(agents):
+    # The ips of the active agents among those from drain.agents_by_ip
+    return set(ip for ip in agents if agents[ip].active)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+import collections
+import mmap
+import os
+import struct
+from bisect import bisect_left,insort
+
+# Recent loop readings in a fixed-size ring of doubles, optionally mapped to a
+# file so they survive a restart. Windows over the most recent seconds keep
+# their aggregates up to date as readings come and go, so asking for the mean,
+# max or a percentile does not scan the ring.
+
+FIELDS = ['cpus_used', 'mem_used', 'disk_used',
+          'cpus_percent', 'mem_percent', 'disk_percent',
+          'active', 'pending', 'bid']
+
+# Magic, capacity, fields per reading, readings written, readings kept
+HEADER = struct.Struct('<8sIIQQ')
+MAGIC = 'BURSTRB1'
+
+class RingBuffer(object):
+    """The last capacity readings, each a timestamp and one double per field."""
+
+    def __init__(self, capacity, fields=FIELDS, path=None):
+        self.capacity = capacity
+        self.fields = list(fields)
+        self.record = struct.Struct('<%id' % (len(self.fields) + 1))
+        self.size = HEADER.size + capacity * self.record.size
+        self.windows = []
+        self.written = 0
+        self.count = 0
+
+        if path:
+            self.buffer = self.map(path)
+        else:
+            self.buffer = bytearray(self.size)
+
+    def map(self, path):
+        # Reuse the readings in the file when it was written with the same layout
+        with open(path, 'a+b') as f:
+            f.seek(0)
+            header = f.read(HEADER.size)
+            if len(header) == HEADER.size and os.fstat(f.fileno()).st_size == self.size:
+                magic, capacity, fields, written, count = HEADER.unpack(header)
+                if (magic, capacity, fields) == (MAGIC, self.capacity, len(self.fields)):
+                    self.written, self.count = written, count
+
+            if (self.written, self.count) == (0, 0):
+                f.truncate(0)
+                f.write('\0' * self.size)
+                f.flush()
+
+            return mmap.mmap(f.fileno(), self.size)
+
+    def append(self, timestamp, values):
+        row = [float(values[f]) for f in self.fields]
+        self.record.pack_into(self.buffer, HEADER.size + (self.written % self.capacity) * self.record.size,
+                              timestamp, *row)
+        self.written += 1
+        self.count = min(self.count + 1, self.capacity)
+        HEADER.pack_into(self.buffer, 0, MAGIC, self.capacity, len(self.fields), self.written, self.count)
+
+        for window in self.windows:
+            window.add(timestamp, row)
+
+    def __len__(self):
+        return self.count
+
+    def reading(self, i):
+        # The i:th oldest reading kept, as (timestamp, {field: value})
+        slot = (self.written - self.count + i) % self.capacity
+        values = self.record.unpack_from(self.buffer, HEADER.size + slot * self.record.size)
+        return values[0], dict(zip(self.fields, values[1:]))
+
+    def readings(self):
+        for i in range(self.count):
+            yield self.reading(i)
+
+    def window(self, seconds):
+        # Windows are kept up to date from here on, so create them once
+        window = Window(seconds, self.fields)
+        for timestamp, values in self.readings():
+            window.add(timestamp, [values[f] for f in self.fields])
+        self.windows.append(window)
+
+        return window
+
+    def flush(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.flush()
+
+class Window(object):
+    """Aggregates of the readings from the last seconds.
+
+    Adding a reading is O(1) for the mean and amortized O(1) for the max. The
+    percentiles keep a sorted list per field, which costs O(n) per reading for
+    the n readings in the window; answering any of them is O(1).
+    """
+
+    def __init__(self, seconds, fields):
+        self.seconds = seconds
+        self.fields = list(fields)
+        self.readings = collections.deque()
+        self.sums = [0.0] * len(self.fields)
+        self.maxima = [collections.deque() for f in self.fields]
+        self.sorted = [[] for f in self.fields]
+
+    def add(self, timestamp, row):
+        self.readings.append((timestamp, row))
+        for i, value in enumerate(row):
+            self.sums[i] += value
+            maxima = self.maxima[i]
+            while maxima and maxima[-1][1] <= value:
+                maxima.pop()
+            maxima.append((timestamp, value))
+            insort(self.sorted[i], value)
+
+        # Drop what has fallen out of the window
+        while self.readings and self.readings[0][0] <= timestamp - self.seconds:
+            old_timestamp, old_row = self.readings.popleft()
+            for i, value in enumerate(old_row):
+                self.sums[i] -= value
+                if self.maxima[i][0][0] <= old_timestamp:
+                    self.maxima[i].popleft()
+                del self.sorted[i][bisect_left(self.sorted[i], value)]
+
+    def __len__(self):
+        return len(self.readings)
+
+    def mean(self, field):
+        if not self.readings:
+            return None
+
+        return self.sums[self.fields.index(field)] / len(self.readings)
+
+    def max(self, field):
+        if not self.readings:
+            return None
+
+        return self.maxima[self.fields.index(field)][0][1]
+
+    def percentile(self, field, percent):
+        values = self.sorted[self.fields.index(field)]
+        if not values:
+            return None
+
+        return values[min(len(values) - 1, int(percent * len(values)))]
+
+    def aggregate(self, field, statistic):
+        # statistic is mean, max or a percentile such as p90
+        if statistic == 'mean':
+            return self.mean(field)
+        elif statistic == 'max':
+            return self.max(field)
+
+        return self.percentile(field, float(statistic[1:]) / 100)
+
+def parse_statistic(statistic):
+    # For checking the configured statistic up front
+    if statistic in ['mean', 'max']:
+        return statistic
+
+    if statistic.startswith('p'):
+        try:
+            if 0 <= float(statistic[1:]) <= 100:
+                return statistic
+        except ValueError:
+            pass
+
+    raise ValueError('%s is not mean, max or a percentile like p90' % statistic)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+import httplib
+import json
+import socket
+import threading
+import urlparse
+import zlib
+
+# The yajl2 backend decodes in C through libyajl when it is installed; the
+# pure python one is many times slower than json.loads
+try:
+    import ijson.backends.yajl2 as ijson
+except ImportError:
+    import ijson
+
+# Keep-alive HTTP for the Mesos and Marathon APIs. Connections are pooled per
+# host, responses may be gzip encoded, and large documents can be decoded as a
+# stream of items instead of being read into memory first.
+
+CHUNK_SIZE = 64 * 1024
+
+class GzipReader(object):
+    """File-like view of the decompressed body of a gzip encoded response."""
+
+    def __init__(self, response):
+        self.response = response
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = self.response.read(CHUNK_SIZE)
+            if not chunk:
+                self.buffer += self.decompressor.flush()
+                break
+            self.buffer += self.decompressor.decompress(chunk)
+
+        if size < 0:
+            data, self.buffer = self.buffer, ''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+
+        return data
+
+class HttpClient(object):
+    def __init__(self, max_idle_per_host=4):
+        self.max_idle_per_host = max_idle_per_host
+        self.lock = threading.Lock()
+        self.idle = dict()
+
+    def checkout(self, host, timeout):
+        with self.lock:
+            connections = self.idle.get(host, [])
+            connection = connections.pop() if connections else None
+
+        if connection is None:
+            return httplib.HTTPConnection(host, timeout=timeout), False
+
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+
+        return connection, True
+
+    def checkin(self, host, connection, response):
+        if response.getheader('connection', '').lower() == 'close':
+            connection.close()
+            return
+
+        with self.lock:
+            connections = self.idle.setdefault(host, [])
+            if len(connections) < self.max_idle_per_host:
+                connections.append(connection)
+                return
+
+        connection.close()
+
+    def request(self, url, timeout, method='GET', body=None):
+        parsed = urlparse.urlparse(url)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+
+        headers = {'Accept': 'application/json',
+                   'Accept-Encoding': 'gzip'}
+        if body is not None:
+            headers['Content-Type'] = 'application/json'
+
+        connection, reused = self.checkout(parsed.netloc, timeout)
+        try:
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            if not reused:
+                raise
+
+            # The server closed an idle connection, try once on a fresh one
+            connection, reused = httplib.HTTPConnection(parsed.netloc, timeout=timeout), False
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+            except:
+                connection.close()
+                raise
+
+        if response.status != 200:
+            response.read()
+            self.checkin(parsed.netloc, connection, response)
+            raise httplib.HTTPException('%s returned HTTP %i %s' % (url, response.status, response.reason))
+
+        return parsed.netloc, connection, response
+
+    def body(self, response):
+        if response.getheader('content-encoding', '').lower() == 'gzip':
+            return GzipReader(response)
+
+        return response
+
+    def get_json(self, url, timeout=None):
+        host, connection, response = self.request(url, timeout)
+        try:
+            data = json.loads(self.body(response).read())
+        except:
+            connection.close()
+            raise
+
+        self.checkin(host, connection, response)
+        return data
+
+    def post_json(self, url, data, timeout=None):
+        # Only for idempotent endpoints, as it is sent again when a reused
+        # connection turns out to be closed
+        host, connection, response = self.request(url, timeout, 'POST', json.dumps(data))
+        response.read()
+        self.checkin(host, connection, response)
+
+    def iter_json(self, url, prefix, timeout=None):
+        """Yields the items under prefix (ijson syntax, e.g. 'slaves.item')."""
+
+        host, connection, response = self.request(url, timeout)
+        drained = False
+        try:
+            for item in ijson.items(self.body(response), prefix):
+                yield item
+
+            # Drain what follows the items so the connection can be reused
+            response.read()
+            drained = True
+        finally:
+            # Also when the caller stops early and the generator is closed
+            if drained:
+                self.checkin(host, connection, response)
+            else:
+                connection.close()
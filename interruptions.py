@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+import pricestore
+import dateutil.parser
+
+# Spot instances get a two-minute notice before EC2 reclaims them. While the
+# instance still runs, its spot request carries one of NOTICE_CODES as the
+# status code, and the instance sees the same notice in its metadata at
+# spot/instance-action. Instances with a notice are replaced and drained
+# right away, instead of after they are gone and their usage lands on the
+# rest of the cluster.
+
+NOTICE_SECONDS = 120
+NOTICE_CODES = ['marked-for-termination', 'marked-for-stop', 'marked-for-hibernation']
+NOTICE_ACTIONS = ['terminate', 'stop', 'hibernate']
+
+def request_notices(spot_requests):
+    # When each instance with a notice goes, keyed by instance id
+    notices = dict()
+    for request in spot_requests:
+        status = request.get(u'Status') or {}
+        if status.get(u'Code') in NOTICE_CODES and request.get(u'InstanceId'):
+            notices[request[u'InstanceId']] = pricestore.to_epoch(status[u'UpdateTime']) + NOTICE_SECONDS
+
+    return notices
+
+def metadata_notices(actions):
+    # The spot/instance-action documents of the instances, keyed by instance
+    # id, as gathered by a relay: {"i-0a1b": {"action": "terminate",
+    # "time": "2017-09-18T08:22:00Z"}}
+    notices = dict()
+    for instance_id, action in actions.items():
+        if action.get(u'action') in NOTICE_ACTIONS:
+            notices[instance_id] = pricestore.to_epoch(dateutil.parser.parse(action[u'time']))
+
+    return notices
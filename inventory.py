@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+import threading
+import time
+
+# Spot requests in these states hold or will hold capacity. Everything else is
+# history and is left on the EC2 side.
+LIVE_REQUEST_STATES = ['open', 'active']
+LIVE_INSTANCE_STATES = ['pending', 'running', 'rebooting']
+
+class SpotInstance(object):
+    """The attributes of an EC2 instance that the control loop reads."""
+
+    def __init__(self, data):
+        self.instance_id = data[u'InstanceId']
+        self.instance_type = data.get(u'InstanceType')
+        self.launch_time = data[u'LaunchTime']
+        self.private_ip_address = data.get(u'PrivateIpAddress')
+        self.spot_instance_request_id = data.get(u'SpotInstanceRequestId')
+        self.state = data[u'State']
+
+def paginate(call, key, **kwargs):
+    items = []
+    while True:
+        response = call(**kwargs)
+        items.extend(response[key])
+        if not response.get('NextToken'):
+            return items
+        kwargs['NextToken'] = response['NextToken']
+
+def fetch_spot_requests(ec2client,extra_filters=None):
+    return paginate(ec2client.describe_spot_instance_requests,
+                    'SpotInstanceRequests',
+                    Filters=[{'Name': 'state', 'Values': LIVE_REQUEST_STATES}] + (extra_filters or []))
+
+def fetch_spot_instances(ec2client,extra_filters=None):
+    reservations = paginate(ec2client.describe_instances,
+                            'Reservations',
+                            Filters=[{'Name': 'instance-lifecycle', 'Values': ['spot']},
+                                     {'Name': 'instance-state-name', 'Values': LIVE_INSTANCE_STATES}] + (extra_filters or []))
+    return [instance for reservation in reservations for instance in reservation[u'Instances']]
+
+class Inventory(object):
+    """The live spot requests and spot instances, kept between loops.
+
+    update() takes one server-filtered listing of each and returns what changed
+    since the previous one: new and fulfilled requests, requests that left the
+    live states (cancelled, closed or failed), and new and terminated instances.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = dict()
+        self.instances = dict()
+        self.expected = dict()
+
+    def expect(self, spot_requests, until):
+        # Requests placed just before a restart, which the listings may not
+        # show yet. They count as listed until they are, or until passes.
+        with self.lock:
+            for request in spot_requests:
+                self.expected[request[u'SpotInstanceRequestId']] = (request, until)
+
+    def update(self, spot_requests, spot_instances):
+        with self.lock:
+            requests = dict((r[u'SpotInstanceRequestId'], r) for r in spot_requests)
+            instances = dict((i[u'InstanceId'], SpotInstance(i)) for i in spot_instances)
+
+            now = time.time()
+            for request_id, (request, until) in self.expected.items():
+                if request_id in requests or until < now:
+                    del self.expected[request_id]
+                else:
+                    requests[request_id] = request
+
+            changes = {'new_requests': [],
+                       'fulfilled_requests': [],
+                       'closed_requests': [],
+                       'new_instances': [],
+                       'terminated_instances': []}
+
+            for request_id in requests:
+                if request_id not in self.requests:
+                    changes['new_requests'].append(request_id)
+                if (requests[request_id][u'State'] == 'active' and
+                    (request_id not in self.requests or self.requests[request_id][u'State'] != 'active')):
+                    changes['fulfilled_requests'].append(request_id)
+
+            changes['closed_requests'] = [r for r in self.requests if r not in requests]
+            changes['new_instances'] = [i for i in instances if i not in self.instances]
+            changes['terminated_instances'] = [i for i in self.instances if i not in instances]
+
+            self.requests = requests
+            self.instances = instances
+
+            return changes
+
+    def spot_requests(self):
+        with self.lock:
+            return self.requests.values()
+
+    def open_request_ids(self):
+        # Oldest first, so cancelling from the end drops the newest requests
+        with self.lock:
+            open_requests = [r for r in self.requests.values() if r[u'State'] == 'open']
+            return [r[u'SpotInstanceRequestId'] for r in sorted(open_requests, key=lambda r: r[u'CreateTime'])]
+
+    def spot_instances(self):
+        with self.lock:
+            return self.instances.values()
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+import basics
+import pricestore
+import json
+import os
+import threading
+import time
+import uuid
+
+# Append-only journal of every loop and of the EC2 calls that change the fleet.
+# An intent is written and synced before each such call and its outcome after
+# it, so after a crash the calls that may or may not have reached EC2 are
+# known. The loop records are synced once per loop. The file is compacted to
+# what recovery needs once it grows past max_bytes.
+
+MUTATING_CALLS = ['request_spot_instances', 'cancel_spot_instance_requests', 'terminate_instances',
+                  'start_instances', 'stop_instances']
+
+class Journal(object):
+    def __init__(self, path, max_bytes=1024*1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.records, end = self.read()
+        self.sequence = self.records[-1]['seq'] if self.records else 0
+        self.truncate(end)
+        self.file = open(path, 'a')
+
+    def read(self):
+        # The complete records, and the offset where the last of them ends
+        records = []
+        end = 0
+        if not os.path.exists(self.path):
+            return records, end
+
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    # A record torn by the crash
+                    break
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break
+                end += len(line)
+
+        return records, end
+
+    def truncate(self, end):
+        # Drop a torn record, so new records do not run on from it
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == end:
+            return
+
+        with open(self.path, 'r+b') as f:
+            f.truncate(end)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def append(self, record, durable=False):
+        with self.lock:
+            self.sequence += 1
+            record['seq'] = self.sequence
+            record['time'] = time.time()
+            self.file.write(json.dumps(record) + '\n')
+            if durable:
+                self.sync()
+
+        return record['seq']
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def commit(self):
+        with self.lock:
+            self.sync()
+
+        if os.path.getsize(self.path) > self.max_bytes:
+            self.compact()
+
+    def intent(self, cluster, call, kwargs):
+        return self.append({'type': 'intent', 'cluster': cluster, 'call': call, 'kwargs': kwargs}, durable=True)
+
+    def done(self, cluster, intent, result=None, error=None):
+        self.append({'type': 'done', 'cluster': cluster, 'intent': intent, 'result': result, 'error': error})
+
+    def tick(self, cluster, snapshot, decision, state):
+        self.append({'type': 'tick', 'cluster': cluster, 'snapshot': snapshot, 'decision': decision, 'state': state})
+
+    def recover(self, cluster, keep_seconds, now=None):
+        """What the journal knows about a cluster from before the restart.
+
+        Returns the state of its last loop, the intents without an outcome,
+        and the spot requests placed in the last keep_seconds.
+        """
+
+        if now is None:
+            now = time.time()
+
+        intents = dict()
+        state = None
+        placed = []
+        for record in self.records:
+            if record.get('cluster') != cluster:
+                continue
+            if record['type'] == 'intent':
+                intents[record['seq']] = record
+            elif record['type'] == 'done':
+                intents.pop(record['intent'], None)
+                if record['result'] and 'requests' in record['result']:
+                    placed.extend(r for r in record['result']['requests'] if r['created'] > now - keep_seconds)
+            elif record['type'] == 'tick':
+                state = record['state']
+
+        return {'state': state,
+                'unfinished': [intents[seq] for seq in sorted(intents)],
+                'requests': placed}
+
+    def compact(self, keep_seconds=3600):
+        # Keep the last loop of each cluster, open intents and recent requests
+        with self.lock:
+            self.sync()
+            records, end = self.read()
+            now = time.time()
+
+            finished = set(r['intent'] for r in records if r['type'] == 'done')
+            last_tick = dict()
+            for record in records:
+                if record['type'] == 'tick':
+                    last_tick[record['cluster']] = record['seq']
+
+            kept = []
+            for record in records:
+                if record['type'] == 'tick' and last_tick[record['cluster']] == record['seq']:
+                    kept.append(record)
+                elif record['type'] == 'intent' and record['seq'] not in finished:
+                    kept.append(record)
+                elif (record['type'] == 'done' and record['result'] and 'requests' in record['result'] and
+                      any(r['created'] > now - keep_seconds for r in record['result']['requests'])):
+                    kept.append(record)
+
+            temporary = '%s.compact' % self.path
+            with open(temporary, 'w') as f:
+                for record in kept:
+                    f.write(json.dumps(record) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+            self.file.close()
+            os.rename(temporary, self.path)
+            directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+            self.file = open(self.path, 'a')
+            self.records = kept
+
+# The fields of a launch specification that differ between spot requests.
+# The rest (with its UserData) comes from the config.
+REQUEST_FIELDS = ['InstanceType', 'Placement', 'SubnetId']
+
+def describe_call(call, kwargs):
+    kwargs = dict(kwargs)
+    if 'LaunchSpecification' in kwargs:
+        specification = kwargs['LaunchSpecification']
+        kwargs['LaunchSpecification'] = dict((f, specification.get(f)) for f in REQUEST_FIELDS)
+
+    return kwargs
+
+def describe_result(call, response):
+    if call == 'request_spot_instances':
+        return {'requests': [{'id': r[u'SpotInstanceRequestId'],
+                              'created': pricestore.to_epoch(r[u'CreateTime']),
+                              'spot_price': r[u'SpotPrice'],
+                              'instance_type': r.get(u'LaunchSpecification', {}).get(u'InstanceType'),
+                              'zone': r.get(u'LaunchSpecification', {}).get(u'Placement', {}).get(u'AvailabilityZone')}
+                             for r in response.get(u'SpotInstanceRequests', [])]}
+
+    return {'ok': True}
+
+class JournaledClient(object):
+    """Wraps a cluster's EC2 client so calls that change the fleet are journaled.
+
+    Spot requests get a ClientToken, which makes placing them again after a
+    crash return the requests that were already placed.
+    """
+
+    def __init__(self, client, journal, cluster):
+        self.client = client
+        self.journal = journal
+        self.cluster = cluster
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if name not in MUTATING_CALLS:
+            return attribute
+
+        def call(**kwargs):
+            if name == 'request_spot_instances':
+                kwargs.setdefault('ClientToken', uuid.uuid4().hex)
+
+            intent = self.journal.intent(self.cluster, name, describe_call(name, kwargs))
+            try:
+                response = attribute(**kwargs)
+            except Exception as e:
+                self.journal.done(self.cluster, intent, error=str(e))
+                raise
+
+            self.journal.done(self.cluster, intent, describe_result(name, response))
+            return response
+
+        return call
+
+def reissue(ec2client, intent, launch_specification):
+    # The same call again. All are safe to repeat: spot requests by their
+    # ClientToken, as long as the call is the same down to its zone and
+    # subnet, the others by nature.
+    kwargs = dict(intent['kwargs'])
+    if intent['call'] == 'request_spot_instances':
+        specification = dict(launch_specification)
+        for field, value in kwargs['LaunchSpecification'].items():
+            if value is None:
+                specification.pop(field, None)
+            else:
+                specification[field] = value
+        kwargs['LaunchSpecification'] = specification
+
+    try:
+        return getattr(ec2client, intent['call'])(**kwargs)
+    except Exception as e:
+        basics.write_to_syslog('error', 'Could not repeat the unfinished %s: %s' % (intent['call'], e))
+        return None
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+import basics
+import json
+import threading
+from kazoo.client import KazooClient
+from kazoo.exceptions import NoNodeError
+
+def parse_zkurl(mesos_zkurl):
+    # zk://[user:password@]host1:port1,host2:port2/path
+    if not mesos_zkurl.startswith('zk://'):
+        raise ValueError('Not a ZooKeeper url: %s' % mesos_zkurl)
+
+    rest = mesos_zkurl[len('zk://'):]
+    if '@' in rest.split('/', 1)[0]:
+        rest = rest.split('@', 1)[1]
+
+    if '/' not in rest:
+        return rest, '/'
+
+    hosts, path = rest.split('/', 1)
+    return hosts, '/' + path.rstrip('/')
+
+def parse_master_info(data):
+    info = json.loads(data)
+    if 'address' in info:
+        address = info['address']
+        return '%s:%i' % (address.get('ip', address.get('hostname')), address['port'])
+
+    # Older masters only fill in the libprocess pid, master@ip:port
+    return info['pid'].split('@', 1)[1]
+
+class MesosLeaderDetector(object):
+    """Tracks the leading Mesos master through a ZooKeeper watch.
+
+    The masters register sequential nodes under the Mesos path and the lowest
+    sequence number is the leader. The children of that path are watched, so
+    the cached leader is replaced as soon as the election changes. Pass a
+    client to run against a ZooKeeper stand-in instead of a real ensemble.
+    """
+
+    def __init__(self, mesos_zkurl, timeout=10, client=None):
+        self.mesos_zkurl = mesos_zkurl
+        self.hosts, self.path = parse_zkurl(mesos_zkurl)
+        self.timeout = timeout
+        self.client = client
+        self.lock = threading.Lock()
+        self.leader = None
+        self.listeners = []
+
+    def start(self):
+        if self.client is None:
+            self.client = KazooClient(hosts=self.hosts, timeout=self.timeout)
+
+        self.client.start(timeout=self.timeout)
+        self.client.ChildrenWatch(self.path, self.on_children)
+
+    def stop(self):
+        self.client.stop()
+        self.client.close()
+
+    def add_listener(self, listener):
+        # Called with the new leader every time it changes
+        self.listeners.append(listener)
+
+    def on_children(self, children):
+        try:
+            leader = self.resolve(children)
+        except Exception as e:
+            basics.write_to_syslog('error', 'Mesos leader lookup failed: %s' % e)
+            leader = None
+
+        with self.lock:
+            previous = self.leader
+            self.leader = leader
+
+        if leader is not None and leader != previous:
+            for listener in self.listeners:
+                listener(leader)
+
+    def resolve(self, children=None):
+        if children is None:
+            children = self.client.get_children(self.path)
+
+        # Mesos >= 0.24 writes JSON nodes, older masters write protobuf ones
+        candidates = sorted(c for c in children if c.startswith('json.info_'))
+        if not candidates:
+            if any(c.startswith('info_') for c in children):
+                return basics.run_command('mesos-resolve %s' % self.mesos_zkurl) or None
+            return None
+
+        for child in candidates:
+            try:
+                data, stat = self.client.get('%s/%s' % (self.path, child))
+            except NoNodeError:
+                # The leader went away between listing and reading
+                continue
+            return parse_master_info(data)
+
+        return None
+
+    def get(self):
+        with self.lock:
+            leader = self.leader
+
+        if leader is None:
+            leader = self.refresh()
+
+        return leader
+
+    def refresh(self):
+        # Re-read the election, e.g. after the cached master stopped answering
+        self.on_children(self.client.get_children(self.path))
+        with self.lock:
+            return self.leader
+
+class StaticLeader(object):
+    """A fixed Mesos master in place of the ZooKeeper election, for clusters
+    with a single master and for test setups without ZooKeeper."""
+
+    def __init__(self, mesos_master):
+        self.leader = mesos_master
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def add_listener(self, listener):
+        # The leader never changes
+        pass
+
+    def get(self):
+        return self.leader
+
+    def refresh(self):
+        return self.leader
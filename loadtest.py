@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+import fakecloud
+import basics
+import getopt
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib2
+import yaml
+
+# Runs the real burst.py main loop against fakecloud's EC2 and Mesos endpoints
+# for a series of fleet sizes, and reports loop latency, EC2 calls per loop and
+# the memory of the burst.py process.
+
+def print_usage():
+    print "Load test of the burst.py main loop against local fake endpoints\n"
+    print "usage: " + __file__ + " [arguments]\n"
+    print "Arguments:"
+    print "   --help\t\t\t Prints this help message"
+    print "   -c [--config]\t\t Config the runs are based on (default config.yml)"
+    print "   -n [--fleet-sizes]\t\t Comma separated fleet sizes (default 100,1000,5000)"
+    print "   -t [--ticks]\t\t\t Loops to measure per fleet size (default 10)"
+    print "   -l [--latency]\t\t Seconds added to every EC2 call (default 0)"
+    print "   -r [--throttle]\t\t Share of EC2 calls answered with RequestLimitExceeded (default 0)"
+    print "   -s [--swing]\t\t\t Instances of demand that come and go every 5 minutes (default 0)"
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    return port
+
+def write_config(base, base_path, directory, endpoint, metrics_port, fleet_size, swing):
+    config = dict((key, base[key]) for key in base if key not in ['clusters', 'history_path', 'price_store_path', 'journal_path'])
+    config.update({'aws_access_key_id': 'fake',
+                   'aws_secret_access_key': 'fake',
+                   'default_region': 'us-east-1',
+                   'ec2_endpoint_url': 'http://%s' % endpoint,
+                   'mesos_master': endpoint,
+                   'launch_config': os.path.abspath(os.path.join(os.path.dirname(base_path),
+                                                                 base.get('launch_config') or 'launch_config.yml')),
+                   'maximum_spot_slaves': fleet_size + swing,
+                   'metrics_port': metrics_port,
+                   'metrics_address': '127.0.0.1',
+                   'execution_interval': 1,
+                   'event_driven': False,
+                   'predictive_scaling': False,
+                   'drain_agents': False,
+                   'journal_path': os.path.join(directory, 'journal.log')})
+
+    path = os.path.join(directory, 'config.yml')
+    with open(path, 'w') as configfile:
+        yaml.safe_dump(config, configfile, default_flow_style=False)
+
+    return path
+
+def scrape(metrics_port):
+    # {(name, labels): value} from the OpenMetrics text
+    samples = dict()
+    for line in urllib2.urlopen('http://127.0.0.1:%i/metrics' % metrics_port, timeout=5).read().splitlines():
+        if line.startswith('#') or not line.strip():
+            continue
+        name, value = line.rsplit(' ', 1)
+        labels = ''
+        if '{' in name:
+            name, labels = name[:-1].split('{', 1)
+        samples[(name, labels)] = float(value)
+
+    return samples
+
+def peak_memory(pid):
+    # Peak resident set size in MB
+    with open('/proc/%i/status' % pid, 'r') as status:
+        for line in status:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024.0
+
+    return None
+
+def run(base, base_path, fleet_size, ticks, latency, throttle, swing):
+    cloud = fakecloud.FakeCloud(base, fleet_size, latency, throttle, swing)
+    server = fakecloud.start_server(cloud)
+    endpoint = '%s:%i' % server.server_address
+    metrics_port = free_port()
+    directory = tempfile.mkdtemp()
+    config_path = write_config(base, base_path, directory, endpoint, metrics_port, fleet_size, swing)
+
+    burst_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'burst.py')
+    with open(os.devnull, 'w') as devnull:
+        process = subprocess.Popen([sys.executable, burst_path, '-c', config_path], stdout=devnull, stderr=devnull)
+
+    result = None
+    try:
+        # The first loop warms up connections and the inventory, measure from the second
+        first = None
+        deadline = time.time() + 120 + ticks * (10 + latency * 20)
+        while time.time() < deadline and process.poll() is None:
+            time.sleep(0.5)
+            try:
+                samples = scrape(metrics_port)
+            except (urllib2.URLError, socket.error):
+                continue
+
+            loops = samples.get(('burst_loop_seconds_count', 'cluster="default"'), 0)
+            if first is None and loops >= 1:
+                first = (samples, cloud.call_counts(), loops)
+            if first is not None and loops >= first[2] + ticks:
+                result = measure(first, (samples, cloud.call_counts(), loops), cloud, process.pid)
+                break
+    finally:
+        if process.poll() is None:
+            process.send_signal(signal.SIGINT)
+            process.wait()
+        server.shutdown()
+        shutil.rmtree(directory)
+
+    if result is None:
+        basics.handle_error('burst.py did not complete %i loops with a fleet of %i' % (ticks, fleet_size))
+
+    return result
+
+def measure(first, last, cloud, pid):
+    samples, calls, loops = last
+    ticks = loops - first[2]
+
+    def delta(name, labels):
+        return samples.get((name, labels), 0) - first[0].get((name, labels), 0)
+
+    phases = dict()
+    for name, labels in samples:
+        if name == 'burst_phase_seconds_sum':
+            phase = labels.split('phase="', 1)[1].rstrip('"')
+            count = delta('burst_phase_seconds_count', labels)
+            if count:
+                phases[phase] = delta(name, labels) / count
+
+    return {'ticks': ticks,
+            'loop_seconds': delta('burst_loop_seconds_sum', 'cluster="default"') / ticks,
+            'phases': phases,
+            'calls': dict((c, (calls.get(c, 0) - first[1].get(c, 0)) / float(ticks)) for c in calls),
+            'throttled': cloud.throttled,
+            'peak_memory': peak_memory(pid)}
+
+def print_results(results):
+    print '   |-----------------------------------------------------------------------------------'
+    print '   | Fleet  | Loop s  | Mesos s | Describe s | EC2 calls/loop | Throttled | Peak MB'
+    print '   |-----------------------------------------------------------------------------------'
+    for fleet_size, result in results:
+        describe = max(result['phases'].get('ec2_describe_instances', 0),
+                       result['phases'].get('ec2_describe_spot_requests', 0))
+        print '   | %-6i | %-7.3f | %-7.3f | %-10.3f | %-14.1f | %-9i | %.1f' % (fleet_size,
+                                                                               result['loop_seconds'],
+                                                                               result['phases'].get('mesos_fetch', 0),
+                                                                               describe,
+                                                                               sum(result['calls'].values()),
+                                                                               result['throttled'],
+                                                                               result['peak_memory'] or 0)
+    print '   |-----------------------------------------------------------------------------------'
+
+    for fleet_size, result in results:
+        print '   %i: %s' % (fleet_size, ', '.join('%s %.1f' % (c, n) for c, n in sorted(result['calls'].items())))
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "c:n:t:l:r:s:", ["help","config=","fleet-sizes=","ticks=","latency=","throttle=","swing="])
+    except getopt.GetoptError as e:
+        basics.handle_error(e)
+
+    config_path = 'config.yml'
+    fleet_sizes = [100, 1000, 5000]
+    ticks = 10
+    latency = 0.0
+    throttle = 0.0
+    swing = 0
+    for o,p in opts:
+        if o in ["--help"]:
+            print_usage()
+            exit()
+        elif o in ["-c", "--config"]:
+            config_path = p
+        elif o in ["-n", "--fleet-sizes"]:
+            fleet_sizes = [int(n) for n in p.split(',')]
+        elif o in ["-t", "--ticks"]:
+            ticks = int(p)
+        elif o in ["-l", "--latency"]:
+            latency = float(p)
+        elif o in ["-r", "--throttle"]:
+            throttle = float(p)
+        elif o in ["-s", "--swing"]:
+            swing = int(p)
+
+    with open(config_path, 'r') as configfile:
+        base = yaml.safe_load(configfile)
+
+    results = []
+    for fleet_size in fleet_sizes:
+        results.append((fleet_size, run(base, config_path, fleet_size, ticks, latency, throttle, swing)))
+
+    print_results(results)
+
+if __name__ == '__main__':
+    main()
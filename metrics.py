@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+import threading
+import time
+import BaseHTTPServer
+import SocketServer
+
+# A small OpenMetrics registry and exporter. Only what the control loop needs:
+# gauges, counters and histograms with optional labels, served as text on
+# /metrics.
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+registry = []
+
+def format_labels(labelnames, labels, extra=None):
+    pairs = ['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+             for name, value in zip(labelnames, labels)]
+    if extra:
+        pairs.append('%s="%s"' % extra)
+
+    if not pairs:
+        return ''
+
+    return '{%s}' % ','.join(pairs)
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value))
+
+class Gauge(object):
+    kind = 'gauge'
+    suffix = ''
+
+    def __init__(self, name, documentation, labelnames=(), unit=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.unit = unit
+        self.lock = threading.Lock()
+        self.values = dict()
+        registry.append(self)
+
+    def set(self, value, labels=()):
+        with self.lock:
+            self.values[tuple(labels)] = value
+
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.values[tuple(labels)] = self.values.get(tuple(labels), 0) + amount
+
+    def render(self):
+        lines = ['# TYPE %s %s' % (self.name, self.kind),
+                 '# HELP %s %s' % (self.name, self.documentation)]
+        if self.unit:
+            lines.append('# UNIT %s %s' % (self.name, self.unit))
+
+        with self.lock:
+            for labels in sorted(self.values):
+                lines.append('%s%s%s %s' % (self.name, self.suffix, format_labels(self.labelnames, labels), format_value(self.values[labels])))
+
+        return lines
+
+class Counter(Gauge):
+    """A total that only grows through inc(). Its samples end in _total."""
+
+    kind = 'counter'
+    suffix = '_total'
+
+class Timer(object):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.time() - self.started, self.labels)
+        return False
+
+class Histogram(object):
+    def __init__(self, name, documentation, buckets, labelnames=(), unit=None):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = sorted(buckets) + [float('inf')]
+        self.labelnames = labelnames
+        self.unit = unit
+        self.lock = threading.Lock()
+        self.series = dict()
+        registry.append(self)
+
+    def observe(self, value, labels=()):
+        labels = tuple(labels)
+        with self.lock:
+            if labels not in self.series:
+                self.series[labels] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+
+            series = self.series[labels]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][i] += 1
+                    break
+            series['sum'] += value
+            series['count'] += 1
+
+    def time(self, labels=()):
+        return Timer(self, tuple(labels))
+
+    def render(self):
+        lines = ['# TYPE %s histogram' % self.name,
+                 '# HELP %s %s' % (self.name, self.documentation)]
+        if self.unit:
+            lines.append('# UNIT %s %s' % (self.name, self.unit))
+
+        with self.lock:
+            for labels in sorted(self.series):
+                series = self.series[labels]
+                cumulative = 0
+                for bound, count in zip(self.buckets, series['buckets']):
+                    cumulative += count
+                    lines.append('%s_bucket%s %i' % (self.name,
+                                                     format_labels(self.labelnames, labels, ('le', format_value(bound))),
+                                                     cumulative))
+                lines.append('%s_sum%s %s' % (self.name, format_labels(self.labelnames, labels), format_value(series['sum'])))
+                lines.append('%s_count%s %i' % (self.name, format_labels(self.labelnames, labels), series['count']))
+
+        return lines
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    lines.append('# EOF')
+
+    return '\n'.join(lines) + '\n'
+
+def timed(cluster, phase, function, *args):
+    # For work handed to a thread pool
+    with PHASE_SECONDS.time((cluster, phase)):
+        return function(*args)
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = render()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class MetricsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def start_http_server(port, addr='127.0.0.1'):
+    server = MetricsServer((addr, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server
+
+## The metrics of the control loop
+
+PHASE_SECONDS = Histogram('burst_phase_seconds',
+                          'Time spent in each phase of the control loop',
+                          [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60],
+                          ('cluster', 'phase'), 'seconds')
+LOOP_SECONDS = Histogram('burst_loop_seconds',
+                         'Time used by a sampling loop, excluding the sleep',
+                         [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120],
+                         ('cluster',), 'seconds')
+LOOP_OVERRUNS = Counter('burst_loop_overruns',
+                        'Loops that used more than execution_interval',
+                        ('cluster',))
+LAST_LOOP_OVERRUN = Gauge('burst_last_loop_overrun',
+                          '1 if the last loop used more than execution_interval',
+                          ('cluster',))
+RESOURCES_USED = Gauge('burst_resources_used',
+                       'Resources in use in the Mesos cluster',
+                       ('cluster', 'resource'))
+RESOURCES_PERCENT = Gauge('burst_resources_used_ratio',
+                          'Share of the Mesos cluster resources in use',
+                          ('cluster', 'resource'))
+INSTANCES = Gauge('burst_instances',
+                  'Spot instances by state: desired, active, pending and interrupted',
+                  ('cluster', 'state'))
+BID_PRICE = Gauge('burst_bid_price',
+                  'Current spot bid',
+                  ('cluster', 'instance_type'))
+DECISION = Gauge('burst_scaling_decision',
+                 'Instances added (positive) or removed (negative) by the last decision',
+                 ('cluster',))
+SUPERSEDED = Counter('burst_superseded',
+                     'Snapshots and decisions replaced by newer ones before use, and decisions dropped as stale',
+                     ('cluster', 'kind'))
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+import threading
+
+# The stages of a cluster's loop (sample, decide, act) run in their own
+# threads and hand over work through queues that hold a single item. Only
+# the newest snapshot or decision matters, so a newer item replaces the one
+# still waiting instead of queueing behind it.
+
+class LatestQueue(object):
+    """A queue of at most one item, where put() replaces what is waiting."""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.item = None
+        self.waiting = False
+
+    def put(self, item):
+        # True when it replaced an item that was still waiting
+        with self.condition:
+            replaced = self.waiting
+            self.item = item
+            self.waiting = True
+            self.condition.notify()
+            return replaced
+
+    def get(self, timeout=None):
+        # The waiting item, or None when timeout passes first
+        with self.condition:
+            if timeout is None:
+                while not self.waiting:
+                    self.condition.wait()
+            elif not self.waiting:
+                self.condition.wait(timeout)
+            if not self.waiting:
+                return None
+
+            item = self.item
+            self.item = None
+            self.waiting = False
+            return item
+
+def start_stage(name, target, *args):
+    thread = threading.Thread(target=target, args=args, name=name)
+    thread.daemon = True
+    thread.start()
+
+    return thread
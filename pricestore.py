@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+import sqlite3
+import threading
+import time
+import calendar
+import datetime
+import dateutil.tz
+from bisect import bisect_left,bisect_right
+from math import sqrt
+
+PRODUCT_DESCRIPTION = 'Linux/UNIX (Amazon VPC)'
+
+def to_epoch(timestamp):
+    return calendar.timegm(timestamp.utctimetuple())
+
+def from_epoch(epoch):
+    return datetime.datetime.fromtimestamp(epoch, dateutil.tz.tzutc())
+
+class PriceStore(object):
+    """Spot price history kept in SQLite and mirrored in memory.
+
+    Only entries newer than the last stored timestamp are fetched from EC2, and
+    a series is refreshed at most every refresh_interval seconds. All queries
+    are answered from the in-memory series. Entries older than history_window
+    are dropped from both. The store is shared by the clusters and collector
+    threads, so every method holds the lock, except while EC2 is paged.
+    """
+
+    def __init__(self, path, history_window=7*24*3600, refresh_interval=300, clock=time.time):
+        self.history_window = history_window
+        self.refresh_interval = refresh_interval
+        self.clock = clock
+        self.lock = threading.RLock()
+        self.series = dict()
+        self.last_refresh = dict()
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS spot_prices ('
+                        'availability_zone TEXT, instance_type TEXT, '
+                        'timestamp INTEGER, price REAL, '
+                        'PRIMARY KEY (availability_zone, instance_type, timestamp))')
+        self.db.commit()
+
+    def load(self, avail_zone, instance_type):
+        key = (avail_zone, instance_type)
+        with self.lock:
+            if key in self.series:
+                return self.series[key]
+
+            since = self.clock() - self.history_window
+            rows = self.db.execute('SELECT timestamp, price FROM spot_prices '
+                                   'WHERE availability_zone = ? AND instance_type = ? AND timestamp >= ? '
+                                   'ORDER BY timestamp', (avail_zone, instance_type, since)).fetchall()
+            self.series[key] = ([row[0] for row in rows], [row[1] for row in rows])
+            return self.series[key]
+
+    def refresh(self, ec2client, avail_zone, instance_type, force=False):
+        return self.refresh_many(ec2client, [avail_zone], [instance_type], force)
+
+    def refresh_many(self, ec2client, avail_zones, instance_types, force=False):
+        # The series of every zone and type that is due, in one query. The
+        # lock is not held while EC2 is paged, so reads of other series and
+        # clusters do not wait for a slow or throttled region.
+        with self.lock:
+            now = self.clock()
+            due = [(z, t) for z in avail_zones for t in instance_types
+                   if force or now - self.last_refresh.get((z, t), 0) >= self.refresh_interval]
+            if not due:
+                return False
+
+            # From the oldest of the newest entries, so every series is covered
+            start_time = now
+            latest = dict()
+            for key in due:
+                timestamps, prices = self.load(*key)
+                latest[key] = timestamps[-1] if timestamps else None
+                start_time = min(start_time, timestamps[-1] if timestamps else now - self.history_window)
+
+            # Taken by this refresh, so concurrent ones do not fetch them again
+            previous = dict((key, self.last_refresh.get(key)) for key in due)
+            for key in due:
+                self.last_refresh[key] = now
+
+        request = {'InstanceTypes': sorted(set(t for z, t in due)),
+                   'ProductDescriptions': [PRODUCT_DESCRIPTION],
+                   'StartTime': from_epoch(start_time),
+                   'EndTime': from_epoch(now)}
+        if len(avail_zones) == 1:
+            request['AvailabilityZone'] = avail_zones[0]
+        else:
+            request['Filters'] = [{'Name': 'availability-zone', 'Values': sorted(set(z for z, t in due))}]
+
+        new_entries = dict((key, dict()) for key in due)
+        try:
+            while True:
+                response = ec2client.describe_spot_price_history(**request)
+                for entry in response['SpotPriceHistory']:
+                    key = (entry.get(u'AvailabilityZone') or avail_zones[0], entry.get(u'InstanceType') or instance_types[0])
+                    if key not in new_entries:
+                        continue
+                    timestamp = to_epoch(entry[u'Timestamp'])
+                    if latest[key] is None or timestamp > latest[key]:
+                        new_entries[key][timestamp] = float(entry[u'SpotPrice'])
+
+                if not response.get('NextToken'):
+                    break
+                request['NextToken'] = response['NextToken']
+        except:
+            # Due again, for the next refresh to try
+            with self.lock:
+                for key in due:
+                    if previous[key] is None:
+                        self.last_refresh.pop(key, None)
+                    else:
+                        self.last_refresh[key] = previous[key]
+            raise
+
+        with self.lock:
+            rows = []
+            pruned = False
+            for key in due:
+                timestamps, prices = self.series[key]
+                for timestamp in sorted(new_entries[key]):
+                    # Another refresh may have added entries in the meantime
+                    if not timestamps or timestamp > timestamps[-1]:
+                        timestamps.append(timestamp)
+                        prices.append(new_entries[key][timestamp])
+                        rows.append((key[0], key[1], timestamp, new_entries[key][timestamp]))
+
+                # Drop what has fallen out of the window, keeping the newest entry
+                cutoff = min(bisect_left(timestamps, now - self.history_window), len(timestamps) - 1)
+                if cutoff > 0:
+                    del timestamps[:cutoff]
+                    del prices[:cutoff]
+
+                # The table holds older entries only before the first refresh
+                # of a series and after a cut from memory
+                if timestamps and (cutoff > 0 or previous[key] is None):
+                    self.db.execute('DELETE FROM spot_prices '
+                                    'WHERE availability_zone = ? AND instance_type = ? AND timestamp < ?',
+                                    (key[0], key[1], timestamps[0]))
+                    pruned = True
+
+            if rows:
+                self.db.executemany('INSERT OR IGNORE INTO spot_prices VALUES (?, ?, ?, ?)', rows)
+            if rows or pruned:
+                self.db.commit()
+
+            return len(rows) > 0
+
+    def window(self, avail_zone, instance_type, seconds):
+        with self.lock:
+            timestamps, prices = self.load(avail_zone, instance_type)
+            if not prices:
+                return []
+
+            # Include the price that was in effect when the window started
+            start = max(0, bisect_right(timestamps, self.clock() - seconds) - 1)
+            return prices[start:]
+
+    def current(self, avail_zone, instance_type):
+        with self.lock:
+            timestamps, prices = self.load(avail_zone, instance_type)
+            if not prices:
+                return None
+
+            return prices[-1]
+
+    def minimum(self, avail_zone, instance_type, seconds):
+        prices = self.window(avail_zone, instance_type, seconds)
+        return min(prices) if prices else None
+
+    def mean(self, avail_zone, instance_type, seconds):
+        prices = self.window(avail_zone, instance_type, seconds)
+        return sum(prices) / len(prices) if prices else None
+
+    def percentile(self, avail_zone, instance_type, seconds, percent):
+        prices = sorted(self.window(avail_zone, instance_type, seconds))
+        if not prices:
+            return None
+
+        return prices[min(len(prices) - 1, int(percent * len(prices)))]
+
+    def volatility(self, avail_zone, instance_type, seconds):
+        # Standard deviation relative to the mean, so zones with different
+        # price levels can be compared
+        prices = self.window(avail_zone, instance_type, seconds)
+        if not prices:
+            return None
+
+        mean = sum(prices) / len(prices)
+        if mean == 0:
+            return 0.0
+
+        return sqrt(sum((p - mean)**2 for p in prices) / len(prices)) / mean
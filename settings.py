@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+import basics
+import history
+import difflib
+import os
+import threading
+import yaml
+
+# The configuration is read, checked and frozen once per load. The launch
+# configuration (with its UserData) is parsed at the same time, so spot
+# requests only copy it. ConfigSource watches the files and swaps in a new
+# load between loops; a file that does not load keeps the running config.
+
+REQUIRED = object()
+NUMBER = (int, long, float)
+STRING = basestring
+
+# Setting: (type, REQUIRED or None). Optional settings left out are None,
+# and the code reading them supplies the default.
+SCHEMA = {
+    'aws_access_key_id': (STRING, REQUIRED),
+    'aws_secret_access_key': (STRING, REQUIRED),
+    'default_region': (STRING, REQUIRED),
+    'ec2_endpoint_url': (STRING, None),
+    'execution_interval': (NUMBER, REQUIRED),
+    'mesos_zkurl': (STRING, REQUIRED),
+    'mesos_zk_timeout': (NUMBER, None),
+    'mesos_master': (STRING, None),
+    'marathon_port': (int, REQUIRED),
+    'availability_zone': (STRING, REQUIRED),
+    'availability_zones': (list, None),
+    'zone_spread': (int, None),
+    'zone_volatility_weight': (NUMBER, None),
+    'zone_cooloff': (NUMBER, None),
+    'launch_config': (STRING, None),
+    'name': (STRING, None),
+    'clusters': (list, None),
+    'security_group_id': (STRING, None),
+    'mesos_fetch_timeout': (NUMBER, None),
+    'ec2_fetch_timeout': (NUMBER, None),
+    'ec2_api_rate': (NUMBER, None),
+    'ec2_api_burst': (NUMBER, None),
+    'ec2_api_retries': (int, None),
+    'ec2_api_backoff': (NUMBER, None),
+    'collector_workers': (int, None),
+    'metrics_port': (int, None),
+    'metrics_address': (STRING, None),
+    'event_driven': (bool, None),
+    'event_debounce': (NUMBER, None),
+    'event_min_interval': (NUMBER, None),
+    'baseline_cpus': (NUMBER, REQUIRED),
+    'baseline_mem': (NUMBER, REQUIRED),
+    'baseline_disk': (NUMBER, REQUIRED),
+    'instance_type': (STRING, REQUIRED),
+    'instance_cpus': (NUMBER, REQUIRED),
+    'instance_mem': (NUMBER, REQUIRED),
+    'instance_disk': (NUMBER, REQUIRED),
+    'instance_catalog': (list, None),
+    'maximum_spot_slaves': (int, REQUIRED),
+    'maximum_bid_limit': (NUMBER, REQUIRED),
+    'burst_point_percentage': (NUMBER, REQUIRED),
+    'spot_request_timeout': (NUMBER, REQUIRED),
+    'partial_hour_limit': (NUMBER, REQUIRED),
+    'history_size': (int, None),
+    'history_path': (STRING, None),
+    'decision_window': (NUMBER, None),
+    'decision_statistic': (STRING, None),
+    'drain_agents': (bool, None),
+    'drain_timeout': (NUMBER, None),
+    'warm_pool_size': (int, None),
+    'interruption_notices': (bool, None),
+    'interruption_notice_url': (STRING, None),
+    'journal_path': (STRING, None),
+    'journal_max_bytes': (int, None),
+    'journal_grace': (NUMBER, None),
+    'price_store_path': (STRING, None),
+    'price_refresh_interval': (NUMBER, None),
+    'price_history_window': (NUMBER, None),
+    'bid_percentile': (NUMBER, None),
+    'bid_window': (NUMBER, None),
+    'predictive_scaling': (bool, None),
+    'forecast_alpha': (NUMBER, None),
+    'forecast_beta': (NUMBER, None),
+    'initial_lead_time': (NUMBER, None),
+}
+
+# Set by the loader, not read from the file
+DERIVED = ('multi_cluster', 'launch_specification')
+
+# A required setting that is not needed when its alternative is set
+ALTERNATIVES = {'mesos_zkurl': 'mesos_master'}
+
+CATALOG_KEYS = ['instance_type', 'cpus', 'mem', 'disk']
+ZONE_KEYS = ['availability_zone']
+
+# These are used when the daemon starts (sessions, connections, threads and
+# the state built on them), so a reload leaves them as they are
+RESTART_SETTINGS = ['aws_access_key_id', 'aws_secret_access_key', 'default_region', 'ec2_endpoint_url',
+                    'availability_zones', 'zone_cooloff',
+                    'mesos_zkurl', 'mesos_master', 'mesos_zk_timeout', 'security_group_id',
+                    'ec2_api_rate', 'ec2_api_burst', 'ec2_api_retries', 'ec2_api_backoff',
+                    'history_size', 'history_path', 'journal_path', 'journal_max_bytes',
+                    'collector_workers', 'metrics_port', 'metrics_address', 'event_driven', 'drain_agents',
+                    'interruption_notices',
+                    'price_store_path', 'price_refresh_interval', 'price_history_window',
+                    'predictive_scaling', 'forecast_alpha', 'forecast_beta', 'initial_lead_time']
+
+class ConfigError(Exception):
+    pass
+
+class Config(object):
+    """One cluster's settings, read-only once built.
+
+    Reads like the dict it replaces: config['key'] for settings that must be
+    there and config.get('key', default) for optional ones.
+    """
+
+    __slots__ = tuple(SCHEMA) + DERIVED
+
+    def __init__(self, values):
+        for key in self.__slots__:
+            object.__setattr__(self, key, values.get(key))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('The configuration is read-only')
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self.__slots__ and getattr(self, key) is not None
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None)
+        if value is None:
+            return default
+
+        return value
+
+    def values(self):
+        return dict((key, getattr(self, key)) for key in self.__slots__)
+
+    def replace(self, **changes):
+        values = self.values()
+        values.update(changes)
+        return Config(values)
+
+def read_yaml(path):
+    try:
+        with open(path, 'r') as f:
+            return yaml.safe_load(f)
+    except (IOError, yaml.YAMLError) as e:
+        raise ConfigError('Could not read %s: %s' % (path, e))
+
+def check_settings(values, path, required=True):
+    if not isinstance(values, dict):
+        raise ConfigError('%s must be a mapping of settings' % path)
+
+    for key in values:
+        if key not in SCHEMA:
+            close = difflib.get_close_matches(str(key), SCHEMA.keys(), 1)
+            raise ConfigError('Unknown setting %s in %s%s' % (key, path, ', did you mean %s?' % close[0] if close else ''))
+
+    for key in SCHEMA:
+        kind, requirement = SCHEMA[key]
+        value = values.get(key)
+        if value is None:
+            if required and requirement is REQUIRED and not values.get(ALTERNATIVES.get(key)):
+                raise ConfigError('%s has not been set in %s' % (key, path))
+            continue
+
+        # yaml reads true/false as bool, which is also an int
+        if not isinstance(value, kind) or (isinstance(value, bool) and kind is not bool):
+            raise ConfigError('%s in %s has the wrong type: %r' % (key, path, value))
+
+    for instance in values.get('instance_catalog') or []:
+        if not isinstance(instance, dict) or any(k not in instance for k in CATALOG_KEYS):
+            raise ConfigError('Every instance_catalog entry in %s needs %s' % (path, ', '.join(CATALOG_KEYS)))
+
+    for zone in values.get('availability_zones') or []:
+        if not isinstance(zone, dict) or any(k not in zone for k in ZONE_KEYS):
+            raise ConfigError('Every availability_zones entry in %s needs %s' % (path, ', '.join(ZONE_KEYS)))
+
+    if values.get('decision_statistic') is not None:
+        try:
+            history.parse_statistic(values['decision_statistic'])
+        except ValueError as e:
+            raise ConfigError('decision_statistic in %s: %s' % (path, e))
+
+def read_launch_specification(path):
+    specification = read_yaml(path)
+    if not isinstance(specification, dict) or not specification.get('ImageId'):
+        raise ConfigError('%s must be a mapping with at least ImageId' % path)
+
+    return specification
+
+def resolve(config_path, path):
+    # Relative to the directory of the config file
+    return os.path.join(os.path.dirname(config_path), path)
+
+def load(config_path):
+    """Returns the Config of every cluster in config_path, in file order."""
+
+    values = read_yaml(config_path)
+    check_settings(values, config_path, required=not (isinstance(values, dict) and values.get('clusters')))
+
+    if values.get('clusters'):
+        entries = []
+        for overrides in values['clusters']:
+            check_settings(overrides, '%s (clusters)' % config_path, required=False)
+            if not overrides.get('name'):
+                raise ConfigError('Every entry in clusters needs a name')
+            if 'clusters' in overrides:
+                raise ConfigError('clusters can not be nested')
+
+            merged = dict((key, values[key]) for key in values if key != 'clusters')
+            merged.update(overrides)
+            entries.append(merged)
+
+        names = [entry['name'] for entry in entries]
+        if len(set(names)) != len(names):
+            raise ConfigError('The cluster names in %s are not unique' % config_path)
+    else:
+        merged = dict(values)
+        merged.setdefault('name', 'default')
+        entries = [merged]
+
+    # Each launch configuration is read once, however many clusters use it
+    specifications = dict()
+    configs = []
+    for entry in entries:
+        check_settings(entry, '%s (cluster %s)' % (config_path, entry['name']))
+        entry['multi_cluster'] = bool(values.get('clusters'))
+        launch_path = resolve(config_path, entry.get('launch_config') or 'launch_config.yml')
+        if launch_path not in specifications:
+            specifications[launch_path] = read_launch_specification(launch_path)
+        entry['launch_config'] = launch_path
+        entry['launch_specification'] = specifications[launch_path]
+        configs.append(Config(entry))
+
+    return configs
+
+class FileWatcher(object):
+    """Tells whether any of the files changed since the last call to changed().
+
+    Uses inotify on the files' directories when pyinotify is available, as
+    editors often replace a file rather than write to it. Otherwise compares
+    modification times, which is one stat per file and call.
+    """
+
+    def __init__(self, paths):
+        self.paths = set(os.path.abspath(p) for p in paths)
+        self.modified = self.modification_times()
+        self.event = None
+        self.notifier = None
+
+        try:
+            import pyinotify
+        except ImportError:
+            return
+
+        watched = self.paths
+        event = threading.Event()
+
+        class Handler(pyinotify.ProcessEvent):
+            def process_default(self, notification):
+                if notification.pathname in watched:
+                    event.set()
+
+        try:
+            manager = pyinotify.WatchManager()
+            self.notifier = pyinotify.ThreadedNotifier(manager, Handler())
+            self.notifier.daemon = True
+            mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_CREATE
+            for directory in set(os.path.dirname(p) for p in self.paths):
+                manager.add_watch(directory, mask)
+            self.notifier.start()
+            self.event = event
+        except Exception as e:
+            basics.write_to_syslog('info', 'Watching the configuration by modification time: %s' % e)
+            self.notifier = None
+
+    def modification_times(self):
+        times = dict()
+        for path in self.paths:
+            try:
+                times[path] = os.stat(path).st_mtime
+            except OSError:
+                times[path] = None
+
+        return times
+
+    def stop(self):
+        if self.notifier is not None:
+            self.notifier.stop()
+
+    def changed(self):
+        if self.event is not None:
+            if not self.event.is_set():
+                return False
+            self.event.clear()
+            return True
+
+        modified = self.modification_times()
+        if modified == self.modified:
+            return False
+
+        self.modified = modified
+        return True
+
+class ConfigSource(object):
+    """The current Config of each cluster, reloaded when the files change.
+
+    refresh() is called between loops. A new load is swapped in whole. A load
+    that fails keeps the running configuration, and settings that only take
+    effect at startup keep their running values.
+    """
+
+    def __init__(self, config_path, watch=True):
+        self.config_path = config_path
+        self.lock = threading.Lock()
+        self.configs = load(config_path)
+        self.watcher = FileWatcher(self.files()) if watch else None
+
+    def files(self):
+        return [self.config_path] + list(set(c['launch_config'] for c in self.configs))
+
+    def clusters(self):
+        return list(self.configs)
+
+    def cluster(self, name):
+        for config in self.configs:
+            if config['name'] == name:
+                return config
+
+        raise KeyError(name)
+
+    def refresh(self):
+        with self.lock:
+            if self.watcher is None or not self.watcher.changed():
+                return False
+
+            try:
+                loaded = dict((c['name'], c) for c in load(self.config_path))
+            except ConfigError as e:
+                basics.write_to_syslog('error', 'Keeping the running configuration: %s' % e)
+                return False
+
+            configs = []
+            for running in self.configs:
+                if running['name'] not in loaded:
+                    basics.write_to_syslog('error', 'Cluster %s was removed from %s, it keeps running until restart' %
+                                           (running['name'], self.config_path))
+                    configs.append(running)
+                    continue
+
+                config = loaded.pop(running['name'])
+                kept = dict((key, running[key]) for key in RESTART_SETTINGS if config[key] != running[key])
+                if kept:
+                    basics.write_to_syslog('info', 'Restart to change %s for cluster %s' %
+                                           (', '.join(sorted(kept)), running['name']))
+                    config = config.replace(**kept)
+                configs.append(config)
+
+            for name in loaded:
+                basics.write_to_syslog('error', 'Restart to start the new cluster %s' % name)
+
+            self.configs = configs
+
+            # Follow launch configurations that were added
+            if set(os.path.abspath(p) for p in self.files()) - self.watcher.paths:
+                self.watcher.stop()
+                self.watcher = FileWatcher(self.files())
+
+            return True
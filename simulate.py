@@ -0,0 +1,552 @@
+#!/usr/bin/env python
+import burst
+import pricestore
+import forecast
+import inventory
+import warmpool
+import interruptions
+import history
+import basics
+import getopt
+import sys
+import time
+import datetime
+import json
+import base64
+import dateutil.tz
+import dateutil.parser
+from math import floor
+from bisect import bisect_right
+
+# Offline replay of recorded Mesos metrics and spot prices through the real
+# decision code in burst.py. EC2 is replaced by an in-memory fake that runs on
+# a virtual clock, so hours of traces replay in seconds.
+
+def print_usage():
+    print "Trace-driven simulator for the cloud bursting policy\n"
+    print "usage: " + __file__ + " [arguments] <metrics trace> <price trace>\n"
+    print "Arguments:"
+    print "   --help\t\t\t Prints this help message"
+    print "   -v [--verbose]\t\t Verbose output from burst.py"
+    print "   -c [--config]\t\t Specify another config file"
+    print "   -b [--boot-delay]\t\t Seconds from launch until the agent is registered (default 300)"
+    print "   -f [--fulfil-delay]\t\t Seconds from request until the instance launches (default 60)"
+    print ""
+    print "The metrics trace has one /metrics/snapshot JSON object per line, with an"
+    print "extra 'timestamp' key holding epoch seconds. The price trace is the JSON"
+    print "output of 'aws ec2 describe-spot-price-history'."
+
+def to_epoch(timestamp):
+    if isinstance(timestamp, (int, long, float)):
+        return float(timestamp)
+
+    parsed = dateutil.parser.parse(timestamp)
+    epoch = datetime.datetime(1970, 1, 1, tzinfo=dateutil.tz.tzutc())
+    return (parsed - epoch).total_seconds()
+
+def load_metrics_trace(path):
+    trace = []
+    with open(path, 'r') as tracefile:
+        for line in tracefile:
+            if line.strip():
+                sample = json.loads(line)
+                sample['timestamp'] = to_epoch(sample['timestamp'])
+                trace.append(sample)
+
+    return sorted(trace, key=lambda sample: sample['timestamp'])
+
+def load_price_trace(path):
+    with open(path, 'r') as tracefile:
+        data = json.load(tracefile)
+
+    if isinstance(data, dict):
+        data = data['SpotPriceHistory']
+
+    prices = [(to_epoch(entry['Timestamp']), float(entry['SpotPrice'])) for entry in data]
+    return sorted(prices)
+
+class VirtualClock(object):
+    def __init__(self, now):
+        self.now = now
+
+    def datetime(self):
+        return datetime.datetime.fromtimestamp(self.now, dateutil.tz.tzutc())
+
+class FakeInstance(object):
+    def __init__(self, instance_id, instance_type, request_id, launch_time, launched_at, ready_at, bid):
+        self.instance_id = instance_id
+        self.instance_type = instance_type
+        self.request_id = request_id
+        self.launch_time = launch_time
+        self.launched_at = launched_at
+        self.private_ip_address = '10.1.%i.%i' % (int(instance_id[2:], 16) / 256 % 256, int(instance_id[2:], 16) % 256)
+        self.ready_at = ready_at
+        self.bid = bid
+        self.state = {'Name': 'pending'}
+        self.zone = None
+        self.lifecycle = 'spot'
+        self.tags = dict()
+        self.power_off_at = None
+        self.reclaim_at = None
+        self.billed_hours = 0
+        self.hour_price = 0.0
+
+def filter_values(kwargs, name):
+    for request_filter in kwargs.get('Filters', []):
+        if request_filter['Name'] == name:
+            return request_filter['Values']
+
+    return None
+
+def paginate(items, key, kwargs):
+    offset = int(kwargs.get('NextToken', 0))
+    page_size = kwargs.get('MaxResults', 1000)
+    response = {key: items[offset:offset + page_size]}
+    if offset + page_size < len(items):
+        response['NextToken'] = str(offset + page_size)
+
+    return response
+
+class FakeEC2(object):
+    """Client side of the EC2 API as used by burst.py, backed by a price trace.
+
+    Zones in zone_prices follow their own trace, all others the shared one.
+    On-demand instances (the warm pool) cost on_demand_price an hour, billed
+    by the second while not stopped, and take start_delay to start again.
+    Outbid spot instances are reclaimed interruption_notice seconds after
+    their request is marked for termination.
+    """
+
+    def __init__(self, clock, prices, fulfil_delay, boot_delay, zone_prices=None, on_demand_price=0.1, start_delay=45,
+                 interruption_notice=120):
+        self.clock = clock
+        self.prices = prices
+        self.zone_prices = zone_prices or dict()
+        self.fulfil_delay = fulfil_delay
+        self.boot_delay = boot_delay
+        self.on_demand_price = on_demand_price
+        self.start_delay = start_delay
+        self.interruption_notice = interruption_notice
+        self.last_advance = clock.now
+        self.requests = []
+        self.instances = dict()
+        self.price_index = 0
+        self.next_id = 0
+        self.tokens = dict()
+
+        self.cost = 0.0
+        self.placed = 0
+        self.cancelled = 0
+        self.terminated = 0
+        self.interrupted = 0
+        self.calls = dict()
+
+    def count_call(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def new_id(self, prefix):
+        self.next_id += 1
+        return '%s-%08x' % (prefix, self.next_id)
+
+    def current_price(self):
+        while (self.price_index + 1 < len(self.prices) and
+               self.prices[self.price_index + 1][0] <= self.clock.now):
+            self.price_index += 1
+
+        return self.prices[self.price_index]
+
+    def zone_price_index(self, zone):
+        if zone not in self.zone_prices:
+            self.current_price()
+            return self.prices, self.price_index
+
+        series = self.zone_prices[zone]
+        return series, max(0, bisect_right([p[0] for p in series], self.clock.now) - 1)
+
+    def zone_price(self, zone, shared_price):
+        if zone not in self.zone_prices:
+            return shared_price
+
+        series, index = self.zone_price_index(zone)
+        return series[index][1]
+
+    def running(self):
+        return [i for i in self.instances.values() if i.state['Name'] == 'running']
+
+    def advance(self):
+        now = self.clock.now
+        price = self.current_price()[1]
+
+        # Fulfil open requests that bid at or above the market
+        for request in self.requests:
+            zone = request['LaunchSpecification'].get('Placement', {}).get('AvailabilityZone')
+            if (request['State'] == 'open' and float(request['SpotPrice']) >= self.zone_price(zone, price) and
+                now - request['CreateEpoch'] >= self.fulfil_delay):
+                instance = FakeInstance(self.new_id('i'),
+                                        request['LaunchSpecification'].get('InstanceType'),
+                                        request['SpotInstanceRequestId'],
+                                        self.clock.datetime(),
+                                        now,
+                                        now + self.boot_delay,
+                                        float(request['SpotPrice']))
+                instance.zone = zone
+                self.instances[instance.instance_id] = instance
+                request['State'] = 'active'
+                request['InstanceId'] = instance.instance_id
+
+        for instance in self.instances.values():
+            if instance.state['Name'] in ['terminated', 'stopped']:
+                continue
+
+            if instance.lifecycle is None:
+                self.advance_on_demand(instance, now)
+                continue
+
+            # Reclaimed by AWS when outbid, after a notice on the request. The
+            # partial hour is not charged.
+            instance_price = self.zone_price(instance.zone, price)
+            if instance.reclaim_at is None and instance_price > instance.bid:
+                instance.reclaim_at = now + self.interruption_notice
+                self.mark_request(instance, 'marked-for-termination')
+            if instance.reclaim_at is not None and now >= instance.reclaim_at:
+                self.stop_instance(instance, 'instance-terminated-by-price')
+                self.cost -= instance.hour_price
+                self.interrupted += 1
+                continue
+
+            if instance.state['Name'] == 'pending' and now >= instance.ready_at:
+                instance.state = {'Name': 'running'}
+
+            # Every started instance hour is charged at the price when it starts
+            hours = int(floor((now - instance.launched_at) / 3600)) + 1
+            while instance.billed_hours < hours:
+                instance.billed_hours += 1
+                instance.hour_price = instance_price
+                self.cost += instance_price
+
+        self.last_advance = now
+
+    def advance_on_demand(self, instance, now):
+        self.cost += self.on_demand_price * (now - max(self.last_advance, instance.launched_at)) / 3600.0
+
+        # A pool instance powers itself off once bootstrapped
+        if instance.power_off_at is not None and now >= instance.power_off_at:
+            instance.state = {'Name': 'stopped'}
+            instance.power_off_at = None
+        elif instance.state['Name'] == 'pending' and now >= instance.ready_at:
+            instance.state = {'Name': 'running'}
+
+    def mark_request(self, instance, status):
+        for request in self.requests:
+            if request['SpotInstanceRequestId'] == instance.request_id:
+                request['Status'] = {'Code': status, 'UpdateTime': self.clock.datetime()}
+
+    def stop_instance(self, instance, status):
+        instance.state = {'Name': 'terminated'}
+        self.mark_request(instance, status)
+        for request in self.requests:
+            if request['SpotInstanceRequestId'] == instance.request_id:
+                request['State'] = 'closed'
+
+    def instance_actions(self):
+        # The spot/instance-action metadata of the instances with a notice
+        return dict((i.instance_id, {'action': 'terminate', 'time': pricestore.from_epoch(i.reclaim_at).strftime('%Y-%m-%dT%H:%M:%SZ')})
+                    for i in self.instances.values() if i.reclaim_at is not None and i.state['Name'] != 'terminated')
+
+    ## The calls used by burst.py
+
+    def describe_spot_price_history(self, **kwargs):
+        self.count_call('describe_spot_price_history')
+        entries = []
+        for zone in filter_values(kwargs, 'availability-zone') or [kwargs.get('AvailabilityZone', '')]:
+            series, index = self.zone_price_index(zone)
+            if 'StartTime' in kwargs:
+                # Every entry in effect between StartTime and now, newest first
+                start = pricestore.to_epoch(kwargs['StartTime'])
+                first = max(0, bisect_right([p[0] for p in series], start) - 1)
+                history = series[first:index + 1][::-1]
+            else:
+                history = [series[index]]
+
+            # Every instance type follows the zone's trace
+            for instance_type in kwargs.get('InstanceTypes', ['']):
+                entries.extend({'SpotPrice': '%.6f' % price,
+                                'Timestamp': pricestore.from_epoch(timestamp),
+                                'InstanceType': instance_type,
+                                'AvailabilityZone': zone,
+                                'ProductDescription': 'Linux/UNIX (Amazon VPC)'} for timestamp, price in history)
+        return paginate(entries, 'SpotPriceHistory', kwargs)
+
+    def describe_spot_instance_requests(self, **kwargs):
+        self.count_call('describe_spot_instance_requests')
+        states = filter_values(kwargs, 'state')
+        requests = [dict(r) for r in self.requests if states is None or r['State'] in states]
+        return paginate(requests, 'SpotInstanceRequests', kwargs)
+
+    def describe_instances(self, **kwargs):
+        self.count_call('describe_instances')
+        states = filter_values(kwargs, 'instance-state-name')
+        lifecycles = filter_values(kwargs, 'instance-lifecycle')
+        tags = [(f['Name'][4:], f['Values']) for f in kwargs.get('Filters', []) if f['Name'].startswith('tag:')]
+        instances = [{'InstanceId': i.instance_id,
+                      'InstanceType': i.instance_type,
+                      'LaunchTime': i.launch_time,
+                      'PrivateIpAddress': i.private_ip_address,
+                      'SpotInstanceRequestId': i.request_id,
+                      'InstanceLifecycle': i.lifecycle,
+                      'Tags': [{'Key': k, 'Value': v} for k, v in i.tags.items()],
+                      'State': dict(i.state)} for i in self.instances.values()
+                     if (states is None or i.state['Name'] in states) and
+                        (lifecycles is None or i.lifecycle in lifecycles) and
+                        all(i.tags.get(k) in values for k, values in tags)]
+        response = paginate(instances, 'Instances', kwargs)
+        response['Reservations'] = [{'Instances': response.pop('Instances')}]
+        return response
+
+    def request_spot_instances(self, SpotPrice, InstanceCount, LaunchSpecification, ClientToken=None, **kwargs):
+        self.count_call('request_spot_instances')
+        # Like EC2, the same ClientToken again returns the requests it placed
+        if ClientToken is not None and ClientToken in self.tokens:
+            return {'SpotInstanceRequests': [dict(r) for r in self.tokens[ClientToken]]}
+
+        created = []
+        for i in range(InstanceCount):
+            request = {'SpotInstanceRequestId': self.new_id('sir'),
+                       'SpotPrice': '%.6f' % float(SpotPrice),
+                       'State': 'open',
+                       'CreateTime': self.clock.datetime(),
+                       'CreateEpoch': self.clock.now,
+                       'LaunchSpecification': LaunchSpecification}
+            self.requests.append(request)
+            created.append(dict(request))
+            self.placed += 1
+
+        if ClientToken is not None:
+            self.tokens[ClientToken] = created
+
+        return {'SpotInstanceRequests': created}
+
+    def cancel_spot_instance_requests(self, SpotInstanceRequestIds):
+        self.count_call('cancel_spot_instance_requests')
+        for request in self.requests:
+            if (request['SpotInstanceRequestId'] in SpotInstanceRequestIds and
+                request['State'] == 'open'):
+                request['State'] = 'cancelled'
+                self.cancelled += 1
+
+        return {'CancelledSpotInstanceRequests': [{'SpotInstanceRequestId': i} for i in SpotInstanceRequestIds]}
+
+    def terminate_instances(self, InstanceIds):
+        self.count_call('terminate_instances')
+        for instance_id in InstanceIds:
+            instance = self.instances[instance_id]
+            if instance.state['Name'] != 'terminated':
+                self.stop_instance(instance, 'instance-terminated-by-user')
+                self.terminated += 1
+
+        return {'TerminatingInstances': [{'InstanceId': i} for i in InstanceIds]}
+
+    def run_instances(self, MinCount, MaxCount, InstanceType, UserData=None, TagSpecifications=None, ClientToken=None, **kwargs):
+        self.count_call('run_instances')
+        if ClientToken is not None and ClientToken in self.tokens:
+            return self.tokens[ClientToken]
+
+        # boto3 sends UserData base64 encoded
+        script = UserData or ''
+        try:
+            script = base64.b64decode(script)
+        except TypeError:
+            pass
+
+        launched = []
+        for i in range(MaxCount):
+            instance = FakeInstance(self.new_id('i'), InstanceType, None, self.clock.datetime(),
+                                    self.clock.now, self.clock.now + self.boot_delay, 0.0)
+            instance.lifecycle = None
+            for specification in TagSpecifications or []:
+                instance.tags.update((tag['Key'], tag['Value']) for tag in specification['Tags'])
+            if 'shutdown -h now' in script:
+                instance.power_off_at = instance.ready_at
+            self.instances[instance.instance_id] = instance
+            launched.append({'InstanceId': instance.instance_id, 'State': dict(instance.state)})
+
+        response = {'ReservationId': self.new_id('r'), 'Instances': launched}
+        if ClientToken is not None:
+            self.tokens[ClientToken] = response
+
+        return response
+
+    def start_instances(self, InstanceIds):
+        self.count_call('start_instances')
+        for instance_id in InstanceIds:
+            instance = self.instances[instance_id]
+            if instance.state['Name'] == 'stopped':
+                instance.state = {'Name': 'pending'}
+                instance.launched_at = self.clock.now
+                instance.ready_at = self.clock.now + self.start_delay
+
+        return {'StartingInstances': [{'InstanceId': i} for i in InstanceIds]}
+
+    def stop_instances(self, InstanceIds):
+        self.count_call('stop_instances')
+        for instance_id in InstanceIds:
+            instance = self.instances[instance_id]
+            if instance.state['Name'] in ['pending', 'running']:
+                instance.state = {'Name': 'stopped'}
+
+        return {'StoppingInstances': [{'InstanceId': i} for i in InstanceIds]}
+
+    def create_tags(self, Resources, Tags):
+        self.count_call('create_tags')
+        for instance_id in Resources:
+            self.instances[instance_id].tags.update((tag['Key'], tag['Value']) for tag in Tags)
+
+        return {}
+
+def metrics_at(trace, index, now):
+    while index + 1 < len(trace) and trace[index + 1]['timestamp'] <= now:
+        index += 1
+
+    return index
+
+def simulate(config, metrics, prices, fulfil_delay=60, boot_delay=300):
+    clock = VirtualClock(metrics[0]['timestamp'])
+    ec2 = FakeEC2(clock, prices, fulfil_delay, boot_delay)
+    ec2_inventory = inventory.Inventory()
+    price_store = pricestore.PriceStore(':memory:',
+                                        config.get('price_history_window', 7*24*3600),
+                                        config.get('price_refresh_interval', 300),
+                                        lambda: clock.now)
+    if config.get('predictive_scaling', False):
+        forecaster = forecast.HoltForecaster(config.get('forecast_alpha', 0.5),
+                                             config.get('forecast_beta', 0.2))
+        lead_tracker = forecast.LeadTimeTracker(config.get('initial_lead_time', 300), clock.now)
+    readings = history.RingBuffer(config.get('history_size', 512))
+    windows = dict()
+    interval = config['execution_interval']
+    burst_point = config['burst_point_percentage']
+
+    result = {'ticks': 0,
+              'simulated_seconds': 0,
+              'seconds_above_burst_point': 0,
+              'peak_instances': 0}
+
+    started = time.time()
+    index = 0
+    while clock.now <= metrics[-1]['timestamp']:
+        ec2.advance()
+        index = metrics_at(metrics, index, clock.now)
+        sample = metrics[index]
+
+        # Recorded usage is the demand. Mesos can not hand out more than the
+        # baseline plus the registered spot agents.
+        running = len(ec2.running())
+        resources_in_use = dict()
+        current_percent_in_use = dict()
+        above = False
+        for resource in ['cpus', 'mem', 'disk']:
+            capacity = config['baseline_%s' % resource] + running * config['instance_%s' % resource]
+            demand = float(sample[u'master/%s_used' % resource])
+            resources_in_use[resource] = min(demand, capacity)
+            current_percent_in_use[resource] = resources_in_use[resource] / capacity
+            if demand / capacity >= burst_point:
+                above = True
+
+        snapshot = {'resources_in_use': resources_in_use,
+                    'current_percent_in_use': current_percent_in_use}
+        ec2_inventory.update(inventory.fetch_spot_requests(ec2), inventory.fetch_spot_instances(ec2))
+        snapshot['cur_slaves'] = ec2_inventory.spot_instances()
+        snapshot['cur_spot_requests'] = ec2_inventory.spot_requests()
+        snapshot['cur_open_spot_requests'] = ec2_inventory.open_request_ids()
+        if config.get('warm_pool_size'):
+            burst.add_warm_pool(snapshot, warmpool.fetch_pool_instances(ec2, config['name']), config['warm_pool_size'])
+        if config.get('interruption_notices', False):
+            burst.add_interruptions(snapshot, interruptions.request_notices(snapshot['cur_spot_requests']))
+        snapshot['bid'] = burst.fetch_current_price(ec2,
+                                                    config['availability_zone'],
+                                                    config['instance_type'],
+                                                    config['maximum_bid_limit'],
+                                                    price_store,
+                                                    config.get('bid_percentile'),
+                                                    config.get('bid_window', 3600))
+
+        burst.record_history(readings, snapshot, clock.now)
+        if config.get('decision_window') and not config.get('predictive_scaling', False):
+            resources_in_use = burst.get_window_resources(readings,
+                                                          windows,
+                                                          config['decision_window'],
+                                                          config.get('decision_statistic', 'p90'))
+
+        if config.get('predictive_scaling', False):
+            snapshot['registered_ips'] = set(i.private_ip_address for i in ec2.running())
+            resources_in_use = burst.get_forecast_resources(forecaster, lead_tracker, snapshot, clock.now)
+
+        slaves_to_adjust = burst.get_scaling_decision(resources_in_use,
+                                                      current_percent_in_use,
+                                                      len(burst.serving_instances(snapshot)),
+                                                      len(snapshot['cur_open_spot_requests']),
+                                                      config)
+        desired_slaves = len(snapshot['cur_open_spot_requests']) + len(snapshot['cur_slaves']) + slaves_to_adjust
+        burst.execute_scaling_decision(ec2, snapshot, desired_slaves, config, clock.datetime())
+        burst.fill_warm_pool(ec2, snapshot, config)
+
+        result['ticks'] += 1
+        result['simulated_seconds'] += interval
+        if above:
+            result['seconds_above_burst_point'] += interval
+        result['peak_instances'] = max(result['peak_instances'], len(snapshot['cur_slaves']))
+
+        clock.now += interval
+
+    result['wall_seconds'] = time.time() - started
+    result['cost'] = ec2.cost
+    result['requests_placed'] = ec2.placed
+    result['requests_cancelled'] = ec2.cancelled
+    result['instances_terminated'] = ec2.terminated
+    result['instances_interrupted'] = ec2.interrupted
+    result['churn'] = ec2.placed + ec2.cancelled + ec2.terminated + ec2.interrupted
+    result['api_calls'] = ec2.calls
+
+    return result
+
+def print_result(result):
+    print '   |------------------------------------------'
+    print '   | Simulated time            | %.1f hours   ' % (result['simulated_seconds'] / 3600.0)
+    print '   | Wall time                 | %.2f seconds ' % result['wall_seconds']
+    print '   | Cost                      | %.4f         ' % result['cost']
+    print '   | Time above burst point    | %.1f%%       ' % (100.0 * result['seconds_above_burst_point'] / max(1, result['simulated_seconds']))
+    print '   | Peak instances            | %i           ' % result['peak_instances']
+    print '   | Requests placed           | %i           ' % result['requests_placed']
+    print '   | Requests cancelled        | %i           ' % result['requests_cancelled']
+    print '   | Instances terminated      | %i           ' % result['instances_terminated']
+    print '   | Instances interrupted     | %i           ' % result['instances_interrupted']
+    print '   | Churn                     | %i           ' % result['churn']
+    print '   |------------------------------------------'
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "vc:b:f:", ["verbose","help","config=","boot-delay=","fulfil-delay="])
+    except getopt.GetoptError as e:
+        basics.handle_error(e)
+
+    burst.set_options([o for o in opts if o[0] in ["-v", "--verbose", "-c", "--config", "--help"]])
+    boot_delay = 300
+    fulfil_delay = 60
+    for o,p in opts:
+        if o in ["-b", "--boot-delay"]:
+            boot_delay = int(p)
+        elif o in ["-f", "--fulfil-delay"]:
+            fulfil_delay = int(p)
+
+    if len(args) != 2:
+        print_usage()
+        exit(1)
+
+    config = burst.import_config().clusters()[0]
+    metrics = load_metrics_trace(args[0])
+    prices = load_price_trace(args[1])
+
+    print_result(simulate(config, metrics, prices, fulfil_delay, boot_delay))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+import datetime
+import unittest
+
+import dateutil.tz
+
+import burst
+import drain
+
+NOW = datetime.datetime(2017, 9, 18, 12, 0, tzinfo=dateutil.tz.tzutc())
+
+class Instance(object):
+    def __init__(self, instance_id, ip, minutes):
+        self.instance_id = instance_id
+        self.private_ip_address = ip
+        self.launch_time = NOW - datetime.timedelta(minutes=minutes)
+
+def agent(ip, cpus_used):
+    return {u'id': 'agent-%s' % ip, u'hostname': ip, u'pid': 'slave(1)@%s:5051' % ip,
+            u'resources': {u'cpus': 4, u'mem': 16384, u'disk': 32000},
+            u'used_resources': {u'cpus': cpus_used, u'mem': 0, u'disk': 0}}
+
+class VictimTest(unittest.TestCase):
+    def setUp(self):
+        burst.verbose = False
+        # Past the partial hour limit of 0 seconds, at different points of their hour
+        self.instances = [Instance('i-old', '10.0.0.1', 130),
+                          Instance('i-hour-end', '10.0.0.2', 58),
+                          Instance('i-new', '10.0.0.3', 20)]
+
+    def victims(self, count, agents=None, drainer=None):
+        return [i.instance_id for i in burst.get_termination_victims(self.instances, count, 0, NOW, agents, drainer)]
+
+    def test_oldest_first_without_agent_data(self):
+        self.assertEqual(self.victims(2), ['i-old', 'i-hour-end'])
+
+    def test_least_allocated_then_billing_position_with_agent_data(self):
+        agents = drain.agents_by_ip([agent('10.0.0.1', 3), agent('10.0.0.2', 0), agent('10.0.0.3', 0)])
+        self.assertEqual(self.victims(2, agents), ['i-hour-end', 'i-new'])
+
+    def test_draining_instances_go_first(self):
+        drainer = drain.Drainer(None)
+        drainer.select([self.instances[2]], None, 600, 0)
+        self.assertEqual(self.victims(1, None, drainer), ['i-new'])
+
+if __name__ == '__main__':
+    unittest.main()
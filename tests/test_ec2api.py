@@ -0,0 +1,54 @@
+import unittest
+
+from botocore.exceptions import ClientError
+
+import ec2api
+
+def throttling():
+    return ClientError({'Error': {'Code': 'RequestLimitExceeded', 'Message': 'slow down'}}, 'DescribeSpotPriceHistory')
+
+class FlakyClient(object):
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    def describe_spot_price_history(self, **kwargs):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise throttling()
+        return {'SpotPriceHistory': []}
+
+class TokenBucketTest(unittest.TestCase):
+    def test_throttling_lowers_the_rate_once_a_second(self):
+        bucket = ec2api.TokenBucket(8, 8)
+        bucket.throttled()
+        bucket.throttled()
+        self.assertEqual(bucket.rate, 4)
+        self.assertTrue(bucket.tokens <= 0)
+
+        bucket.slowed -= 1
+        bucket.throttled()
+        self.assertEqual(bucket.rate, 2)
+
+    def test_successful_calls_restore_the_rate(self):
+        bucket = ec2api.TokenBucket(8, 8)
+        bucket.rate = bucket.min_rate
+        for i in range(30):
+            bucket.succeeded()
+        self.assertEqual(bucket.rate, 8)
+
+    def test_throttled_calls_slow_the_shared_bucket(self):
+        bucket = ec2api.TokenBucket(1000, 1000)
+        client = ec2api.ThrottledClient(FlakyClient(2), bucket, backoff=0.001)
+        self.assertEqual(client.describe_spot_price_history(), {'SpotPriceHistory': []})
+        self.assertEqual(client.client.calls, 3)
+        self.assertTrue(bucket.rate < 1000)
+
+    def test_throttling_that_outlasts_the_retries_is_raised(self):
+        bucket = ec2api.TokenBucket(1000, 1000)
+        client = ec2api.ThrottledClient(FlakyClient(10), bucket, retries=2, backoff=0.001)
+        self.assertRaises(ClientError, client.describe_spot_price_history)
+        self.assertEqual(client.client.calls, 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import time
+import unittest
+
+import fleet
+
+CATALOG = [{'instance_type': 'm3.large', 'cpus': 2, 'mem': 7500, 'disk': 32000},
+           {'instance_type': 'r3.large', 'cpus': 2, 'mem': 15250, 'disk': 32000},
+           {'instance_type': 'c3.xlarge', 'cpus': 4, 'mem': 7500, 'disk': 80000},
+           {'instance_type': 'm3.xlarge', 'cpus': 4, 'mem': 15000, 'disk': 80000},
+           {'instance_type': 'r3.xlarge', 'cpus': 4, 'mem': 30500, 'disk': 80000}]
+PRICES = {'m3.large': 0.0173, 'r3.large': 0.0311, 'c3.xlarge': 0.0419, 'm3.xlarge': 0.0357, 'r3.xlarge': 0.0627}
+
+def covered(deficit, mix):
+    by_type = dict((t['instance_type'], t) for t in CATALOG)
+    return all(sum(n * by_type[t][r] for t, n in mix.items()) > deficit[r] for r in fleet.RESOURCES)
+
+class CheapestMixTest(unittest.TestCase):
+    def test_memory_heavy_deficit_buys_memory(self):
+        deficit = {'cpus': 1.0, 'mem': 30000.0, 'disk': 1000.0}
+        mix = fleet.cheapest_mix(deficit, CATALOG, PRICES, 10)
+        self.assertTrue(covered(deficit, mix))
+        self.assertEqual(mix, {'r3.large': 2})
+
+    def test_large_deficit_is_bounded(self):
+        deficit = {'cpus': 60*3.1, 'mem': 60*14000.0, 'disk': 60*45000.0}
+        started = time.time()
+        mix = fleet.cheapest_mix(deficit, CATALOG, PRICES, 1000)
+        self.assertLess(time.time() - started, 5)
+        self.assertTrue(covered(deficit, mix))
+
+    def test_no_mix_within_max_count(self):
+        deficit = {'cpus': 100.0, 'mem': 0.0, 'disk': 0.0}
+        self.assertEqual(fleet.cheapest_mix(deficit, CATALOG, PRICES, 3), None)
+
+class CapacityTest(unittest.TestCase):
+    def test_types_outside_the_catalog_count_as_default(self):
+        default = {'instance_type': 't2.large', 'cpus': 2, 'mem': 8000, 'disk': 20000}
+        members = [('i-1', 'm3.large', False), ('i-2', 't2.large', False)]
+        capacity = fleet.get_fleet_capacity(members, CATALOG, default)
+        self.assertEqual(capacity, {'cpus': 4.0, 'mem': 15500.0, 'disk': 52000.0})
+
+    def test_types_outside_the_catalog_are_removed_first(self):
+        default = {'instance_type': 't2.large', 'cpus': 2, 'mem': 8000, 'disk': 20000}
+        members = [('i-1', 'r3.xlarge', False), ('sir-2', 'm3.large', True), ('i-3', 't2.large', False)]
+        deficit = {'cpus': -5.0, 'mem': -20000.0, 'disk': -60000.0}
+        removable = fleet.get_removable_members(deficit, members, CATALOG, PRICES, default)
+        self.assertEqual(removable, [('i-3', 't2.large', False), ('sir-2', 'm3.large', True)])
+
+if __name__ == '__main__':
+    unittest.main()
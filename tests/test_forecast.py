@@ -0,0 +1,48 @@
+import datetime
+import unittest
+
+import dateutil.tz
+
+import forecast
+
+class Instance(object):
+    def __init__(self, instance_id, ip):
+        self.instance_id = instance_id
+        self.private_ip_address = ip
+
+def request(request_id, instance_id, created):
+    return {u'SpotInstanceRequestId': request_id,
+            u'InstanceId': instance_id,
+            u'CreateTime': datetime.datetime.fromtimestamp(created, dateutil.tz.tzutc())}
+
+class LeadTimeTrackerTest(unittest.TestCase):
+    def test_registration_is_measured_once(self):
+        tracker = forecast.LeadTimeTracker(300, 1000, alpha=0.5)
+        requests = [request('sir-1', 'i-1', 1100)]
+        instances = [Instance('i-1', '10.0.0.1')]
+
+        self.assertTrue(tracker.waiting(requests, instances))
+        tracker.observe(requests, instances, set(), 1200)
+        self.assertEqual(tracker.samples, 0)
+
+        tracker.observe(requests, instances, set(['10.0.0.1']), 1300)
+        self.assertEqual((tracker.samples, tracker.lead_time), (1, 250))
+        self.assertFalse(tracker.waiting(requests, instances))
+
+    def test_requests_from_before_the_start_are_not_measured(self):
+        tracker = forecast.LeadTimeTracker(300, 1000)
+        requests = [request('sir-1', 'i-1', 900)]
+        self.assertFalse(tracker.waiting(requests, [Instance('i-1', '10.0.0.1')]))
+
+    def test_requests_that_left_the_listings_are_forgotten(self):
+        tracker = forecast.LeadTimeTracker(300, 1000)
+        requests = [request('sir-1', 'i-1', 1100), request('sir-2', 'i-2', 1100)]
+        instances = [Instance('i-1', '10.0.0.1'), Instance('i-2', '10.0.0.2')]
+        tracker.observe(requests, instances, set(['10.0.0.1', '10.0.0.2']), 1300)
+        self.assertEqual(tracker.measured, set(['sir-1', 'sir-2']))
+
+        tracker.forget(requests[1:])
+        self.assertEqual(tracker.measured, set(['sir-2']))
+
+if __name__ == '__main__':
+    unittest.main()
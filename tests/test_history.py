@@ -0,0 +1,67 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import history
+
+FIELDS = ['cpus_used', 'mem_used']
+
+class WindowTest(unittest.TestCase):
+    def test_aggregates_match_a_scan_of_the_window(self):
+        rng = random.Random(16)
+        window = history.Window(300, FIELDS)
+        readings = []
+        timestamp = 1000.0
+        for i in range(2000):
+            timestamp += rng.choice([1, 10, 30, 60, 120])
+            row = [float(rng.randint(0, 50)), rng.uniform(0, 1e5)]
+            window.add(timestamp, row)
+            readings.append((timestamp, row))
+
+            inside = [r for t, r in readings if t > timestamp - 300]
+            self.assertEqual(len(window), len(inside))
+            for f, field in enumerate(FIELDS):
+                values = sorted(r[f] for r in inside)
+                self.assertAlmostEqual(window.mean(field), sum(values) / len(values), places=6)
+                self.assertEqual(window.max(field), values[-1])
+                self.assertEqual(window.aggregate(field, 'p90'), values[min(len(values) - 1, int(0.9 * len(values)))])
+
+    def test_empty_window(self):
+        window = history.Window(60, FIELDS)
+        self.assertEqual((window.mean('cpus_used'), window.max('cpus_used'), window.percentile('cpus_used', 0.5)),
+                         (None, None, None))
+
+    def test_statistics_are_checked(self):
+        self.assertEqual(history.parse_statistic('p99.5'), 'p99.5')
+        self.assertRaises(ValueError, history.parse_statistic, 'p101')
+        self.assertRaises(ValueError, history.parse_statistic, 'median')
+
+class RingBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'history.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_keeps_the_last_readings_across_a_restart(self):
+        ring = history.RingBuffer(4, FIELDS, path=self.path)
+        window = ring.window(25)
+        for i in range(6):
+            ring.append(i * 10, {'cpus_used': i, 'mem_used': i * 100})
+        ring.flush()
+        self.assertEqual(window.max('mem_used'), 500)
+        self.assertEqual(len(window), 3)
+
+        ring = history.RingBuffer(4, FIELDS, path=self.path)
+        self.assertEqual([t for t, values in ring.readings()], [20, 30, 40, 50])
+        self.assertEqual(ring.window(25).mean('cpus_used'), 4)
+
+    def test_a_file_of_another_layout_starts_empty(self):
+        history.RingBuffer(4, FIELDS, path=self.path).append(0, {'cpus_used': 1, 'mem_used': 1})
+        self.assertEqual(len(history.RingBuffer(8, FIELDS, path=self.path)), 0)
+
+if __name__ == '__main__':
+    unittest.main()
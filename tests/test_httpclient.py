@@ -0,0 +1,52 @@
+import BaseHTTPServer
+import json
+import threading
+import unittest
+
+import httpclient
+
+BODY = json.dumps({'queue': [{'count': i} for i in range(100)]})
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, format, *args):
+        pass
+
+class HttpClientTest(unittest.TestCase):
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.handle_request)
+        self.thread.daemon = True
+        self.thread.start()
+        self.host = '%s:%i' % self.server.server_address
+        self.url = 'http://%s/v2/queue' % self.host
+        self.client = httpclient.HttpClient()
+
+    def tearDown(self):
+        for connections in self.client.idle.values():
+            for connection in connections:
+                connection.close()
+        self.thread.join(5)
+        self.server.server_close()
+
+    def test_items_are_streamed_and_the_connection_reused(self):
+        items = list(self.client.iter_json(self.url, 'queue.item', 5))
+        self.assertEqual([item['count'] for item in items], range(100))
+        self.assertEqual(len(self.client.idle[self.host]), 1)
+
+    def test_an_abandoned_stream_closes_its_connection(self):
+        stream = self.client.iter_json(self.url, 'queue.item', 5)
+        self.assertEqual(next(stream)['count'], 0)
+        stream.close()
+        self.assertEqual(self.client.idle.get(self.host, []), [])
+
+if __name__ == '__main__':
+    unittest.main()
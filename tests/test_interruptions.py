@@ -0,0 +1,77 @@
+import datetime
+import os
+import unittest
+
+import dateutil.tz
+import yaml
+
+import burst
+import fakecloud
+import interruptions
+import inventory
+
+CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config.yml')
+
+class NoticeTest(unittest.TestCase):
+    def test_request_notices(self):
+        update = datetime.datetime(2017, 9, 18, 8, 20, tzinfo=dateutil.tz.tzutc())
+        requests = [{u'SpotInstanceRequestId': 'sir-1', u'InstanceId': 'i-1',
+                     u'Status': {u'Code': 'marked-for-termination', u'UpdateTime': update}},
+                    {u'SpotInstanceRequestId': 'sir-2', u'InstanceId': 'i-2',
+                     u'Status': {u'Code': 'fulfilled', u'UpdateTime': update}},
+                    {u'SpotInstanceRequestId': 'sir-3',
+                     u'Status': {u'Code': 'marked-for-stop', u'UpdateTime': update}}]
+        self.assertEqual(interruptions.request_notices(requests), {'i-1': 1505722800 + 120})
+
+    def test_metadata_notices(self):
+        actions = {'i-1': {u'action': 'terminate', u'time': '2017-09-18T08:22:00Z'},
+                   'i-2': {u'action': 'none', u'time': '2017-09-18T08:22:00Z'}}
+        self.assertEqual(interruptions.metadata_notices(actions), {'i-1': 1505722920})
+
+class RelayTest(unittest.TestCase):
+    """Against the instance-action relay and EC2 of the fake cloud."""
+
+    def setUp(self):
+        burst.verbose = False
+        self.cloud = fakecloud.FakeCloud(yaml.safe_load(open(CONFIG)), 3, price=0.02)
+        self.server = fakecloud.start_server(self.cloud)
+        self.url = 'http://%s:%i/spot/instance-actions' % self.server.server_address
+
+    def tearDown(self):
+        # Lets the keep-alive handler threads end
+        for connections in burst.http.idle.values():
+            for connection in connections:
+                connection.close()
+        burst.http.idle.clear()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def outbid(self):
+        # Above the bid of the preloaded instances, which get their notice
+        self.cloud.ec2.prices.append((self.cloud.clock.now - 1, 1.0))
+
+    def test_no_notices_while_the_bids_hold(self):
+        self.assertEqual(burst.fetch_interruption_notices(self.url, 5), {})
+
+    def test_relayed_notices_match_the_spot_requests(self):
+        self.outbid()
+        relayed = burst.fetch_interruption_notices(self.url, 5)
+        self.assertEqual(len(relayed), 3)
+
+        requested = interruptions.request_notices(inventory.fetch_spot_requests(self.cloud.ec2))
+        self.assertEqual(sorted(relayed), sorted(requested))
+        for instance_id in relayed:
+            self.assertTrue(abs(relayed[instance_id] - requested[instance_id]) <= 1)
+
+    def test_interrupted_instances_stop_serving(self):
+        self.outbid()
+        instances = [inventory.SpotInstance(i) for i in inventory.fetch_spot_instances(self.cloud.ec2)]
+        snapshot = {'cur_slaves': instances}
+        burst.add_interruptions(snapshot, burst.fetch_interruption_notices(self.url, 5))
+        self.assertEqual(burst.serving_instances(snapshot), [])
+
+    def test_an_unreachable_relay_gives_no_notices(self):
+        self.assertEqual(burst.fetch_interruption_notices('http://127.0.0.1:1/spot/instance-actions', 1), {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import journal
+
+class RecordingClient(object):
+    def __init__(self):
+        self.calls = []
+
+    def request_spot_instances(self, **kwargs):
+        self.calls.append(kwargs)
+        raise IOError('connection reset')
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'journal.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_unfinished_intents_are_recovered(self):
+        j = journal.Journal(self.path)
+        first = j.intent('default', 'terminate_instances', {'InstanceIds': ['i-1']})
+        j.done('default', first, {'ok': True})
+        second = j.intent('default', 'terminate_instances', {'InstanceIds': ['i-2']})
+        j.tick('default', {}, 0, {'forecaster': None})
+        j.commit()
+
+        recovered = journal.Journal(self.path).recover('default', 120)
+        self.assertEqual([r['seq'] for r in recovered['unfinished']], [second])
+        self.assertEqual(recovered['state'], {'forecaster': None})
+
+    def test_recent_requests_count_as_placed(self):
+        j = journal.Journal(self.path)
+        intent = j.intent('default', 'request_spot_instances', {'InstanceType': 'm4.large'})
+        j.done('default', intent, {'requests': [{'id': 'sir-old', 'created': 100.0},
+                                                {'id': 'sir-new', 'created': 990.0}]})
+        j.commit()
+
+        recovered = journal.Journal(self.path).recover('default', 120, now=1000.0)
+        self.assertEqual([r['id'] for r in recovered['requests']], ['sir-new'])
+
+    def test_torn_tail_is_dropped_before_appending(self):
+        j = journal.Journal(self.path)
+        j.intent('default', 'terminate_instances', {'InstanceIds': ['i-1']})
+        j.commit()
+        with open(self.path, 'a') as f:
+            f.write('{"type": "intent", "cluster": "default", "ca')
+
+        j = journal.Journal(self.path)
+        intent = j.intent('default', 'request_spot_instances', {'InstanceType': 'm4.large'})
+        j.commit()
+
+        recovered = journal.Journal(self.path).recover('default', 120)
+        self.assertEqual([r['seq'] for r in recovered['unfinished']], [1, intent])
+        self.assertEqual(intent, 2)
+        self.assertEqual(recovered['unfinished'][1]['call'], 'request_spot_instances')
+
+    def test_compaction_keeps_what_recovery_needs(self):
+        j = journal.Journal(self.path, max_bytes=0)
+        done = j.intent('default', 'terminate_instances', {'InstanceIds': ['i-1']})
+        j.done('default', done, {'ok': True})
+        unfinished = j.intent('default', 'terminate_instances', {'InstanceIds': ['i-2']})
+        j.tick('default', {}, 0, {'step': 1})
+        j.tick('default', {}, 0, {'step': 2})
+        j.commit()
+
+        recovered = journal.Journal(self.path).recover('default', 120)
+        self.assertEqual([r['seq'] for r in recovered['unfinished']], [unfinished])
+        self.assertEqual(recovered['state'], {'step': 2})
+
+    def test_reissued_request_keeps_its_zone_and_subnet(self):
+        base = {'ImageId': 'ami-1', 'InstanceType': 'm3.large', 'SubnetId': 'subnet-default'}
+        zoned = dict(base, InstanceType='r3.large', Placement={'AvailabilityZone': 'eu-central-1b'}, SubnetId='subnet-b')
+        unzoned = dict(base, Placement={'AvailabilityZone': 'eu-central-1c'})
+        del unzoned['SubnetId']
+
+        client = RecordingClient()
+        journaled = journal.JournaledClient(client, journal.Journal(self.path), 'default')
+        for specification in [zoned, unzoned]:
+            self.assertRaises(IOError, journaled.request_spot_instances,
+                              SpotPrice='0.02', InstanceCount=1, LaunchSpecification=specification)
+
+        placed = list(client.calls)
+        for record in journal.Journal(self.path).records:
+            if record['type'] == 'intent':
+                journal.reissue(client, record, base)
+
+        self.assertEqual(client.calls[2:], placed)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import json
+import threading
+import time
+import unittest
+
+from kazoo.exceptions import NoNodeError
+
+import burst
+import leader
+
+class FakeZooKeeper(object):
+    """Stand-in for a KazooClient holding the nodes of a Mesos election."""
+
+    def __init__(self, nodes):
+        self.nodes = dict(nodes)
+        self.watches = []
+        self.started = False
+
+    def start(self, timeout=None):
+        self.started = True
+
+    def stop(self):
+        self.started = False
+
+    def close(self):
+        pass
+
+    def get_children(self, path):
+        return [name.rsplit('/', 1)[1] for name in self.nodes if name.rsplit('/', 1)[0] == path]
+
+    def get(self, path):
+        if path not in self.nodes:
+            raise NoNodeError()
+        return self.nodes[path], None
+
+    def ChildrenWatch(self, path, func):
+        self.watches.append((path, func))
+        func(self.get_children(path))
+
+    def elect(self, nodes):
+        # Replaces the election and fires the watches, as ZooKeeper would
+        self.nodes = dict(nodes)
+        for path, func in self.watches:
+            func(self.get_children(path))
+
+def master(ip, port=5050):
+    return json.dumps({'address': {'ip': ip, 'port': port}, 'pid': 'master@%s:%i' % (ip, port)})
+
+class MesosLeaderDetectorTest(unittest.TestCase):
+    def setUp(self):
+        self.zk = FakeZooKeeper({'/mesos/json.info_0000000002': master('10.0.0.2'),
+                                 '/mesos/json.info_0000000003': master('10.0.0.3'),
+                                 '/mesos/log_replicas': ''})
+        self.detector = leader.MesosLeaderDetector('zk://zk1:2181,zk2:2181/mesos', client=self.zk)
+        self.changes = []
+        self.detector.add_listener(self.changes.append)
+        self.detector.start()
+
+    def test_the_lowest_sequence_leads(self):
+        self.assertTrue(self.zk.started)
+        self.assertEqual(self.detector.get(), '10.0.0.2:5050')
+        self.assertEqual(self.changes, ['10.0.0.2:5050'])
+
+    def test_listeners_follow_the_election(self):
+        self.zk.elect({'/mesos/json.info_0000000003': master('10.0.0.3')})
+        self.assertEqual(self.detector.get(), '10.0.0.3:5050')
+
+        # Only a new leader is passed on
+        self.zk.elect({'/mesos/json.info_0000000003': master('10.0.0.3'),
+                       '/mesos/json.info_0000000004': master('10.0.0.4')})
+        self.assertEqual(self.changes, ['10.0.0.2:5050', '10.0.0.3:5050'])
+
+    def test_a_leader_gone_while_listing_is_skipped(self):
+        self.assertEqual(self.detector.resolve(['json.info_0000000001', 'json.info_0000000003']), '10.0.0.3:5050')
+
+    def test_no_leader_during_an_election(self):
+        self.zk.elect({})
+        self.assertEqual(self.detector.get(), None)
+
+class LeaderChangeTest(unittest.TestCase):
+    def setUp(self):
+        burst.verbose = False
+        self.config = {'name': 'test', 'execution_interval': 30}
+        self.cluster = {'config': self.config, 'wakeup': threading.Event()}
+
+    def test_a_leader_change_cuts_the_sleep_short(self):
+        zk = FakeZooKeeper({'/mesos/json.info_0000000002': master('10.0.0.2')})
+        detector = leader.MesosLeaderDetector('zk://zk1:2181/mesos', client=zk)
+        detector.start()
+        detector.add_listener(lambda leader: burst.on_leader_change(self.cluster, leader))
+
+        change = threading.Timer(0.1, zk.elect, [{'/mesos/json.info_0000000003': master('10.0.0.3')}])
+        change.start()
+        started = time.time()
+        burst.sleep_until_next_loop(started, self.config, self.cluster['wakeup'])
+        change.join()
+
+        self.assertTrue(time.time() - started < 5)
+        self.assertFalse(self.cluster['wakeup'].is_set())
+        self.assertEqual(detector.get(), '10.0.0.3:5050')
+
+    def test_without_a_change_the_interval_is_slept(self):
+        self.config['execution_interval'] = 0.2
+        started = time.time()
+        burst.sleep_until_next_loop(started, self.config, self.cluster['wakeup'])
+        self.assertTrue(time.time() - started >= 0.2)
+
+class ParseTest(unittest.TestCase):
+    def test_zkurl_with_credentials(self):
+        self.assertEqual(leader.parse_zkurl('zk://user:pass@zk1:2181,zk2:2181/mesos/'), ('zk1:2181,zk2:2181', '/mesos'))
+
+    def test_master_info_of_older_masters(self):
+        self.assertEqual(leader.parse_master_info(json.dumps({'pid': 'master@10.0.0.9:5050'})), '10.0.0.9:5050')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,26 @@
+import unittest
+
+import metrics
+
+class RenderTest(unittest.TestCase):
+    def setUp(self):
+        self.registered = list(metrics.registry)
+
+    def tearDown(self):
+        metrics.registry[:] = self.registered
+
+    def test_counter_samples_end_in_total(self):
+        counter = metrics.Counter('test_overruns', 'Loops that overran', ('cluster',))
+        counter.inc(1, ('a',))
+        counter.inc(2, ('a',))
+        self.assertEqual(counter.render(), ['# TYPE test_overruns counter',
+                                            '# HELP test_overruns Loops that overran',
+                                            'test_overruns_total{cluster="a"} 3.0'])
+
+    def test_gauge_samples_keep_their_name(self):
+        gauge = metrics.Gauge('test_bid', 'Current bid', ('cluster',))
+        gauge.set(0.25, ('a"b',))
+        self.assertEqual(gauge.render()[-1], 'test_bid{cluster="a\\"b"} 0.25')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,17 @@
+import unittest
+
+import pipeline
+
+class LatestQueueTest(unittest.TestCase):
+    def test_put_replaces_the_waiting_item(self):
+        queue = pipeline.LatestQueue()
+        self.assertFalse(queue.put(1))
+        self.assertTrue(queue.put(2))
+        self.assertEqual(queue.get(), 2)
+        self.assertFalse(queue.put(3))
+
+    def test_get_times_out_when_empty(self):
+        self.assertEqual(pipeline.LatestQueue().get(timeout=0.01), None)
+
+if __name__ == '__main__':
+    unittest.main()
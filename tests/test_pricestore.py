@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import pricestore
+
+class PriceHistoryClient(object):
+    def __init__(self, entries):
+        self.entries = entries
+
+    def describe_spot_price_history(self, **kwargs):
+        start = pricestore.to_epoch(kwargs['StartTime'])
+        end = pricestore.to_epoch(kwargs['EndTime'])
+        return {'SpotPriceHistory': [{u'AvailabilityZone': zone,
+                                      u'InstanceType': instance_type,
+                                      u'Timestamp': pricestore.from_epoch(timestamp),
+                                      u'SpotPrice': str(price)}
+                                     for zone, instance_type, timestamp, price in self.entries
+                                     if start <= timestamp <= end]}
+
+class ReadingClient(PriceHistoryClient):
+    """Reads the store from another thread while a page is fetched."""
+
+    def __init__(self, entries, store):
+        PriceHistoryClient.__init__(self, entries)
+        self.store = store
+        self.read = []
+
+    def describe_spot_price_history(self, **kwargs):
+        reader = threading.Thread(target=lambda: self.read.append(self.store.current('eu-central-1b', 'm4.large')))
+        reader.start()
+        reader.join(5)
+        return PriceHistoryClient.describe_spot_price_history(self, **kwargs)
+
+class FailingClient(object):
+    def describe_spot_price_history(self, **kwargs):
+        raise IOError('connection reset')
+
+class PriceStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'prices.db')
+        self.now = 10000
+        self.client = PriceHistoryClient([('eu-central-1a', 'm4.large', t, 0.01 * (i + 1))
+                                          for i, t in enumerate(range(5000, 10001, 1000))])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def store(self):
+        return pricestore.PriceStore(self.path, history_window=3000, refresh_interval=0, clock=lambda: self.now)
+
+    def test_queries_answer_from_the_refreshed_series(self):
+        store = self.store()
+        store.refresh(self.client, 'eu-central-1a', 'm4.large')
+        self.assertEqual(store.current('eu-central-1a', 'm4.large'), 0.06)
+        self.assertEqual(store.window('eu-central-1a', 'm4.large', 1500), [0.04, 0.05, 0.06])
+        self.assertAlmostEqual(store.mean('eu-central-1a', 'm4.large', 1500), 0.05)
+
+    def test_entries_past_the_history_window_are_pruned(self):
+        store = self.store()
+        store.refresh(self.client, 'eu-central-1a', 'm4.large')
+        self.now = 14500
+        store.refresh(self.client, 'eu-central-1a', 'm4.large')
+
+        self.assertEqual(store.series[('eu-central-1a', 'm4.large')], ([10000], [0.06]))
+        rows = store.db.execute('SELECT timestamp FROM spot_prices').fetchall()
+        self.assertEqual(rows, [(10000,)])
+
+    def test_reads_do_not_wait_for_ec2(self):
+        store = self.store()
+        client = ReadingClient(self.client.entries, store)
+        store.refresh(client, 'eu-central-1a', 'm4.large')
+        self.assertEqual(client.read, [None])
+        self.assertEqual(store.current('eu-central-1a', 'm4.large'), 0.06)
+
+    def test_a_failed_refresh_stays_due(self):
+        store = pricestore.PriceStore(self.path, history_window=3000, refresh_interval=300, clock=lambda: self.now)
+        self.assertRaises(IOError, store.refresh, FailingClient(), 'eu-central-1a', 'm4.large')
+        self.assertTrue(store.refresh(self.client, 'eu-central-1a', 'm4.large'))
+        self.assertFalse(store.refresh(self.client, 'eu-central-1a', 'm4.large'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import random
+import unittest
+
+import burst
+
+RESOURCES = ['cpus', 'mem', 'disk']
+
+def legacy_decision(resources_in_use, active, pending, config):
+    # The decision before the closed form: one instance up per loop, and down
+    # by stepping through the instances one by one
+    burst_point = config['burst_point_percentage']
+    pending_active = active + pending
+    total = dict((r, config['baseline_%s' % r] + pending_active * config['instance_%s' % r]) for r in RESOURCES)
+
+    if any(resources_in_use[r] / total[r] >= burst_point for r in RESOURCES):
+        return 0 if pending_active + 1 > config['maximum_spot_slaves'] else 1
+
+    if pending_active == 0:
+        return 0
+
+    scale_down = 0
+    while pending_active >= 0:
+        usage = dict((r, max(0.0, resources_in_use[r] / (total[r] - scale_down * config['instance_%s' % r]))) for r in RESOURCES)
+        if not any(usage[r] >= burst_point for r in RESOURCES):
+            scale_down += 1
+            pending_active -= 1
+            continue
+        break
+
+    return -(scale_down - 1) if scale_down > 1 else 0
+
+def random_case(rng):
+    config = {'burst_point_percentage': rng.choice([0.5, 0.75, 0.8, 0.9, rng.uniform(0.3, 0.95)]),
+              'maximum_spot_slaves': rng.randint(0, 40)}
+    for r, (baseline, instance) in zip(RESOURCES, [(16, 4), (65536, 16384), (500000, 32000)]):
+        config['baseline_%s' % r] = float(rng.choice([baseline, rng.randint(1, baseline * 2)]))
+        config['instance_%s' % r] = float(rng.choice([instance, rng.randint(1, instance * 2)]))
+
+    active = rng.randint(0, 30)
+    pending = rng.randint(0, 10)
+    resources_in_use = dict()
+    for r in RESOURCES:
+        capacity = config['baseline_%s' % r] + rng.randint(0, 45) * config['instance_%s' % r]
+        if rng.random() < 0.2:
+            # Exactly at the burst point of some capacity
+            resources_in_use[r] = capacity * config['burst_point_percentage']
+        else:
+            resources_in_use[r] = rng.uniform(0, capacity)
+
+    return resources_in_use, active, pending, config
+
+class ScalingDecisionTest(unittest.TestCase):
+    def setUp(self):
+        burst.verbose = False
+
+    def decide(self, resources_in_use, active, pending, config):
+        percent = dict((r, 0.0) for r in RESOURCES)
+        return burst.get_scaling_decision(resources_in_use, percent, active, pending, config)
+
+    def test_matches_the_legacy_decision(self):
+        rng = random.Random(2017)
+        for i in range(20000):
+            resources_in_use, active, pending, config = random_case(rng)
+            decision = self.decide(resources_in_use, active, pending, config)
+
+            if decision > 0:
+                # The legacy decision gets there one loop at a time
+                count = active + pending
+                while legacy_decision(resources_in_use, count, 0, config) == 1:
+                    count += 1
+                self.assertEqual(decision, count - active - pending, (resources_in_use, active, pending, config))
+            else:
+                self.assertEqual(decision, legacy_decision(resources_in_use, active, pending, config),
+                                 (resources_in_use, active, pending, config))
+
+    def test_required_slaves_stay_below_the_burst_point(self):
+        config = {'burst_point_percentage': 0.8,
+                  'baseline_cpus': 16.0, 'baseline_mem': 65536.0, 'baseline_disk': 500000.0,
+                  'instance_cpus': 4.0, 'instance_mem': 16384.0, 'instance_disk': 32000.0}
+        self.assertEqual(burst.get_required_slaves({'cpus': 12.8, 'mem': 0.0, 'disk': 0.0}, config), 1)
+        self.assertEqual(burst.get_required_slaves({'cpus': 12.7, 'mem': 0.0, 'disk': 0.0}, config), 0)
+        self.assertEqual(burst.get_required_slaves({'cpus': 0.0, 'mem': 131072.0, 'disk': 0.0}, config), 7)
+
+if __name__ == '__main__':
+    unittest.main()
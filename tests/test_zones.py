@@ -0,0 +1,44 @@
+import datetime
+import unittest
+
+import dateutil.tz
+
+import inventory
+import zones
+
+def request(request_id, state, zone, created):
+    return {u'SpotInstanceRequestId': request_id,
+            u'State': state,
+            u'LaunchSpecification': {u'Placement': {u'AvailabilityZone': zone}},
+            u'CreateTime': datetime.datetime.fromtimestamp(created, dateutil.tz.tzutc())}
+
+class ZoneTrackerTest(unittest.TestCase):
+    def setUp(self):
+        self.inventory = inventory.Inventory()
+        self.tracker = zones.ZoneTracker([('eu-central-1a', None), ('eu-central-1b', 'subnet-b')], cooloff=100)
+
+    def observe(self, requests, now):
+        changes = self.inventory.update(requests, [])
+        return self.tracker.observe(self.inventory.spot_requests(), changes, 60, now)
+
+    def test_zones_with_requests_open_past_the_timeout_are_avoided(self):
+        requests = [request('sir-1', 'open', 'eu-central-1a', 1000),
+                    request('sir-2', 'open', 'eu-central-1b', 1050)]
+        self.assertEqual(self.observe(requests, 1030), set())
+        self.assertEqual(self.observe(requests, 1070), set(['eu-central-1a']))
+        self.assertEqual(self.observe(requests, 1120), set(['eu-central-1a', 'eu-central-1b']))
+
+    def test_fulfilled_and_closed_requests_are_no_longer_watched(self):
+        self.observe([request('sir-1', 'open', 'eu-central-1a', 1000),
+                      request('sir-2', 'open', 'eu-central-1b', 1000)], 1030)
+        self.observe([request('sir-1', 'active', 'eu-central-1a', 1000)], 1040)
+        self.assertEqual(self.tracker.open, dict())
+        self.assertEqual(self.observe([request('sir-1', 'active', 'eu-central-1a', 1000)], 1200), set())
+
+    def test_avoided_zones_are_used_again_after_the_cooloff(self):
+        self.observe([request('sir-1', 'open', 'eu-central-1a', 1000)], 1070)
+        self.assertEqual(self.observe([], 1169), set(['eu-central-1a']))
+        self.assertEqual(self.observe([], 1170), set())
+
+if __name__ == '__main__':
+    unittest.main()
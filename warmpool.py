@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+import inventory
+import base64
+
+# A pool of instances that have run the launch configuration's bootstrap
+# once and are kept stopped. Starting one gives a Mesos agent in the time it
+# takes to boot, rather than a spot request, a fresh boot and the whole
+# bootstrap. Spot instances can not be stopped, so the pool is on-demand
+# instances, tagged with the cluster they belong to. A third tag follows
+# them through the pool:
+#
+#   bootstrapping  launched to fill the pool; powers itself off when done
+#   warm           stopped into the pool
+#   in-service     started for a burst, counted as an active instance
+
+POOL_TAG = 'cloud-burst:warm-pool'
+STATE_TAG = 'cloud-burst:pool-state'
+POOL_INSTANCE_STATES = ['pending', 'running', 'stopping', 'stopped']
+
+# Put before the bootstrap, so the agent stays off while the instance fills
+# the pool and never joins the cluster only to be powered off with tasks on
+# it. Upstart does not start it, and the bootstrap's own start of the agent
+# and its monit reload (which would start it too) are skipped. The bootstrap
+# may have CRLF line ends, hence the stripped \r.
+HOLD_AGENT = '''
+# cloud-burst warm pool: the agent stays off until started for a burst
+mkdir -p /etc/init
+echo manual > /etc/init/mesos-slave.override
+service() {
+    if [ "${1%$'\\r'}" = "mesos-slave" ]; then return 0; fi
+    command service "$@"
+}
+monit() {
+    if [ "${1%$'\\r'}" = "reload" ]; then return 0; fi
+    command monit "$@"
+}
+'''
+
+# Put after the bootstrap. UserData runs on the first boot only, so with
+# the override gone, later starts boot with the agent (and monit watching it).
+POWER_OFF = '''
+# cloud-burst warm pool: bootstrapped, now stopped until needed
+command service mesos-slave stop
+rm -f /etc/init/mesos-slave.override
+shutdown -h now
+'''
+
+def pool_user_data(user_data):
+    # The bootstrap between the hold and the power-off, after its #! line
+    if user_data.startswith('#!'):
+        first, _, rest = user_data.partition('\n')
+        return first + '\n' + HOLD_AGENT + rest + '\n' + POWER_OFF
+
+    return '#!/bin/bash\n' + HOLD_AGENT + user_data + '\n' + POWER_OFF
+
+def fetch_pool_instances(ec2client, cluster_name):
+    reservations = inventory.paginate(ec2client.describe_instances,
+                                      'Reservations',
+                                      Filters=[{'Name': 'tag:%s' % POOL_TAG, 'Values': [cluster_name]},
+                                               {'Name': 'instance-state-name', 'Values': POOL_INSTANCE_STATES}])
+    return [instance for reservation in reservations for instance in reservation[u'Instances']]
+
+def pool_state(data):
+    for tag in data.get(u'Tags', []):
+        if tag[u'Key'] == STATE_TAG:
+            return tag[u'Value']
+
+    return None
+
+def classify(pool_instances, size):
+    # The pool by what each instance can be used for
+    pool = {'in_service': [], 'warm': [], 'filling': [], 'size': size, 'changed': False}
+    for data in pool_instances:
+        instance = inventory.SpotInstance(data)
+        state = instance.state[u'Name']
+        if state == 'stopped':
+            pool['warm'].append(instance)
+        elif state == 'stopping' or pool_state(data) == 'bootstrapping':
+            pool['filling'].append(instance)
+        else:
+            pool['in_service'].append(instance)
+
+    return pool
+
+def shortfall(pool):
+    # Instances missing from the pool, counting those on their way in
+    return pool['size'] - len(pool['warm']) - len(pool['filling'])
+
+def set_state(ec2client, instance_ids, state):
+    ec2client.create_tags(Resources=instance_ids, Tags=[{'Key': STATE_TAG, 'Value': state}])
+
+def start(ec2client, pool, count):
+    # Start up to count warm instances, returns how many were started
+    instances = pool['warm'][:count]
+    if not instances:
+        return 0
+
+    instance_ids = [instance.instance_id for instance in instances]
+    set_state(ec2client, instance_ids, 'in-service')
+    ec2client.start_instances(InstanceIds=instance_ids)
+    pool['warm'] = pool['warm'][len(instances):]
+    pool['in_service'].extend(instances)
+    pool['changed'] = True
+
+    return len(instances)
+
+def stop(ec2client, pool, instances):
+    instance_ids = [instance.instance_id for instance in instances]
+    set_state(ec2client, instance_ids, 'warm')
+    ec2client.stop_instances(InstanceIds=instance_ids)
+    pool['filling'].extend(instances)
+    pool['changed'] = True
+
+def launch(ec2client, count, cluster_name, instance_type, launch_specification):
+    # The spot launch specification takes the same fields, but run_instances
+    # encodes the UserData itself
+    specification = dict(launch_specification)
+    specification.pop('InstanceType', None)
+    user_data = ''
+    if 'UserData' in specification:
+        user_data = base64.b64decode(specification.pop('UserData'))
+
+    return ec2client.run_instances(MinCount=count,
+                                   MaxCount=count,
+                                   InstanceType=instance_type,
+                                   UserData=pool_user_data(user_data),
+                                   InstanceInitiatedShutdownBehavior='stop',
+                                   TagSpecifications=[{'ResourceType': 'instance',
+                                                       'Tags': [{'Key': POOL_TAG, 'Value': cluster_name},
+                                                                {'Key': STATE_TAG, 'Value': 'bootstrapping'}]}],
+                                   **specification)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+import pricestore
+
+# Spot requests spread over several availability zones. The prices of every
+# configured zone are read in one query and the zones ranked by price and
+# recent volatility. New requests are split over the cheapest zones, and a
+# zone whose requests stay open past the request timeout is passed over for
+# a while, so its requests move to the next zone.
+
+def get_zones(config):
+    # [(zone, subnet id)], from availability_zones or the single zone and the
+    # launch configuration's subnet
+    if config.get('availability_zones'):
+        return [(z['availability_zone'], z.get('subnet_id')) for z in config['availability_zones']]
+
+    return [(config['availability_zone'], config['launch_specification'].get('SubnetId'))]
+
+def fetch_zone_prices(ec2client, zone_names, instance_types, now):
+    # {(zone, instance type): price} for the price in effect now, in one query
+    request = {'InstanceTypes': list(instance_types),
+               'ProductDescriptions': [pricestore.PRODUCT_DESCRIPTION],
+               'Filters': [{'Name': 'availability-zone', 'Values': list(zone_names)}],
+               'StartTime': pricestore.from_epoch(now),
+               'EndTime': pricestore.from_epoch(now)}
+    newest = dict()
+    while True:
+        response = ec2client.describe_spot_price_history(**request)
+        for entry in response['SpotPriceHistory']:
+            key = (entry[u'AvailabilityZone'], entry[u'InstanceType'])
+            timestamp = pricestore.to_epoch(entry[u'Timestamp'])
+            if key not in newest or timestamp > newest[key][0]:
+                newest[key] = (timestamp, float(entry[u'SpotPrice']))
+
+        if not response.get('NextToken'):
+            break
+        request['NextToken'] = response['NextToken']
+
+    return dict((key, newest[key][1]) for key in newest)
+
+def rank_zones(zones, market_prices, volatilities, max_limit, volatility_weight=1.0):
+    """The zones for one instance type, best first.
+
+    Zones are ranked by their price raised by volatility_weight times its
+    relative standard deviation, so a cheap but jumpy zone can lose to a
+    steady one. Zones without a price are left out. Each entry is a dict with
+    the zone, subnet, bid and whether the bid is held down by max_limit.
+    """
+
+    ranked = []
+    for zone, subnet_id in zones:
+        if market_prices.get(zone) is None:
+            continue
+        bid = market_prices[zone] + 0.001
+        score = market_prices[zone] * (1 + volatility_weight * (volatilities.get(zone) or 0.0))
+        ranked.append((score, {'zone': zone,
+                               'subnet_id': subnet_id,
+                               'bid': min(bid, max_limit),
+                               'capped': bid > max_limit}))
+
+    return [entry for score, entry in sorted(ranked, key=lambda r: r[0])]
+
+def request_zone(request, subnet_zones):
+    # The zone a spot request was placed in, from its placement or subnet
+    specification = request.get(u'LaunchSpecification', {})
+    zone = specification.get(u'Placement', {}).get(u'AvailabilityZone')
+    if zone is None:
+        zone = subnet_zones.get(specification.get(u'SubnetId'))
+    if zone is None:
+        zone = request.get(u'LaunchedAvailabilityZone')
+
+    return zone
+
+class ZoneTracker(object):
+    """The zones where spot requests stay open, kept between loops.
+
+    A zone with a request open longer than the timeout is avoided for
+    cooloff seconds from then on. The open requests are followed through
+    the changes of the inventory, so every change has to be observed.
+    """
+
+    def __init__(self, zones, cooloff=1800):
+        self.subnet_zones = dict((subnet_id, zone) for zone, subnet_id in zones if subnet_id)
+        self.cooloff = cooloff
+        self.avoided = dict()
+        # Zone and creation time of the open requests, by request id
+        self.open = dict()
+
+    def observe(self, spot_requests, changes, timeout, now):
+        if changes['new_requests']:
+            requests = dict((r[u'SpotInstanceRequestId'], r) for r in spot_requests)
+            for request_id in changes['new_requests']:
+                request = requests[request_id]
+                if request[u'State'] == 'open':
+                    self.open[request_id] = (request_zone(request, self.subnet_zones),
+                                             pricestore.to_epoch(request[u'CreateTime']))
+
+        for request_id in changes['fulfilled_requests'] + changes['closed_requests']:
+            self.open.pop(request_id, None)
+
+        for zone, created in self.open.values():
+            if zone is not None and now - created > timeout:
+                self.avoided[zone] = now + self.cooloff
+
+        for zone in self.avoided.keys():
+            if self.avoided[zone] <= now:
+                del self.avoided[zone]
+
+        return set(self.avoided)
+
+def split(count, ranked, spread, avoided=()):
+    """[(zone entry, count)] spreading count requests over the best zones.
+
+    Zones that are avoided or held at the bid limit are used only when no
+    other zone is left. The cheaper zones get the remainder.
+    """
+
+    usable = [z for z in ranked if z['zone'] not in avoided and not z['capped']]
+    if not usable:
+        usable = [z for z in ranked if z['zone'] not in avoided] or ranked
+    usable = usable[:max(1, spread)]
+
+    shares = []
+    for i, zone in enumerate(usable):
+        share = count / len(usable) + (1 if i < count % len(usable) else 0)
+        if share:
+            shares.append((zone, share))
+
+    return shares
+
+def placement(launch_specification, zone):
+    # The launch specification pinned to one zone and its subnet
+    specification = dict(launch_specification,
+                         Placement=dict(launch_specification.get('Placement', {}), AvailabilityZone=zone['zone']))
+    if zone['subnet_id']:
+        specification['SubnetId'] = zone['subnet_id']
+    else:
+        specification.pop('SubnetId', None)
+
+    return specification